@@ -0,0 +1,38 @@
+"""Migration to add the place_stats table and populate it.
+
+The counts on the dashboard were computed by scanning people, places and
+coverage tables on every page view. The place_stats table keeps a rollup of
+those counts for every place, which is updated whenever people or coverage
+change.
+"""
+
+from voternet.models import get_db, PlaceStats
+
+def upgrade():
+    db = get_db()
+
+    with db.transaction():
+        db.query("create table place_stats (" +
+            " place_id integer references places on delete cascade," +
+            " type place_type," +
+            " places integer default 0," +
+            " coordinators integer default 0," +
+            " volunteers integer default 0," +
+            " pb_agents integer default 0," +
+            " px_agents integer default 0," +
+            " confirmed_pb_agents integer default 0," +
+            " places_with_coordinators integer default 0," +
+            " places_with_pb_agents integer default 0," +
+            " places_with_px_agents integer default 0," +
+            " places_with_confirmed_pb_agents integer default 0," +
+            " covered_pxs integer default 0," +
+            " coverage integer default 0," +
+            " primary key (place_id, type))")
+
+        PlaceStats.rebuild()
+
+if __name__ == "__main__":
+    from voternet import webapp
+    webapp.check_config()
+
+    upgrade()
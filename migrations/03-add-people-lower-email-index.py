@@ -0,0 +1,17 @@
+"""Migration to add an index on lower(email) of people.
+
+The roles of a user are looked up by case-insensitive email when checking
+permissions. This index makes that lookup use an index scan.
+"""
+
+from voternet.models import get_db
+
+def upgrade():
+    db = get_db()
+    db.query("create index people_lower_email_idx on people(lower(email))")
+
+if __name__ == "__main__":
+    from voternet import webapp
+    webapp.check_config()
+
+    upgrade()
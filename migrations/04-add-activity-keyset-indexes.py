@@ -0,0 +1,21 @@
+"""Migration to index activity on (tstamp, id) and (place_id, tstamp, id).
+
+The activity feed is paginated by (tstamp, id). These indexes replace the
+indexes on tstamp and place_id.
+"""
+
+from voternet.models import get_db
+
+def upgrade():
+    db = get_db()
+    with db.transaction():
+        db.query("create index activity_tstamp_id_idx on activity(tstamp, id)")
+        db.query("create index activity_place_id_tstamp_idx on activity(place_id, tstamp, id)")
+        db.query("drop index activity_tstamp_idx")
+        db.query("drop index activity_place_id_idx")
+
+if __name__ == "__main__":
+    from voternet import webapp
+    webapp.check_config()
+
+    upgrade()
@@ -0,0 +1,19 @@
+"""Migration to index messages on (place_id, tstamp, id).
+
+Messages are paginated by (tstamp, id). This index replaces the index on
+place_id.
+"""
+
+from voternet.models import get_db
+
+def upgrade():
+    db = get_db()
+    with db.transaction():
+        db.query("create index messages_place_id_tstamp_idx on messages(place_id, tstamp, id)")
+        db.query("drop index messages_place_id_idx")
+
+if __name__ == "__main__":
+    from voternet import webapp
+    webapp.check_config()
+
+    upgrade()
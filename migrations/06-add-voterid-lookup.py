@@ -0,0 +1,20 @@
+"""Migration to add the voterid_lookup table.
+
+The results of looking up voter details from the voter search service,
+including the voterids that are not found, are cached in this table.
+"""
+
+from voternet.models import get_db
+
+def upgrade():
+    db = get_db()
+    db.query("create table voterid_lookup (" +
+        " voterid text primary key," +
+        " data text," +
+        " expires timestamp)")
+
+if __name__ == "__main__":
+    from voternet import webapp
+    webapp.check_config()
+
+    upgrade()
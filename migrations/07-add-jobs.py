@@ -0,0 +1,29 @@
+"""Migration to add the jobs table.
+
+Slow work like looking up voter details is run in the background by
+workers, which take the jobs from this table.
+"""
+
+from voternet.models import get_db
+
+def upgrade():
+    db = get_db()
+    with db.transaction():
+        db.query("create table jobs (" +
+            " id serial primary key," +
+            " name text," +
+            " key text," +
+            " args text," +
+            " status text default 'pending'," +
+            " error text," +
+            " created timestamp default (current_timestamp at time zone 'UTC')," +
+            " started timestamp," +
+            " finished timestamp)")
+        db.query("create index jobs_status_idx on jobs(status, id)")
+        db.query("create unique index jobs_pending_key_idx on jobs(key) where status='pending'")
+
+if __name__ == "__main__":
+    from voternet import webapp
+    webapp.check_config()
+
+    upgrade()
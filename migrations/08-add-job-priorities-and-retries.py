@@ -0,0 +1,23 @@
+"""Migration to add priorities and retries to jobs.
+"""
+
+from voternet.models import get_db
+
+def upgrade():
+    db = get_db()
+    with db.transaction():
+        db.query("alter table jobs" +
+            " add column priority integer default 0," +
+            " add column attempts integer default 0," +
+            " add column max_attempts integer default 3," +
+            " add column run_at timestamp default (current_timestamp at time zone 'UTC')")
+        db.query("update jobs set run_at=created")
+        db.query("drop index jobs_status_idx")
+        db.query("create index jobs_pending_idx on jobs(priority desc, id) where status='pending'")
+        db.query("create index jobs_status_idx on jobs(status)")
+
+if __name__ == "__main__":
+    from voternet import webapp
+    webapp.check_config()
+
+    upgrade()
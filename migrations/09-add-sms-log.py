@@ -0,0 +1,29 @@
+"""Migration to add the sms_batch and sms_log tables.
+
+Every SMS sent is recorded in sms_log with its status, which is used to
+resume sending a batch after a crash.
+"""
+
+from voternet.models import get_db
+
+def upgrade():
+    db = get_db()
+    with db.transaction():
+        db.query("create table sms_batch (" +
+            " id serial primary key," +
+            " message text," +
+            " created timestamp default (current_timestamp at time zone 'UTC'))")
+        db.query("create table sms_log (" +
+            " batch_id integer references sms_batch," +
+            " phone text," +
+            " status text default 'pending'," +
+            " response text," +
+            " tstamp timestamp default (current_timestamp at time zone 'UTC')," +
+            " primary key (batch_id, phone))")
+        db.query("create index sms_log_unsent_idx on sms_log(batch_id) where status != 'sent'")
+
+if __name__ == "__main__":
+    from voternet import webapp
+    webapp.check_config()
+
+    upgrade()
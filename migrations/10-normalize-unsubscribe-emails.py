@@ -0,0 +1,21 @@
+"""Migration to lowercase the unsubscribed emails and index them.
+
+Removes the duplicate addresses that differ only in case and adds a unique
+index on lower(email), used to filter unsubscribed recipients in SQL.
+"""
+
+from voternet.models import get_db
+
+def upgrade():
+    db = get_db()
+    with db.transaction():
+        db.query("delete from unsubscribe a using unsubscribe b" +
+            " where lower(trim(a.email)) = lower(trim(b.email)) and a.id > b.id")
+        db.query("update unsubscribe set email=lower(trim(email))")
+        db.query("create unique index unsubscribe_lower_email_idx on unsubscribe(lower(email))")
+
+if __name__ == "__main__":
+    from voternet import webapp
+    webapp.check_config()
+
+    upgrade()
@@ -0,0 +1,28 @@
+"""Migration to add the send_ledger table.
+
+The emails sent to each address were recorded as things of type email, with
+keys like sendmail_voterid_added/foo@example.com. Those records are copied to
+the new send_ledger table.
+"""
+
+from voternet.models import get_db
+
+def upgrade():
+    db = get_db()
+    with db.transaction():
+        db.query("create table send_ledger (" +
+            " template text," +
+            " email text," +
+            " sent_on timestamp default (current_timestamp at time zone 'UTC')," +
+            " primary key (template, email))")
+        db.query("insert into send_ledger (template, email, sent_on)" +
+            " select split_part(key, '/', 1), lower(substr(key, strpos(key, '/') + 1))," +
+            "   max((data::json->>'sent_on')::timestamp)" +
+            " from things where type='email'" +
+            " group by 1, 2")
+
+if __name__ == "__main__":
+    from voternet import webapp
+    webapp.check_config()
+
+    upgrade()
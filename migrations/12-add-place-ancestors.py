@@ -0,0 +1,24 @@
+"""Migration to add the place_ancestors table and populate it.
+
+Subtree queries used to match a place id against one of the hierarchy
+columns of places, which was different for every type of place. With
+place_ancestors, they all use a single index scan on ancestor_id.
+"""
+
+from voternet.models import get_db, Place
+
+def upgrade():
+    db = get_db()
+    with db.transaction():
+        db.query("create table place_ancestors (" +
+            " ancestor_id integer references places on delete cascade," +
+            " place_id integer references places on delete cascade," +
+            " primary key (ancestor_id, place_id))")
+        db.query("create index place_ancestors_place_id_idx on place_ancestors(place_id)")
+        Place.update_ancestors()
+
+if __name__ == "__main__":
+    from voternet import webapp
+    webapp.check_config()
+
+    upgrade()
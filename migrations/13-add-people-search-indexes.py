@@ -0,0 +1,31 @@
+"""Migration to add trigram indexes for searching people.
+
+People are searched by fragments of their name, email, phone number and
+voter ID. The trigram indexes of pg_trgm make those LIKE '%...%' lookups use
+index scans. Phone numbers are indexed after normalizing them the same way
+as utils.process_phone.
+
+Creating the pg_trgm extension may require superuser privileges.
+"""
+
+from voternet.models import get_db
+
+def upgrade():
+    db = get_db()
+    with db.transaction():
+        db.query("create extension if not exists pg_trgm")
+        db.query(
+            "create function normalize_phone(phone text) returns text as" +
+            " 'select case when length(d) = 12 and d like ''91%'' then substr(d, 3) else d end" +
+            "  from (select regexp_replace(phone, ''[^0-9]'', '''', ''g'') as d) t'" +
+            " language sql immutable")
+        db.query("create index people_name_trgm_idx on people using gin (lower(name) gin_trgm_ops)")
+        db.query("create index people_email_trgm_idx on people using gin (lower(email) gin_trgm_ops)")
+        db.query("create index people_phone_trgm_idx on people using gin (normalize_phone(phone) gin_trgm_ops)")
+        db.query("create index people_voterid_trgm_idx on people using gin (lower(voterid) gin_trgm_ops)")
+
+if __name__ == "__main__":
+    from voternet import webapp
+    webapp.check_config()
+
+    upgrade()
@@ -0,0 +1,20 @@
+"""Migration to add the heartbeat column to the jobs table.
+
+Running jobs are considered abandoned when their heartbeat is too old,
+instead of when they are running for too long. The jobs running now get
+their start time as the heartbeat.
+"""
+
+from voternet.models import get_db
+
+def upgrade():
+    db = get_db()
+    with db.transaction():
+        db.query("alter table jobs add column heartbeat timestamp")
+        db.query("update jobs set heartbeat=started where status='running'")
+
+if __name__ == "__main__":
+    from voternet import webapp
+    webapp.check_config()
+
+    upgrade()
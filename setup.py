@@ -7,7 +7,7 @@ dependencies = [
     'markdown',
     'pyYAML',
     'tablib',
-    'xappy',
+    'XlsxWriter',
     'flup',
     'pytz',
     'WTForms'
@@ -0,0 +1,158 @@
+"""Local servers standing in for the external services in tests.
+
+StandInServer answers HTTP GET requests with the JSON returned by the
+respond function and counts the connections and the requests it gets. It can
+also misbehave, by dropping some requests without responding, by closing the
+connection after every response while keeping it alive in the headers, by
+responding slowly or by responding with an error status.
+
+SMTPSink accepts all the messages sent to it and keeps them. It can also
+close the connection after every message, or drop the connection after
+receiving a message without acknowledging it.
+"""
+import json
+import time
+import smtpd
+import socket
+import asyncore
+import threading
+import SocketServer
+import BaseHTTPServer
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+            self.server.open_connections.add(self.connection)
+
+    def finish(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.finish(self)
+        with self.server.lock:
+            self.server.open_connections.discard(self.connection)
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append(self.path)
+            drop = server.drop > 0
+            if drop:
+                server.drop -= 1
+        if drop:
+            self.close_connection = 1
+            return
+
+        time.sleep(server.delay)
+        body = json.dumps(server.respond(self.path))
+        self.send_response(server.status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        if server.close_after_response:
+            self.close_connection = 1
+
+    def log_message(self, format, *args):
+        pass
+
+class StandInServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, respond=lambda path: {}):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0), Handler)
+        self.respond = respond
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.open_connections = set()
+        self.requests = []
+        # number of requests to drop without responding
+        self.drop = 0
+        self.close_after_response = False
+        # seconds to wait before responding and the status to respond with
+        self.delay = 0
+        self.status = 200
+        self.url = "http://127.0.0.1:{0}/search".format(self.server_address[1])
+
+    def start(self):
+        t = threading.Thread(target=self.serve_forever)
+        t.daemon = True
+        t.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        # end the handlers waiting for more requests on kept-alive connections
+        with self.lock:
+            for conn in self.open_connections:
+                try:
+                    conn.shutdown(socket.SHUT_RD)
+                except socket.error:
+                    pass
+        while self.open_connections:
+            time.sleep(0.01)
+
+class SMTPSinkChannel(smtpd.SMTPChannel):
+    received = False
+    dropping = False
+
+    def push(self, msg):
+        if not self.dropping:
+            smtpd.SMTPChannel.push(self, msg)
+
+    def found_terminator(self):
+        self.received = False
+        self.sink.current_channel = self
+        smtpd.SMTPChannel.found_terminator(self)
+        if self.dropping:
+            self.close()
+        elif self.received and self.sink.close_after_message:
+            self.close_when_done()
+
+class SMTPSink(smtpd.SMTPServer):
+    def __init__(self):
+        smtpd.SMTPServer.__init__(self, ("127.0.0.1", 0), None)
+        self.host, self.port = self.socket.getsockname()
+        self.connections = 0
+        # list of (mailfrom, rcpttos, data) of the messages received
+        self.messages = []
+        # number of messages to drop the connection after, without replying
+        self.drop_after_data = 0
+        self.close_after_message = False
+        self.current_channel = None
+        self._running = False
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            conn, addr = pair
+            self.connections += 1
+            channel = SMTPSinkChannel(self, conn, addr)
+            channel.sink = self
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        channel = self.current_channel
+        channel.received = True
+        self.messages.append((mailfrom, rcpttos, data))
+        if self.drop_after_data > 0:
+            self.drop_after_data -= 1
+            channel.dropping = True
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def _loop(self):
+        while self._running:
+            asyncore.loop(timeout=0.05, count=1)
+
+    def stop(self):
+        self._running = False
+        self._thread.join()
+        for channel in asyncore.socket_map.values():
+            channel.close()
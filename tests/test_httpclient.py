@@ -0,0 +1,64 @@
+import os
+import sys
+import json
+import socket
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "voternet"))
+
+import httpclient
+from standin import StandInServer
+
+class ConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInServer(lambda path: {"path": path}).start()
+        self.pool = httpclient.ConnectionPool(self.server.url, size=2, retries=2, backoff=0)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_get(self):
+        self.assertEquals(json.loads(self.pool.get("/search?voterid=1")), {"path": "/search?voterid=1"})
+
+    def test_reuses_connections(self):
+        for i in range(10):
+            self.pool.get("/search?voterid=%d" % i)
+        self.assertEquals(len(self.server.requests), 10)
+        self.assertEquals(self.server.connections, 1)
+
+    def test_retries_dropped_requests(self):
+        self.server.drop = 2
+        self.assertEquals(json.loads(self.pool.get("/search")), {"path": "/search"})
+        self.assertEquals(len(self.server.requests), 3)
+
+    def test_gives_up_after_retries(self):
+        self.server.drop = 3
+        self.assertRaises(httpclient.RETRY_ERRORS, self.pool.get, "/search")
+        self.assertEquals(len(self.server.requests), 3)
+
+    def test_does_not_retry_sent_requests_unless_idempotent(self):
+        self.server.drop = 1
+        self.assertRaises(httpclient.RETRY_ERRORS, self.pool.get, "/search", idempotent=False)
+        self.assertEquals(len(self.server.requests), 1)
+
+    def test_retries_stale_connections(self):
+        # the server closes every connection the pool keeps alive
+        self.server.close_after_response = True
+        for i in range(3):
+            self.pool.get("/search?voterid=%d" % i, idempotent=False)
+        self.assertEquals(len(self.server.requests), 3)
+        self.assertEquals(self.server.connections, 3)
+
+class ConnectErrorTest(unittest.TestCase):
+    def test_connect_error(self):
+        # find a port that nothing is listening on
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+        sock.close()
+
+        pool = httpclient.ConnectionPool("http://127.0.0.1:%d/" % port, retries=1, backoff=0)
+        self.assertRaises(httpclient.ConnectError, pool.get, "/", idempotent=False)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+"""Tests of sending email batches, using a local SMTP sink.
+"""
+import os
+import sys
+import socket
+import smtplib
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "voternet"))
+
+import web
+import mailer
+from standin import SMTPSink
+
+class StatusRecorder:
+    """Keeps the status of the messages instead of writing them to the database.
+    """
+    def __init__(self):
+        self.statuses = {}
+
+    def add(self, message, status):
+        self.statuses[message.to_address] = status
+
+    def flush(self):
+        pass
+
+def make_batch(n):
+    messages = [web.storage(id=i, name="Person %d" % i, to_address="person%d@example.com" % i) for i in range(n)]
+    return web.storage(
+        id=1,
+        subject="Hello",
+        message="Hello {name}",
+        mark_unsubscribed=lambda: 0,
+        get_messages=lambda status: messages)
+
+class BatchSenderTest(unittest.TestCase):
+    def setUp(self):
+        web.config.from_address = "noreply@example.com"
+        web.config.email_bcc_address = None
+        self.sink = SMTPSink().start()
+
+    def tearDown(self):
+        self.sink.stop()
+
+    def connect(self):
+        return smtplib.SMTP(self.sink.host, self.sink.port)
+
+    def send(self, n, num_connections=1, connect=None):
+        sender = mailer.BatchSender(make_batch(n), num_connections=num_connections, connect=connect or self.connect)
+        sender.status_writer = StatusRecorder()
+        counts = sender.send()
+        return counts, sender.status_writer.statuses
+
+    def get_recipients(self):
+        return sorted(rcpt for mailfrom, rcpttos, data in self.sink.messages for rcpt in rcpttos)
+
+    def test_send(self):
+        counts, statuses = self.send(20, num_connections=4)
+        self.assertEquals(counts, {"sent": 20})
+        self.assertEquals(self.get_recipients(), sorted("person%d@example.com" % i for i in range(20)))
+        self.assertTrue(self.sink.connections <= 4)
+        self.assertTrue("Hello Person 0" in [data for mailfrom, rcpttos, data in self.sink.messages if rcpttos == ["person0@example.com"]][0])
+
+    def test_reconnects_closed_connections(self):
+        # the server closes the connection after every message
+        self.sink.close_after_message = True
+        counts, statuses = self.send(5)
+        self.assertEquals(counts, {"sent": 5})
+        self.assertEquals(len(self.sink.messages), 5)
+        self.assertEquals(self.sink.connections, 5)
+
+    def test_retries_connect(self):
+        attempts = []
+        def connect():
+            attempts.append(1)
+            if len(attempts) == 1:
+                raise socket.error("connection refused")
+            return self.connect()
+
+        counts, statuses = self.send(3, connect=connect)
+        self.assertEquals(counts, {"sent": 3})
+        self.assertEquals(len(attempts), 2)
+
+    def test_does_not_resend_after_data(self):
+        # the server receives the first message and drops the connection
+        # without acknowledging it
+        self.sink.drop_after_data = 1
+        counts, statuses = self.send(3)
+        self.assertEquals(counts, {"sent": 2, "failed": 1})
+        self.assertEquals(statuses["person0@example.com"], "failed")
+        self.assertEquals(self.get_recipients(), ["person0@example.com", "person1@example.com", "person2@example.com"])
+
+if __name__ == "__main__":
+    unittest.main()
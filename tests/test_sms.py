@@ -0,0 +1,157 @@
+"""Tests of sending SMS batches, using a local stand-in for the SMS gateway.
+
+The tests of the sms_log table need a database with the voternet schema.
+They are run only when VOTERNET_TEST_CONFIG is set to the path of a config
+file pointing to such a database.
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "voternet"))
+
+import web
+import sms
+from standin import StandInServer
+
+class MemoryBatch(web.storage):
+    """SMS batch keeping the status of the phones in memory, like sms_log.
+    """
+    def __init__(self, message, phones):
+        web.storage.__init__(self, id=1, message=message, statuses=dict((p, "pending") for p in phones))
+
+    def get_unsent_phones(self):
+        return sorted(p for p, status in self.statuses.items() if status not in ["sent", "unknown"])
+
+    def set_status(self, phones, status, response=None):
+        for p in phones:
+            self.statuses[p] = status
+
+    def get_stats(self):
+        stats = web.storage()
+        for status in self.statuses.values():
+            stats[status] = stats.get(status, 0) + 1
+        stats.total = len(self.statuses)
+        return stats
+
+def get_phones(n):
+    return ["98450%05d" % i for i in range(n)]
+
+class SendBatchTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInServer().start()
+        self.provider = sms.HTTPProvider(self.server.url + "?to={phone_numbers}&msg={message}", timeout=1)
+        self._chunk_size = sms.CHUNK_SIZE
+        sms.CHUNK_SIZE = 10
+
+    def tearDown(self):
+        sms.CHUNK_SIZE = self._chunk_size
+        self.server.stop()
+
+    def test_send_in_parallel(self):
+        batch = MemoryBatch("hello world", get_phones(45))
+        stats = sms.send_batch(batch, provider=self.provider, concurrency=4)
+        self.assertEquals(stats, {"sent": 45, "total": 45})
+        self.assertEquals(len(self.server.requests), 5)
+        self.assertTrue(self.server.connections <= 4)
+        self.assertTrue(all("msg=hello+world" in path for path in self.server.requests))
+
+        # nothing is sent again
+        sms.send_batch(batch, provider=self.provider)
+        self.assertEquals(len(self.server.requests), 5)
+
+    def test_not_sent_is_resent(self):
+        batch = MemoryBatch("hello", get_phones(5))
+        # the gateway can't be reached
+        provider = sms.HTTPProvider("http://127.0.0.1:1/send?to={phone_numbers}&msg={message}", timeout=1)
+        stats = sms.send_batch(batch, provider=provider)
+        self.assertEquals(stats, {"failed": 5, "total": 5})
+
+        stats = sms.send_batch(batch, provider=self.provider)
+        self.assertEquals(stats, {"sent": 5, "total": 5})
+        self.assertEquals(len(self.server.requests), 1)
+
+    def test_rejected_is_resent(self):
+        batch = MemoryBatch("hello", get_phones(5))
+        self.server.status = 400
+        self.assertEquals(sms.send_batch(batch, provider=self.provider), {"failed": 5, "total": 5})
+
+        self.server.status = 200
+        self.assertEquals(sms.send_batch(batch, provider=self.provider), {"sent": 5, "total": 5})
+        self.assertEquals(len(self.server.requests), 2)
+
+    def test_maybe_sent_is_not_resent(self):
+        for misbehave in ["drop", "error", "timeout"]:
+            batch = MemoryBatch("hello", get_phones(5))
+            self.server.requests = []
+            if misbehave == "drop":
+                self.server.drop = 1
+            elif misbehave == "error":
+                self.server.status = 503
+            else:
+                self.server.delay = 2
+
+            stats = sms.send_batch(batch, provider=self.provider)
+            self.server.status, self.server.delay = 200, 0
+            self.assertEquals(stats, {"unknown": 5, "total": 5}, misbehave)
+            self.assertEquals(len(self.server.requests), 1, misbehave)
+
+            sms.send_batch(batch, provider=self.provider)
+            self.assertEquals(len(self.server.requests), 1, misbehave)
+
+class SMSLogTest(unittest.TestCase):
+    def setUp(self):
+        configfile = os.environ.get("VOTERNET_TEST_CONFIG")
+        if not configfile:
+            self.skipTest("VOTERNET_TEST_CONFIG is not set")
+
+        import webapp
+        from models import get_db
+        webapp.load_config(configfile)
+        self.db = get_db()
+        self.batch_ids = []
+        self.server = StandInServer().start()
+        self.provider = sms.HTTPProvider(self.server.url + "?to={phone_numbers}&msg={message}", timeout=1)
+
+    def tearDown(self):
+        self.server.stop()
+        if self.batch_ids:
+            self.db.delete("sms_log", where="batch_id IN $ids", vars={"ids": self.batch_ids})
+            self.db.delete("sms_batch", where="id IN $ids", vars={"ids": self.batch_ids})
+
+    def new_batch(self, phones):
+        from models import SMSBatch
+        batch = SMSBatch.new("hello", phones)
+        self.batch_ids.append(batch.id)
+        return batch
+
+    def get_statuses(self, batch):
+        result = self.db.select("sms_log", where="batch_id=$batch.id", vars=locals())
+        return dict((row.phone, row.status) for row in result)
+
+    def test_sms_log(self):
+        phones = get_phones(5)
+        batch = self.new_batch(phones)
+        self.assertEquals(batch.get_unsent_phones(), phones)
+
+        stats = sms.send_batch(batch, provider=self.provider)
+        self.assertEquals(stats, {"sent": 5, "total": 5})
+        self.assertEquals(self.get_statuses(batch), dict((p, "sent") for p in phones))
+        self.assertEquals(batch.get_unsent_phones(), [])
+
+    def test_unknown_is_not_resumed(self):
+        from models import SMSBatch
+        batch = self.new_batch(get_phones(5))
+        self.server.status = 503
+        self.assertEquals(sms.send_batch(batch, provider=self.provider), {"unknown": 5, "total": 5})
+        self.assertEquals(batch.get_unsent_phones(), [])
+        self.assertTrue(batch.id not in [b.id for b in SMSBatch.find_incomplete()])
+
+        failed = self.new_batch(get_phones(3))
+        self.server.status = 400
+        self.assertEquals(sms.send_batch(failed, provider=self.provider), {"failed": 3, "total": 3})
+        self.assertEquals(failed.get_unsent_phones(), get_phones(3))
+        self.assertTrue(failed.id in [b.id for b in SMSBatch.find_incomplete()])
+
+if __name__ == "__main__":
+    unittest.main()
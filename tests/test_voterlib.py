@@ -0,0 +1,109 @@
+"""Tests of looking up voter details from the voter search service, using a
+local stand-in for the service.
+
+The tests of models.VoterLookup need a database with the voternet schema.
+They are run only when VOTERNET_TEST_CONFIG is set to the path of a config
+file pointing to such a database.
+"""
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "voternet"))
+
+import voterlib
+from standin import StandInServer
+
+def respond(path):
+    voterid = path.split("voterid=")[-1]
+    if voterid.startswith("MISSING"):
+        return {}
+    return {"name": "Name of " + voterid, "ac": 150, "part": 12, "serial": 34}
+
+class FetcherTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StandInServer(respond).start()
+        self.fetcher = voterlib.Fetcher(self.server.url, pool_size=2, retries=2, backoff=0)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_fetch(self):
+        d = self.fetcher.fetch("ABC1234567")
+        self.assertEquals(d.voterid, "ABC1234567")
+        self.assertEquals(d.first_name, "Name of ABC1234567")
+        self.assertEquals(d.ac_num, 150)
+        self.assertEquals(self.server.requests, ["/search?voterid=ABC1234567"])
+
+    def test_fetch_not_found(self):
+        self.assertEquals(self.fetcher.fetch("MISSING1"), None)
+
+    def test_fetch_many_reuses_connections(self):
+        voterids = ["ABC%07d" % i for i in range(20)]
+        result = self.fetcher.fetch_many(voterids)
+        self.assertEquals(sorted(result), voterids)
+        self.assertEquals(len(self.server.requests), 20)
+        self.assertTrue(self.server.connections <= 2)
+
+    def test_retries(self):
+        self.server.drop = 2
+        self.assertEquals(self.fetcher.fetch("ABC1234567").voterid, "ABC1234567")
+        self.assertEquals(len(self.server.requests), 3)
+
+    def test_lookup_error(self):
+        self.server.drop = 3
+        self.assertRaises(voterlib.VoterLookupError, self.fetcher.fetch, "ABC1234567")
+
+class VoterLookupTest(unittest.TestCase):
+    VOTERIDS = ["TEST0000001", "TEST0000002", "MISSING0001", "MISSING0002"]
+
+    def setUp(self):
+        configfile = os.environ.get("VOTERNET_TEST_CONFIG")
+        if not configfile:
+            self.skipTest("VOTERNET_TEST_CONFIG is not set")
+
+        import webapp
+        from models import get_db
+        webapp.load_config(configfile)
+        self.db = get_db()
+        self.db.delete("voterid_lookup", where="voterid IN $voterids", vars={"voterids": self.VOTERIDS})
+
+        self.server = StandInServer(respond).start()
+        fetcher = voterlib.Fetcher(self.server.url, retries=0)
+        self._get_fetcher = voterlib.get_fetcher
+        voterlib.get_fetcher = lambda: fetcher
+
+    def tearDown(self):
+        voterlib.get_fetcher = self._get_fetcher
+        self.server.stop()
+        self.db.delete("voterid_lookup", where="voterid IN $voterids", vars={"voterids": self.VOTERIDS})
+
+    def test_cache_hits_make_no_request(self):
+        from models import VoterLookup
+        d = VoterLookup.get("TEST0000001")
+        self.assertEquals(d.first_name, "Name of TEST0000001")
+        self.assertEquals(VoterLookup.get("MISSING0001"), None)
+        self.assertEquals(len(self.server.requests), 2)
+
+        self.assertEquals(VoterLookup.get("TEST0000001").first_name, "Name of TEST0000001")
+        self.assertEquals(VoterLookup.get("MISSING0001"), None)
+        self.assertEquals(len(self.server.requests), 2)
+
+    def test_get_many_looks_up_only_missing(self):
+        from models import VoterLookup
+        VoterLookup.get("TEST0000001")
+        VoterLookup.get("MISSING0001")
+        self.server.requests = []
+
+        result = VoterLookup.get_many(self.VOTERIDS)
+        self.assertEquals(sorted(result), sorted(self.VOTERIDS))
+        self.assertEquals(result["MISSING0002"], None)
+        self.assertEquals(sorted(self.server.requests), [
+            "/search?voterid=MISSING0002",
+            "/search?voterid=TEST0000002"])
+
+        VoterLookup.get_many(self.VOTERIDS)
+        self.assertEquals(len(self.server.requests), 2)
+
+if __name__ == "__main__":
+    unittest.main()
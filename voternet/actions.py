@@ -1,7 +1,10 @@
 from webapp import check_config
-from models import Place, Invite, get_db
+from models import Place, Person, Invite, PlaceStats, VoterLookup, SMSBatch, add_voterid_info_many
 import utils
+import jobs
+import cachesync
 import sys
+import time
 import web
 import re
 import logging
@@ -20,6 +23,7 @@ def email_fill_voterid(place_key):
         raise ValueError("Invalid place {0}".format(place_key))
 
     agents = [a for a in place.get_pb_agents() if a.email and not a.voterid]
+    agents = utils.filter_unsent(utils.sendmail_voterid_pending, agents)
 
     pool = ThreadPool(20)
     def sendmail(a):
@@ -32,12 +36,12 @@ def email_invites():
             utils.sendmail_voterid_pending(a)
         except Exception:
             logger.error("failed to send email to %s", a)
-    agents = Invite.find_all()    
+    agents = utils.filter_unsent(utils.sendmail_voterid_pending, Invite.find_all())
     pool = ThreadPool(20)    
     pool.map(sendmail, agents)
 
 def add_invites(place_key, filename, batch):
-    from webapp import import_people
+    from importer import PeopleImporter
 
     place = Place.find(place_key)
     if not place:
@@ -45,14 +49,13 @@ def add_invites(place_key, filename, batch):
 
     rows = [line.strip("\n").split("\t") for line in open(filename) if line.strip()]
     re_badchars = re.compile("[^A-Za-z0-9 \.-]+")
-    count = 0
-    with get_db().transaction():
-        for row in rows:
-            name, phone, email = row
-            name = re_badchars.sub("", name).strip()
-            d = web.storage(name=name, phone=phone, email=email, place=None, role=None)
-            if import_people().add_volunteer(d, place, batch=batch, as_invite=True):
-                count += 1
+    data = []
+    for row in rows:
+        name, phone, email = row
+        name = re_badchars.sub("", name).strip()
+        data.append(web.storage(name=name, phone=phone, email=email, place=None, role=None))
+    results = PeopleImporter(place, batch=batch, as_invite=True).import_rows(data)
+    count = len([r for r in results if r['status'] == 'added'])
     logger.info("imported %s people", count)
 
 def email_voterid_added(place_key):
@@ -62,7 +65,8 @@ def email_voterid_added(place_key):
     if not place:
         raise ValueError("Invalid place {0}".format(place_key))
 
-    agents = [a for a in place.get_pb_agents() if a.email and a.get_voterid_info()]    
+    agents = [a for a in Person.prefetch(place.get_pb_agents()) if a.email and a.get_voterid_info()]
+    agents = utils.filter_unsent(utils.sendmail_voterid_added, agents)
     conn = utils.get_smtp_conn()    
     for a in agents:
         utils.sendmail_voterid_added(a, conn=conn)
@@ -102,16 +106,46 @@ def autoadd_pb_agents(place_key):
     _add_pb_agents(place, place.get_all_volunteers())
 
 def update_voterinfo(place_key):
-    """Updtes voter info of all volunteers with voterids whos voter info is not updated yet.
+    """Updtes voter info of all volunteers with voterids whos voter info is not updated yet
+    and moves the agents whose voterid belongs to another PB to that PB.
     """
     place = Place.find(place_key)
     if not place:
         raise ValueError("Invalid place {0}".format(place_key))    
-    for a in place.get_all_volunteers("pb_agent"):
-        a.populate_voterid_info()
-        info = a.get_voterid_info()
-        if info and info.pb_id != a.place_id:
-            a.update(place_id=info.pb_id)
+
+    t0 = time.time()
+    agents = Person.prefetch(place.get_all_volunteers("pb_agent"))
+    voterids = set(a.voterid for a in agents if a.voterid and not a.get_voterid_info())
+    t1 = time.time()
+    logger.info("found %d agents, %d with voterid info pending in %0.2f seconds", len(agents), len(voterids), t1-t0)
+
+    details = VoterLookup.get_many(voterids)
+    found = [d for d in details.values() if d]
+    add_voterid_info_many(found)
+    t2 = time.time()
+    logger.info("looked up %d voterids, found %d in %0.2f seconds", len(voterids), len(found), t2-t1)
+
+    moved = place.reassign_pb_agents()
+    t3 = time.time()
+    logger.info("moved %d agents to the PB of their voterid in %0.2f seconds", len(moved), t3-t2)
+    logger.info("updated voter info of %s in %0.2f seconds", place.key, t3-t0)
+
+def rebuild_place_stats():
+    """Recomputes the place_stats rollup of all places from scratch.
+    """
+    t0 = time.time()
+    PlaceStats.rebuild()
+    logger.info("rebuilt place_stats in %0.2f seconds", time.time()-t0)
+
+def check_place_stats():
+    """Prints the place_stats rows that differ from the counts computed from scratch.
+    """
+    drift = PlaceStats.check()
+    for row in drift:
+        place = Place.from_id(row.place_id)
+        for column, (value, expected) in sorted(row.diff.items()):
+            print "\t".join([place and place.key or str(row.place_id), row.type, column, str(value), str(expected)])
+    logger.info("found %d place_stats rows with drift", len(drift))
 
 def debug(place_key):
     place = Place.find(place_key)
@@ -126,6 +160,34 @@ def setup_logger():
     FORMAT = "%(asctime)s [%(name)s] [%(levelname)s] %(message)s"
     logging.basicConfig(format=FORMAT, level=logging.INFO)
 
+def run_jobs(num_workers=4):
+    """Runs the background jobs using num_workers threads, forever.
+    """
+    logger.info("running jobs with %d workers", num_workers)
+    # jobs modify places, people and roles, and read cached data
+    cachesync.start_listener()
+    jobs.run_workers(num_workers)
+
+def resume_sms():
+    """Sends the SMS batches that were interrupted before sending to all their phones.
+    """
+    import sms
+    for batch in SMSBatch.find_incomplete():
+        stats = sms.send_batch(batch)
+        logger.info("resumed sms batch %s: %s", batch.id, dict(stats))
+
+def job_status():
+    """Prints the number of jobs by name and status, and the recent failures.
+    """
+    status = jobs.get_status()
+    for name, counts in sorted(status['counts'].items()):
+        print name, " ".join("{}={}".format(k, v) for k, v in sorted(counts.items()))
+    if status['oldest_pending_age'] is not None:
+        print "oldest pending job is waiting for %d seconds" % status['oldest_pending_age']
+    for f in status['recent_failures']:
+        print "failed", f['id'], f['name'], f['args'], f['finished']
+        print f['error']
+
 def main():  
     setup_logger()
 
@@ -151,6 +213,16 @@ def main():
         email_invites()
     elif cmdname == 'add_invites':
         add_invites(sys.argv[2], sys.argv[3], sys.argv[4])
+    elif cmdname == 'rebuild_place_stats':
+        rebuild_place_stats()
+    elif cmdname == 'check_place_stats':
+        check_place_stats()
+    elif cmdname == 'resume_sms':
+        resume_sms()
+    elif cmdname == 'job_status':
+        job_status()
+    elif cmdname == 'run_jobs':
+        run_jobs(*[int(n) for n in sys.argv[2:3]])
     elif cmd:
         places = sys.argv[2:]
         for p in places:
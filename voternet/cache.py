@@ -1,10 +1,118 @@
 """Caching utilities"""
 
 import functools
+import threading
+import time
+from collections import OrderedDict
 
-cache = {}
+class LRUCache:
+    """Thread-safe cache with an optional bound on the number of entries
+    and an optional time-to-live for the entries.
 
-OBJ_CACHE = {}
+    When the cache is full, the least recently used entry is evicted.
+    The default ttl can be overridden for each entry when it is added.
+    Keeps count of hits, misses, evictions and expirations.
+    """
+    def __init__(self, maxsize=None, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires = entry
+            if expires is not None and expires < time.time():
+                self.expirations += 1
+                self.misses += 1
+                return default
+            # move to the end to mark it as the most recently used
+            self._data[key] = entry
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl if ttl is not None else self.ttl
+        expires = time.time() + ttl if ttl else None
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expires)
+            while self.maxsize and len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self),
+            "maxsize": self.maxsize,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_rate": lookups and float(self.hits) / lookups
+        }
+
+# A sentinel to find cache misses, as None is a valid value to cache.
+_missing = object()
+
+# All the caches, by name. The memoize decorators take the cache name as backend.
+# Any object with get, set, delete, clear and get_stats methods like LRUCache
+# can be used as a backend.
+backends = {
+    "default": LRUCache(),
+    "objects": LRUCache(),
+}
+
+def get_backend(name):
+    return backends[name]
+
+def configure(name, maxsize=None, ttl=None):
+    """Replaces the named cache with a new one with the given bounds.
+    """
+    backends[name] = LRUCache(maxsize=maxsize, ttl=ttl)
+
+def configure_from_config(config):
+    """Configures the caches from a dict mapping cache name to its settings.
+
+    For example, the following in the config file limits the object cache
+    to 10000 entries, each living for at most an hour.
+
+        cache:
+            objects:
+                maxsize: 10000
+                ttl: 3600
+    """
+    for name, settings in (config or {}).items():
+        configure(name, **settings)
+
+def get_stats():
+    """Returns the stats of all the caches, by name.
+    """
+    return dict((name, backend.get_stats()) for name, backend in backends.items())
 
 def _get_obj_key(obj):
     cls = obj.__class__
@@ -12,36 +120,85 @@ def _get_obj_key(obj):
     key = (mod + "." + cls.__name__, obj.id)
     return key
 
+# (backend, key) pairs used in object_memoize, required to invalidate all the
+# entries of an object
+_object_keys = set()
+
+# Functions called as hook(kind, keys) after cache entries are invalidated.
+# Used to propagate the invalidations to other processes.
+invalidation_hooks = []
+
+def _run_hooks(kind, keys):
+    for hook in invalidation_hooks:
+        hook(kind, keys)
+
 def invalidate_object_cache(objects):
-    for obj in objects:
-        obj_key = _get_obj_key(obj)
-        OBJ_CACHE.pop(obj_key, None)
+    obj_keys = [_get_obj_key(obj) for obj in objects]
+    invalidate_object_keys(obj_keys)
+    _run_hooks("objects", obj_keys)
+
+def invalidate_object_keys(obj_keys):
+    """Invalidates the object cache of objects with the given keys,
+    without running the invalidation hooks.
+    """
+    for obj_key in obj_keys:
+        for backend, key in _object_keys:
+            get_backend(backend).delete((obj_key, key))
 
-def object_memoize(f=None, key=None):
+def object_memoize(f=None, key=None, backend="objects", ttl=None):
     if f is None:
-        return lambda f: object_memoize(f, key=key)
+        return lambda f: object_memoize(f, key=key, backend=backend, ttl=ttl)
+    _object_keys.add((backend, key))
     @functools.wraps(f)
     def g(self):
-        obj_key = _get_obj_key(self)
-        obj_cache = OBJ_CACHE.setdefault(obj_key, {})
-        if key not in obj_cache:
-            obj_cache[key] = f(self)
-        return obj_cache[key]
+        cache = get_backend(backend)
+        cache_key = _get_obj_key(self), key
+        value = cache.get(cache_key, _missing)
+        if value is _missing:
+            value = f(self)
+            cache.set(cache_key, value, ttl=ttl)
+        return value
     return g
 
-def memoize(f=None, key=None):
+def memoize(f=None, key=None, backend="default", ttl=None):
     if f is None:
-        return lambda f: memoize(f, key=key)
+        return lambda f: memoize(f, key=key, backend=backend, ttl=ttl)
     if key is None:
         key = f.__name__
     @functools.wraps(f)
     def g(*args, **kwargs):
+        cache = get_backend(backend)
         cache_key = key, args, tuple(sorted(kwargs.items()))
-        if cache_key not in cache:
-            cache[cache_key] = f(*args, **kwargs)
-        return cache[cache_key]
+        value = cache.get(cache_key, _missing)
+        if value is _missing:
+            value = f(*args, **kwargs)
+            cache.set(cache_key, value, ttl=ttl)
+        return value
     return g
 
 def invalidate_cache(_key, *args, **kwargs):
+    backend = kwargs.pop("_backend", "default")
     cache_key = _key, args, tuple(sorted(kwargs.items()))
-    cache.pop(cache_key, None)
+    invalidate_cache_keys(backend, [cache_key])
+    _run_hooks("memoize", [(backend, cache_key)])
+
+def invalidate_cache_many(_key, args_list, _backend="default"):
+    """Invalidates the entries of a memoize cache for each of the given
+    tuples of arguments, publishing them to the other processes together.
+    """
+    cache_keys = [(_key, tuple(args), ()) for args in args_list]
+    invalidate_cache_keys(_backend, cache_keys)
+    _run_hooks("memoize", [(_backend, cache_key) for cache_key in cache_keys])
+
+def invalidate_cache_keys(backend, cache_keys):
+    """Invalidates the given keys of a memoize cache, without running the
+    invalidation hooks.
+    """
+    for cache_key in cache_keys:
+        get_backend(backend).delete(cache_key)
+
+def clear_all():
+    """Removes all the entries from all the caches.
+    """
+    for backend in backends.values():
+        backend.clear()
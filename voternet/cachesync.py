@@ -0,0 +1,164 @@
+"""Propagates cache invalidations across processes using Postgres LISTEN/NOTIFY.
+
+Every process caches places and counts in memory (see cache.py and
+models.PlaceTree). When a process invalidates its cache after a write, the
+invalidated keys are published on a notification channel and every other
+process listening on that channel applies the same invalidation to its
+local cache.
+
+Notifications sent inside a transaction are delivered only when the
+transaction is committed, so other processes never see invalidations of
+changes that are rolled back.
+
+Set cache_sync to false in the config file to disable this.
+"""
+import web
+import os
+import json
+import time
+import socket
+import select
+import logging
+import threading
+
+import cache
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "voternet_cache"
+
+# Postgres limits the payload of a notification to 8000 bytes.
+# Keys are published in chunks to stay well within that limit.
+CHUNK_SIZE = 50
+
+# kind -> function to apply the invalidation of keys of that kind
+handlers = {}
+
+def is_enabled():
+    return web.config.get("cache_sync", True)
+
+def get_origin():
+    """Returns an identifier of this process, used to ignore the notifications
+    published by this process.
+    """
+    return "{0}:{1}".format(socket.gethostname(), os.getpid())
+
+def register_handler(kind, handler):
+    """Registers a function to apply invalidations of the given kind.
+
+    The handler is called with the list of keys from the notification. The
+    handler registered for kind "reset" is called without any arguments when
+    notifications might have been missed.
+    """
+    handlers[kind] = handler
+
+def publish(kind, keys):
+    """Publishes the invalidation of the given keys to all other processes.
+    """
+    if not is_enabled() or not keys:
+        return
+
+    from models import get_db
+    db = get_db()
+    origin = get_origin()
+    for chunk in web.group(keys, CHUNK_SIZE):
+        payload = json.dumps({"origin": origin, "kind": kind, "keys": chunk})
+        db.query("SELECT pg_notify($CHANNEL, $payload)", vars={"CHANNEL": CHANNEL, "payload": payload})
+
+def publish_reset():
+    """Asks all other processes to clear all their caches and reload the
+    place tree, after changes too large to publish key by key.
+    """
+    if not is_enabled():
+        return
+
+    from models import get_db
+    payload = json.dumps({"origin": get_origin(), "kind": "reset", "keys": []})
+    get_db().query("SELECT pg_notify($CHANNEL, $payload)", vars={"CHANNEL": CHANNEL, "payload": payload})
+
+def apply(payload):
+    """Applies the invalidation in the payload of a notification.
+    """
+    d = json.loads(payload)
+    if d.get("origin") == get_origin():
+        return
+    handler = handlers.get(d['kind'])
+    if handler and d['kind'] == "reset":
+        handler()
+    elif handler:
+        handler([_tuplify(key) for key in d['keys']])
+    else:
+        logger.warn("ignoring cache invalidation of unknown kind %r", d['kind'])
+
+def _tuplify(value):
+    """Converts the lists in a json-decoded value back to tuples.
+
+    Cache keys are tuples, but they become lists when encoded as json.
+    """
+    if isinstance(value, list):
+        return tuple(_tuplify(v) for v in value)
+    else:
+        return value
+
+def _reset():
+    cache.clear_all()
+
+register_handler("objects", cache.invalidate_object_keys)
+register_handler("memoize", lambda keys: [cache.invalidate_cache_keys(backend, [key]) for backend, key in keys])
+register_handler("reset", _reset)
+
+cache.invalidation_hooks.append(publish)
+
+class Listener(threading.Thread):
+    """Thread that listens for invalidations published by other processes
+    and applies them to the caches of this process.
+    """
+    def __init__(self, timeout=60, retry_interval=5):
+        threading.Thread.__init__(self, name="cachesync")
+        self.daemon = True
+        self.timeout = timeout
+        self.retry_interval = retry_interval
+
+    def run(self):
+        while True:
+            try:
+                self.listen()
+            except Exception:
+                logger.error("cache invalidation listener failed. reconnecting...", exc_info=True)
+                time.sleep(self.retry_interval)
+
+    def listen(self):
+        import psycopg2
+        import psycopg2.extensions
+        from models import get_connection_params
+
+        conn = psycopg2.connect(**get_connection_params())
+        try:
+            conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            conn.cursor().execute("LISTEN " + CHANNEL)
+            logger.info("listening for cache invalidations on channel %s", CHANNEL)
+
+            # Invalidations published while we were not listening are lost.
+            handlers["reset"]()
+
+            while True:
+                if select.select([conn], [], [], self.timeout) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    notify = conn.notifies.pop(0)
+                    try:
+                        apply(notify.payload)
+                    except Exception:
+                        logger.error("failed to apply cache invalidation %r", notify.payload, exc_info=True)
+        finally:
+            conn.close()
+
+@web.memoize
+def start_listener():
+    """Starts the listener thread, if it is not started already.
+    """
+    if is_enabled():
+        listener = Listener()
+        listener.start()
+        return listener
@@ -0,0 +1,105 @@
+"""Streaming exports of tabular data as CSV or XLSX.
+
+The rows are written out incrementally as they are read from the database,
+so exporting the volunteers of a whole state takes bounded memory.
+"""
+import web
+import csv
+import datetime
+import tempfile
+import logging
+from cStringIO import StringIO
+
+try:
+    import xlsxwriter
+except ImportError:
+    xlsxwriter = None
+    print "WARNING: unable to import xlsxwriter, exports will be in CSV format."
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPES = {
+    "csv": "text/csv; charset=utf-8",
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+}
+
+# number of rows written to the response at once
+CHUNK_SIZE = 500
+
+def _to_str(value):
+    if value is None:
+        return ""
+    elif isinstance(value, unicode):
+        return value.encode("utf-8")
+    elif isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    else:
+        return str(value)
+
+def _to_cell(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    else:
+        return value
+
+def write_csv(headers, rows):
+    """Generates the CSV of the rows, in chunks.
+    """
+    buf = StringIO()
+    writer = csv.writer(buf)
+    writer.writerow([_to_str(h) for h in headers])
+    for i, row in enumerate(rows, 1):
+        writer.writerow([_to_str(v) for v in row])
+        if i % CHUNK_SIZE == 0:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
+
+def write_xlsx(headers, rows, chunk_size=65536):
+    """Generates the XLSX file of the rows, in chunks.
+
+    An XLSX file is a zip archive and it can only be sent after all the rows
+    are written. The rows are flushed to a temporary file as they are written
+    and the file is sent once it is complete.
+    """
+    with tempfile.TemporaryFile() as f:
+        workbook = xlsxwriter.Workbook(f, {"constant_memory": True})
+        sheet = workbook.add_worksheet()
+        sheet.write_row(0, 0, headers, workbook.add_format({"bold": True}))
+        for i, row in enumerate(rows, 1):
+            sheet.write_row(i, 0, [_to_cell(v) for v in row])
+        workbook.close()
+
+        f.seek(0)
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            yield data
+
+def get_format(format):
+    """Returns the export format to use for the requested format.
+
+    The old .xls downloads are served as XLSX. CSV is used for XLSX when
+    xlsxwriter is not installed.
+    """
+    if format == "csv" or xlsxwriter is None:
+        return "csv"
+    else:
+        return "xlsx"
+
+def export(filename, format, headers, rows):
+    """Sets the headers of the response for downloading the rows as a file
+    and returns a generator of the file contents.
+
+    The extension of the file is added to the filename.
+    """
+    format = get_format(format)
+    web.header("Content-Type", CONTENT_TYPES[format])
+    web.header("Content-disposition", "attachment; filename=%s.%s" % (filename, format))
+    logger.info("exporting %s.%s", filename, format)
+    if format == "csv":
+        return write_csv(headers, rows)
+    else:
+        return write_xlsx(headers, rows)
@@ -0,0 +1,120 @@
+"""HTTP client with a pool of keep-alive connections and retries.
+
+Used to talk to the external services, like the voter search service and
+the SMS gateway.
+"""
+import time
+import socket
+import httplib
+import urlparse
+import logging
+import threading
+import Queue
+
+logger = logging.getLogger(__name__)
+
+class HTTPError(Exception):
+    def __init__(self, status, reason, body=""):
+        Exception.__init__(self, "{0} {1}".format(status, reason))
+        self.status = status
+        self.reason = reason
+        self.body = body
+
+class ConnectError(IOError):
+    """The request failed before it was sent to the server, either because the
+    connection could not be made or because the kept-alive connection was
+    closed by the server. It is always safe to retry such a request.
+    """
+    pass
+
+# errors on which an idempotent request is retried
+RETRY_ERRORS = (IOError, httplib.HTTPException, HTTPError)
+
+class ConnectionPool:
+    """Pool of keep-alive connections to the host of the given url.
+
+    At most size requests are made at the same time, the other threads wait
+    for a connection to be free. Failed requests are retried with exponential
+    backoff.
+    """
+    def __init__(self, url, size=4, timeout=10, retries=3, backoff=0.5):
+        u = urlparse.urlsplit(url)
+        self.connection_class = httplib.HTTPSConnection if u.scheme == "https" else httplib.HTTPConnection
+        self.netloc = u.netloc
+        self.size = size
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+
+        # idle connections
+        self._connections = Queue.Queue()
+        self._semaphore = threading.BoundedSemaphore(size)
+
+    def _get_connection(self):
+        """Returns an idle connection, or a new one, and whether it is reused.
+        """
+        try:
+            return self._connections.get_nowait(), True
+        except Queue.Empty:
+            return self.connection_class(self.netloc, timeout=self.timeout), False
+
+    def _request(self, method, path, body=None, headers=None):
+        headers = dict(headers or {}, Connection="keep-alive")
+        with self._semaphore:
+            conn, reused = self._get_connection()
+            try:
+                if conn.sock is None:
+                    try:
+                        conn.connect()
+                    except socket.error, e:
+                        raise ConnectError("failed to connect to {0}: {1}".format(self.netloc, e))
+                try:
+                    conn.request(method, path, body, headers)
+                    response = conn.getresponse()
+                except (socket.error, httplib.BadStatusLine), e:
+                    # A kept-alive connection closed by the server fails on
+                    # sending or gets no response at all.
+                    if reused and not isinstance(e, socket.timeout):
+                        raise ConnectError("stale connection to {0}: {1}".format(self.netloc, e))
+                    raise
+                data = response.read()
+            except Exception:
+                conn.close()
+                raise
+            self._connections.put(conn)
+        if response.status != 200:
+            raise HTTPError(response.status, response.reason, data)
+        return data
+
+    def request(self, method, path, body=None, headers=None, idempotent=True):
+        """Makes a request and returns the body of the response.
+
+        Idempotent requests are retried on any error. The others are only
+        retried when they failed before being sent, as the server may have
+        acted on the request even if it failed later.
+
+        Raises ConnectError if the request could not be sent, HTTPError if
+        the response status is not 200 and IOError or httplib.HTTPException
+        if the request fails otherwise, after retrying.
+        """
+        retry_errors = RETRY_ERRORS if idempotent else (ConnectError,)
+        for attempt in range(self.retries + 1):
+            try:
+                return self._request(method, path, body, headers)
+            except retry_errors, e:
+                if attempt == self.retries:
+                    raise
+                logger.warn("%s %s%s failed: %s. retrying...", method, self.netloc, path, e)
+                time.sleep(self.backoff * 2 ** attempt)
+
+    def get(self, path, headers=None, idempotent=True):
+        return self.request("GET", path, headers=headers, idempotent=idempotent)
+
+def get_path(url):
+    """Returns the path of the url including the query string.
+    """
+    u = urlparse.urlsplit(url)
+    path = u.path or "/"
+    if u.query:
+        path += "?" + u.query
+    return path
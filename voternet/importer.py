@@ -0,0 +1,181 @@
+"""Bulk import of people and invites from the rows of a spreadsheet.
+
+All the rows of an import are checked up front. The place of every row is
+resolved from the place tree, and the existing people and invites that the
+rows could duplicate are found with a single query each. The new people,
+invites and activities are then written with multi-row inserts in one
+transaction.
+
+A person is a duplicate if there is already a person with the same role and
+the same email or phone number at the same place. An invite is a duplicate if
+it would be a duplicate person or if there is already an invite with the same
+email. The rows of the import are checked against each other in the same way.
+"""
+import web
+import logging
+
+import jobs
+from models import Place, PlaceStats, Activity, ACL, get_db
+
+logger = logging.getLogger(__name__)
+
+class PeopleImporter:
+    """Imports rows with name, phone, email, voterid, role and place into the
+    given place.
+
+    The place of a row is the name of a sub place of the given place, of which
+    only the part before the "-" is used. The row is added to the given place
+    when it has no place.
+    """
+    def __init__(self, place, batch=None, as_invite=False):
+        self.place = place
+        self.batch = batch
+        self.as_invite = as_invite
+
+    def import_rows(self, rows):
+        """Imports the rows and returns the outcome of every row as a dict with
+        the index of the row, the status, which is "added" or "skipped", and
+        the reason for skipping the row.
+        """
+        results = [None] * len(rows)
+        pending = []
+        for i, row in enumerate(rows):
+            place, reason = self._check_row(row)
+            if reason:
+                results[i] = self._skip(i, row, reason)
+            else:
+                pending.append((i, row, place))
+
+        pending = self._dedupe_people(pending, results)
+        if self.as_invite:
+            pending = self._dedupe_invites(pending, results)
+
+        with get_db().transaction():
+            if self.as_invite:
+                self._add_invites(pending)
+            else:
+                self._add_people(pending)
+
+        for i, row, place in pending:
+            results[i] = {"row": i, "status": "added"}
+        if pending and not self.as_invite:
+            self._after_add_people(pending)
+        logger.info("imported %d of %d rows into %s", len(pending), len(rows), self.place.key)
+        return results
+
+    def _skip(self, i, row, reason):
+        logger.warn("%s. Ignoring this %s", reason, row)
+        return {"row": i, "status": "skipped", "reason": reason}
+
+    def _check_row(self, row):
+        """Returns the place to add the row to and the reason for skipping the
+        row, if it has to be skipped.
+        """
+        if not row.name:
+            return None, "No name specified"
+        if row.place:
+            key = self.place.key + "/" + row.place.split("-")[0].strip()
+            place = Place.find(key)
+            if not place:
+                return None, "Unknown place {0}".format(row.place)
+        else:
+            place = self.place
+        if not row.email and not row.phone:
+            return None, "No email/phone number specified"
+        if self.as_invite and not row.email:
+            return None, "Can't add invite as no email provided"
+        return place, None
+
+    def _dedupe_people(self, pending, results):
+        """Skips the rows matching an existing person or an earlier row.
+        """
+        place_ids = list(set(place.id for i, row, place in pending))
+        if not place_ids:
+            return []
+        result = get_db().query(
+            "SELECT place_id, role, lower(email) as email, phone FROM people" +
+            " WHERE place_id IN $place_ids", vars=locals())
+        emails = set()
+        phones = set()
+        for p in result:
+            if p.email:
+                emails.add((p.place_id, p.role, p.email))
+            if p.phone:
+                phones.add((p.place_id, p.role, p.phone))
+
+        rows = []
+        for i, row, place in pending:
+            email = row.email and (place.id, row.role, row.email.lower())
+            phone = row.phone and (place.id, row.role, row.phone)
+            if email and email in emails:
+                results[i] = self._skip(i, row, "Already found a vol with same email and role")
+            elif phone and phone in phones:
+                results[i] = self._skip(i, row, "Already found a vol with same phone number and role")
+            else:
+                emails.add(email)
+                phones.add(phone)
+                rows.append((i, row, place))
+        return rows
+
+    def _dedupe_invites(self, pending, results):
+        """Skips the rows matching an existing invite or an earlier row.
+        """
+        emails = list(set(row.email for i, row, place in pending))
+        if not emails:
+            return []
+        result = get_db().query("SELECT email FROM invite WHERE email IN $emails", vars=locals())
+        emails = set(row.email for row in result)
+
+        rows = []
+        for i, row, place in pending:
+            if row.email in emails:
+                results[i] = self._skip(i, row, "Already found an invite with the same email")
+            else:
+                emails.add(row.email)
+                rows.append((i, row, place))
+        return rows
+
+    def _add_invites(self, pending):
+        values = [dict(place_id=place.id, name=row.name, email=row.email, phone=row.phone, batch=self.batch)
+                  for i, row, place in pending]
+        if values:
+            get_db().multiple_insert("invite", values, seqname=False)
+
+    def _add_people(self, pending):
+        """Adds the people and records an activity for each of them.
+
+        The ids of the new people are added to the rows as person_id. The ids
+        are taken from the sequence before inserting, as the order of the rows
+        returned by a multi-row INSERT ... RETURNING is not guaranteed.
+        """
+        if not pending:
+            return
+        db = get_db()
+        n = len(pending)
+        result = db.query("SELECT nextval('people_id_seq') as id FROM generate_series(1, $n)", vars=locals())
+        for (i, row, place), r in zip(pending, result):
+            row.person_id = r.id
+
+        batch = self.batch
+        values = [web.reparam("($row.person_id, $place.id, $row.name, $row.email, $row.phone, $row.voterid, $row.role, $batch)", locals())
+                  for i, row, place in pending]
+        db.query(
+            "INSERT INTO people (id, place_id, name, email, phone, voterid, role, notes) VALUES " +
+            web.SQLQuery.join(values, ", "))
+
+        Activity.record_many("volunteer-added", [
+            dict(place_id=place.id, volunteer_id=row.person_id, name=row.name, role=row.role)
+            for i, row, place in pending])
+
+    def _after_add_people(self, pending):
+        """Updates the stats and caches of the places of the new people and
+        looks up their voterids in the background.
+        """
+        place_ids = list(set(place.id for i, row, place in pending))
+        PlaceStats.update_places(place_ids)
+        Place.invalidate_object_caches(place_ids)
+        for email in set(row.email.lower() for i, row, place in pending if row.email):
+            ACL.invalidate(email)
+        jobs.enqueue_many("voterid-info", [
+            ("voterid-info/%d" % row.person_id, {"person_id": row.person_id, "notify": False})
+            for i, row, place in pending if row.voterid])
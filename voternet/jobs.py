@@ -0,0 +1,319 @@
+"""Durable queue of background jobs.
+
+Slow work, like looking up the voter details from the voter search service,
+is added to the jobs table instead of being done in the web request. Worker
+processes take the pending jobs from the table and run them.
+
+    python voternet/actions.py --config config.yml run_jobs [num_workers]
+
+Jobs are claimed using SELECT ... FOR UPDATE SKIP LOCKED, so any number of
+workers can run in parallel without picking the same job. Jobs with higher
+priority are run first. A failed job is retried with exponential backoff
+till it has been attempted max_attempts times. If a pending job with the same
+key was added in the meantime, the failed job is merged into it instead, as
+the pending job does the same work with the latest arguments.
+
+While a job is running, its worker updates the heartbeat of the job every
+HEARTBEAT_INTERVAL seconds. A running job whose heartbeat is older than
+STALE_TIMEOUT, because its worker died, is retried too. Every worker looks
+for such jobs every STALE_TIMEOUT/2 seconds, even while the queue is busy. A
+worker only marks a job as done or failed if it still owns it, that is, if
+the job is still running the same attempt.
+
+The number of jobs in each state is available from the job_status command
+and at /debug/jobs.
+"""
+import web
+import json
+import time
+import logging
+import threading
+import traceback
+import psycopg2
+
+logger = logging.getLogger(__name__)
+
+# delay in seconds before the first retry of a failed job, doubled for every retry
+BACKOFF = 30
+
+# interval in seconds at which a running job updates its heartbeat
+HEARTBEAT_INTERVAL = 60
+
+# time in seconds without a heartbeat after which a running job is considered abandoned
+STALE_TIMEOUT = 300
+
+# job name -> function to run the jobs with that name
+handlers = {}
+
+def register(name):
+    """Decorator to register a function to run the jobs with the given name.
+
+    The function is called with the keyword arguments passed to enqueue.
+    """
+    def decorator(f):
+        handlers[name] = f
+        return f
+    return decorator
+
+class Job(web.storage):
+    def get_args(self):
+        return json.loads(self.args)
+
+    def run(self):
+        """Runs the job and marks it as done or failed.
+        """
+        handler = handlers.get(self.name)
+        heartbeat = Heartbeat(self)
+        heartbeat.start()
+        try:
+            if handler is None:
+                raise ValueError("No handler registered for job {0}".format(self.name))
+            handler(**self.get_args())
+        except Exception:
+            logger.error("job %s %s failed (attempt %d of %d)", self.id, self.name, self.attempts, self.max_attempts, exc_info=True)
+            heartbeat.stop()
+            self._fail(traceback.format_exc())
+        else:
+            heartbeat.stop()
+            self._finish()
+
+    def beat(self):
+        """Updates the heartbeat of the job. Returns False if the job is not
+        owned by this attempt anymore.
+        """
+        from models import get_db
+        updated = get_db().query(
+            "UPDATE jobs SET heartbeat=(current_timestamp at time zone 'UTC')" +
+            " WHERE id=$self.id" + _OWNED, vars=locals())
+        return bool(updated)
+
+    def _finish(self):
+        from models import get_db
+        updated = get_db().query(
+            "UPDATE jobs SET status='done', finished=(current_timestamp at time zone 'UTC')" +
+            " WHERE id=$self.id" + _OWNED, vars=locals())
+        if not updated:
+            logger.warn("job %s %s finished after it was requeued (attempt %d)", self.id, self.name, self.attempts)
+        self.status = "done"
+
+    def _fail(self, error):
+        if not self._retry_or_fail(error):
+            logger.warn("job %s %s failed after it was requeued (attempt %d)", self.id, self.name, self.attempts)
+
+    def _retry_or_fail(self, error):
+        """Marks the job, if this attempt still owns it, to be retried, merged
+        or failed. Returns False if the job is not owned by this attempt.
+        """
+        from models import get_db
+        db = get_db()
+        for attempt in range(2):
+            try:
+                with db.transaction():
+                    result = db.query(
+                        "UPDATE jobs SET error=$error," + _RETRY_OR_FAIL +
+                        " WHERE id=$self.id" + _OWNED +
+                        " RETURNING status, key, args",
+                        vars={"self": self, "error": error, "backoff": BACKOFF}).list()
+                    if result and result[0].status == "merged":
+                        # the flags set on this job, like notify, must not be lost
+                        job = result[0]
+                        db.query(
+                            "UPDATE jobs SET args=" + _merge_args("args", "$job.args") +
+                            " WHERE key=$job.key AND status='pending'", vars=locals())
+                    return bool(result)
+            except psycopg2.IntegrityError:
+                # A pending job with the same key was added while updating.
+                # It is seen by the query now and this job is merged into it.
+                if attempt:
+                    raise
+
+    def __repr__(self):
+        return "<Job: %s>" % dict(self)
+
+# SQL condition matching a job only while it is running the attempt of self
+_OWNED = " AND status='running' AND attempts=$self.attempts"
+
+class Heartbeat(threading.Thread):
+    """Thread that updates the heartbeat of a running job till it is stopped.
+    """
+    def __init__(self, job, interval=HEARTBEAT_INTERVAL):
+        threading.Thread.__init__(self, name="heartbeat-%s" % job.id)
+        self.daemon = True
+        self.job = job
+        self.interval = interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                if not self.job.beat():
+                    logger.warn("job %s %s was requeued while running (attempt %d)", self.job.id, self.job.name, self.job.attempts)
+                    return
+            except Exception:
+                logger.error("failed to update the heartbeat of job %s", self.job.id, exc_info=True)
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+# SQL to set the status of a job that failed or was abandoned. The job is
+# retried after a backoff unless it has used all its attempts. If there is
+# already a pending job with the same key, which has the latest arguments,
+# the job is marked as merged instead and the pending job runs in its place.
+_RETRY_OR_FAIL = (
+    " status=(CASE" +
+    "   WHEN attempts >= max_attempts THEN 'failed'" +
+    "   WHEN key IS NOT NULL AND EXISTS (SELECT 1 FROM jobs p WHERE p.key=jobs.key AND p.status='pending') THEN 'merged'" +
+    "   ELSE 'pending' END)," +
+    " run_at=(current_timestamp at time zone 'UTC') + $backoff * power(2, attempts-1) * interval '1 second'," +
+    " finished=(current_timestamp at time zone 'UTC')")
+
+def _merge_args(args, previous_args):
+    """Returns the SQL expression for the args of a job replacing a pending
+    job with previous_args. The flags that are true in previous_args stay
+    true, so that asking to notify someone, for example, is not undone by a
+    later request for the same job without notifying.
+    """
+    return (
+        "((" + args + ")::jsonb || coalesce(" +
+        "(SELECT jsonb_object_agg(f.key, true) FROM jsonb_each((" + previous_args + ")::jsonb) f" +
+        " WHERE f.value = 'true'::jsonb), '{}'::jsonb))::text")
+
+def enqueue(name, key=None, priority=0, max_attempts=3, **kwargs):
+    """Adds a job to the queue and returns its id.
+
+    The keyword arguments are passed to the function registered for the job.
+    Jobs with higher priority are run before the others.
+
+    If key is given and there is already a pending job with the same key,
+    the arguments of that job are replaced instead of adding a new job,
+    except for the flags that are true in that job, which stay true.
+    """
+    from models import get_db
+    args = json.dumps(kwargs)
+    result = get_db().query(
+        "INSERT INTO jobs (name, key, args, priority, max_attempts)" +
+        " VALUES ($name, $key, $args, $priority, $max_attempts)" +
+        " ON CONFLICT (key) WHERE status='pending' DO UPDATE SET args=" + _merge_args("excluded.args", "jobs.args") +
+        " RETURNING id", vars=locals())
+    return result[0].id
+
+def enqueue_many(name, jobs, priority=0, max_attempts=3):
+    """Adds many jobs with the same name to the queue using a single query.
+
+    The jobs are given as a list of (key, kwargs) pairs. Like enqueue, the
+    arguments of an existing pending job with the same key are replaced,
+    except for the flags that are true in that job.
+    """
+    from models import get_db
+    # a key can't be used twice in a single INSERT ... ON CONFLICT
+    jobs = dict((key, json.dumps(kwargs)) for key, kwargs in jobs)
+    if not jobs:
+        return
+    values = [web.reparam("($name, $key, $args, $priority, $max_attempts)", locals()) for key, args in jobs.items()]
+    get_db().query(
+        "INSERT INTO jobs (name, key, args, priority, max_attempts) VALUES " +
+        web.SQLQuery.join(values, ", ") +
+        " ON CONFLICT (key) WHERE status='pending' DO UPDATE SET args=" + _merge_args("excluded.args", "jobs.args"))
+
+def claim():
+    """Marks the next job to run as running and returns it.
+
+    Returns None when there are no pending jobs that are due.
+    """
+    from models import get_db
+    result = get_db().query(
+        "UPDATE jobs SET status='running', attempts=attempts+1," +
+        " started=(current_timestamp at time zone 'UTC'), heartbeat=(current_timestamp at time zone 'UTC')" +
+        " WHERE id = (" +
+        "   SELECT id FROM jobs" +
+        "   WHERE status='pending' AND run_at <= (current_timestamp at time zone 'UTC')" +
+        "   ORDER BY priority DESC, id LIMIT 1 FOR UPDATE SKIP LOCKED)" +
+        " RETURNING *").list()
+    return result and Job(result[0]) or None
+
+def requeue_stale(timeout=STALE_TIMEOUT):
+    """Retries or fails the running jobs without a heartbeat for timeout seconds.
+
+    Returns the number of such jobs. The jobs are updated one at a time, as
+    two of them may have the same key and only one of them can be pending.
+    """
+    from models import get_db
+    result = get_db().query(
+        "SELECT * FROM jobs WHERE status='running'" +
+        "   AND heartbeat < (current_timestamp at time zone 'UTC') - $timeout * interval '1 second'",
+        vars=locals())
+    return len([job for job in result.list() if Job(job)._retry_or_fail("abandoned by the worker")])
+
+def get_status():
+    """Returns the number of jobs by name and status, the age in seconds of
+    the oldest due job and the most recent failures.
+    """
+    from models import get_db
+    db = get_db()
+    counts = {}
+    for row in db.query("SELECT name, status, count(*) as count FROM jobs GROUP BY name, status"):
+        counts.setdefault(row.name, {})[row.status] = row.count
+    result = db.query(
+        "SELECT extract(epoch from (current_timestamp at time zone 'UTC') - min(run_at)) as age" +
+        " FROM jobs WHERE status='pending' AND run_at <= (current_timestamp at time zone 'UTC')")
+    age = result[0].age
+    failures = db.query(
+        "SELECT id, name, args, attempts, finished, error FROM jobs" +
+        " WHERE status='failed' ORDER BY finished DESC LIMIT 10").list()
+    return {
+        "counts": counts,
+        "oldest_pending_age": age and float(age),
+        "recent_failures": [dict(f, finished=f.finished and f.finished.isoformat()) for f in failures]
+    }
+
+def run_pending():
+    """Runs all the pending jobs, one after another. Returns the number of
+    jobs run.
+    """
+    count = 0
+    job = claim()
+    while job:
+        job.run()
+        count += 1
+        job = claim()
+    return count
+
+class Worker(threading.Thread):
+    """Thread that keeps running the pending jobs and requeues the abandoned
+    ones every requeue_interval seconds.
+    """
+    def __init__(self, name, poll_interval=1, requeue_interval=STALE_TIMEOUT/2):
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.poll_interval = poll_interval
+        self.requeue_interval = requeue_interval
+
+    def run(self):
+        logger.info("%s started", self.name)
+        next_requeue = time.time()
+        while True:
+            try:
+                if time.time() >= next_requeue:
+                    next_requeue = time.time() + self.requeue_interval
+                    if requeue_stale():
+                        logger.warn("%s requeued abandoned jobs", self.name)
+                job = claim()
+                if job:
+                    job.run()
+                else:
+                    time.sleep(self.poll_interval)
+            except Exception:
+                logger.error("%s failed to run jobs", self.name, exc_info=True)
+                time.sleep(self.poll_interval)
+
+def run_workers(num_workers=4, poll_interval=1):
+    """Runs the jobs using num_workers threads, forever.
+    """
+    workers = [Worker("worker-%d" % i, poll_interval=poll_interval) for i in range(num_workers)]
+    for w in workers:
+        w.start()
+    # join with a timeout to stay responsive to KeyboardInterrupt
+    while any(w.is_alive() for w in workers):
+        for w in workers:
+            w.join(1)
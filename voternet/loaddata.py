@@ -11,125 +11,194 @@ USAGE:
     * The second argument is the state code
     * The third argument is the state name
 
+Pass --dry-run to see what would be added or changed, without changing the database.
+
+The rows of each file are copied to a temporary table using COPY and added to
+the places table with a single INSERT ... ON CONFLICT (key), which resolves
+the parents using joins. Places that are already loaded are only updated when
+their name has changed, so loading the same files again is safe.
+
 This script is also used to add the first admin user.
 
     python voternet/loaddata.py --add-admin your.email@gmail.com
 """
-
-from models import get_db, Place
+from models import get_db, Place, PlaceStats
+import cachesync
+from cStringIO import StringIO
+import contextlib
+import time
 import web
 import csv
 
 # will be initialized in main()
 db = None
 
-@web.memoize
-def get_pc(state_id, code):
-    return db.select("places", where="type='PC' AND state_id=$state_id AND code=$code", vars=locals())[0]
+# when True, the changes are printed, but not saved
+dry_run = False
+
+@contextlib.contextmanager
+def timed(label):
+    t0 = time.time()
+    yield
+    print "{0}: {1:0.2f} seconds".format(label, time.time() - t0)
+
+def _copy_value(value):
+    """Formats the value for COPY in text format.
+    """
+    if value is None:
+        return "\\N"
+    value = web.safestr(value)
+    return value.replace("\\", "\\\\").replace("\t", "\\t").replace("\n", "\\n").replace("\r", "\\r")
+
+def stage_places(rows):
+    """Copies the rows of (key, name, type, code, parent_key) to the
+    staging_places table, replacing the rows added earlier.
+    """
+    db.query(
+        "CREATE TEMP TABLE IF NOT EXISTS staging_places" +
+        " (key text, name text, type text, code text, parent_key text)" +
+        " ON COMMIT DROP")
+    db.query("TRUNCATE staging_places")
+    buf = StringIO()
+    for row in rows:
+        buf.write("\t".join(_copy_value(v) for v in row) + "\n")
+    buf.seek(0)
+    db._db_cursor().copy_from(buf, "staging_places", columns=("key", "name", "type", "code", "parent_key"))
+
+def print_diff(label):
+    """Prints the number of staged places that are new, changed or unchanged
+    and the places that are skipped as their parent is not found.
+    """
+    result = db.query(
+        "SELECT" +
+        "   count(*) FILTER (WHERE parent.id IS NULL) as missing_parent," +
+        "   count(*) FILTER (WHERE parent.id IS NOT NULL AND p.id IS NULL) as new," +
+        "   count(*) FILTER (WHERE p.id IS NOT NULL AND p.name IS DISTINCT FROM s.name) as changed," +
+        "   count(*) FILTER (WHERE p.id IS NOT NULL AND p.name IS NOT DISTINCT FROM s.name) as unchanged" +
+        " FROM (SELECT DISTINCT ON (key) * FROM staging_places ORDER BY key) s" +
+        " LEFT JOIN places p ON p.key=s.key" +
+        " LEFT JOIN places parent ON parent.key=s.parent_key")
+    counts = result[0]
+    print "{0}: {1.new} new, {1.changed} changed, {1.unchanged} unchanged, {1.missing_parent} missing parent".format(label, counts)
+
+    if dry_run:
+        result = db.query(
+            "SELECT s.key, s.name, p.id, p.name as old_name, parent.id as parent_id, s.parent_key" +
+            " FROM (SELECT DISTINCT ON (key) * FROM staging_places ORDER BY key) s" +
+            " LEFT JOIN places p ON p.key=s.key" +
+            " LEFT JOIN places parent ON parent.key=s.parent_key" +
+            " WHERE parent.id IS NULL OR p.id IS NULL OR p.name IS DISTINCT FROM s.name" +
+            " ORDER BY s.key")
+        for row in result:
+            if row.parent_id is None:
+                print "  ! {0} (parent {1} not found)".format(row.key, row.parent_key)
+            elif row.id is None:
+                print "  + {0} {1}".format(row.key, web.safestr(row.name))
+            else:
+                print "  ~ {0} {1} -> {2}".format(row.key, web.safestr(row.old_name), web.safestr(row.name))
+
+def upsert_places():
+    """Adds the staged places to the places table and updates the name of the
+    places that are already there. Returns the number of places added or updated.
 
-@web.memoize
-def get_ac(state_id, code):
-    return db.select("places", where="type='AC' AND state_id=$state_id AND code=$code", vars=locals())[0]
+    The hierarchy of each place is taken from its parent. Polling centers are
+    not part of the tree, their parent_key is one of their polling booths and
+    only the hierarchy is taken from it.
+    """
+    return db.query(
+        "INSERT INTO places (key, name, type, code, parent_id, state_id, region_id, pc_id, ac_id, ward_id)" +
+        " SELECT DISTINCT ON (s.key) s.key, s.name, s.type::place_type, s.code," +
+        "   CASE WHEN s.type='PX' THEN NULL ELSE p.id END," +
+        "   CASE WHEN p.type='STATE' THEN p.id ELSE p.state_id END," +
+        "   CASE WHEN p.type='REGION' THEN p.id ELSE p.region_id END," +
+        "   CASE WHEN p.type='PC' THEN p.id ELSE p.pc_id END," +
+        "   CASE WHEN p.type='AC' THEN p.id ELSE p.ac_id END," +
+        "   CASE WHEN p.type='WARD' THEN p.id ELSE p.ward_id END" +
+        " FROM staging_places s JOIN places p ON p.key=s.parent_key" +
+        " ORDER BY s.key" +
+        " ON CONFLICT (key) DO UPDATE SET name=excluded.name" +
+        " WHERE places.name IS DISTINCT FROM excluded.name")
 
-@web.memoize
-def get_ward(ac_id, code):
-    return db.select("places", where="type='WARD' AND ac_id=$ac_id AND code=$code", vars=locals())[0]
+@contextlib.contextmanager
+def transaction():
+    """Runs the load in a single transaction and rebuilds the place stats.
+    Once the changes are committed, the running processes are asked to reload
+    their caches and places.
+
+    In dry-run mode, the changes are rolled back at the end.
+    """
+    with timed("total"):
+        t = db.transaction()
+        try:
+            yield
+            if not dry_run:
+                PlaceStats.rebuild()
+        except:
+            t.rollback()
+            raise
+        if dry_run:
+            t.rollback()
+            print "dry run, rolled back all the changes"
+        else:
+            t.commit()
+            cachesync.publish_reset()
+
+def update_ancestors(column):
+    """Updates place_ancestors for the places whose keys are in the given
+    column of the staged places.
+    """
+    result = db.query("SELECT DISTINCT places.id FROM places, staging_places s WHERE places.key=s.{0}".format(column))
+    Place.update_ancestors([row.id for row in result])
+
+def load_places(label, rows):
+    with timed(label):
+        stage_places(rows)
+        print_diff(label)
+        count = upsert_places()
+        update_ancestors("key")
+        print "{0}: added or updated {1} places".format(label, count)
 
 def add_acs(state, dir):
-    with db.transaction():
-        for pc, ac, name in read_csv(dir + "/ac.txt"):
-            key = state.key + "/" + ac
-            name = ac + " - " + name
-            if not db.select("places", where="type='AC' AND state_id=$state.id AND code=$ac", vars=locals()):
-                parent = get_pc(state.id, pc)
-                db.insert("places", key=key, name=name, type="AC", code=ac, parent_id=parent.id, state_id=state.id, pc_id=parent.id)
+    rows = [(state.key + "/" + ac, ac + " - " + name, "AC", ac, state.key + "/" + pc)
+            for pc, ac, name in read_csv(dir + "/ac.txt")]
+    load_places("add_acs", rows)
 
 def add_pcs(state, dir):
-    with db.transaction():
-        for code, name in read_csv(dir + "/pc.txt"):
-            key = state.key + "/" + code
-            name = code + " - " + name
-            if not db.select("places", where="type='PC' AND key=$key", vars=locals()):
-                db.insert("places", key=key, name=name, type="PC", code=code, parent_id=state.id, state_id=state.id)
+    rows = [(state.key + "/" + code, code + " - " + name, "PC", code, state.key)
+            for code, name in read_csv(dir + "/pc.txt")]
+    load_places("add_pcs", rows)
 
 def add_wards(state, filename):
-    for line in open(filename):
-        ac, code, name = line.strip("\n").split("\t")
-        key = "{0}/{1}/{2}".format(state.key, ac, code)
-        name = code + " - " + name
-        parent = get_ac(state.id, ac)
-        if not db.select("places", where="type='WARD' AND key=$key", vars=locals()):
-            db.insert("places", key=key, name=name, type="WARD", code=code,
-                parent_id=parent.id,
-                state_id=state.id,
-                region_id=parent.region_id,
-                pc_id=parent.pc_id,
-                ac_id=parent.id)
+    rows = [("{0}/{1}/{2}".format(state.key, ac, code), code + " - " + name, "WARD", code, state.key + "/" + ac)
+            for ac, code, name in read_csv(filename)]
+    load_places("add_wards", rows)
 
 def add_polling_booths(state, dir):
-    with db.transaction():
-        for ac_code, code, name in read_csv(dir + "/polling_booths.txt"):
-            print "add_polling_booths", state.id, ac_code, code
-            key = "{0}/{1}/{2}".format(state.key, ac_code, code)
-            name = code + " - " + name
-            ac = get_ac(state.id, ac_code)
-            ac_id = ac.id
-            pc_id = ac.pc_id
-            ward_id = None
-
-            if not db.select("places", where="type='PB' AND key=$key", vars=locals()):
-                lazy_insert("places", key=key, name=name, type="PB", code=code,
-                    parent_id=ac_id,
-                    state_id=state.id,
-                    pc_id=pc_id,
-                    ac_id=ac_id,
-                    ward_id=ward_id)
-        commit_lazy_inserts()
+    rows = [("{0}/{1}/{2}".format(state.key, ac_code, code), code + " - " + name, "PB", code, state.key + "/" + ac_code)
+            for ac_code, code, name in read_csv(dir + "/polling_booths.txt")]
+    load_places("add_polling_booths", rows)
 
 def add_polling_centers(state, filename):
-    d = {}
-    with db.transaction():
-        for ac_code, px_code, pb_code, name in read_csv(filename):
-            print "adding polling center", state.id, ac_code, px_code
-            if (ac_code, px_code) not in d:
-                key = "{0}/{1}/{2}".format(state.key, ac_code, px_code)                    
-                if not db.select("places", where="type='PX' AND key=$key", vars=locals()):
-                    pb_key = "{0}/{1}/{2}".format(state.key, ac_code, pb_code)
-                    pb = Place.find(pb_key)
-                    lazy_insert("places", key=key, name=name, type="PX", 
-                        code=key.split("/")[-1],
-                        state_id=state.id,
-                        region_id=pb.region_id,
-                        pc_id=pb.pc_id,
-                        ac_id=pb.ac_id,
-                        ward_id=pb.ward_id)
-                d[ac_code, px_code] = 1
-        commit_lazy_inserts()
-
-    with db.transaction():
-        for ac_code, px_code, pb_code, name in read_csv(filename):
-            key = "{0}/{1}/{2}".format(state.key, ac_code, px_code)                    
-            px = Place.find(key)
-            pb_key = "{0}/{1}/{2}".format(state.key, ac_code, pb_code)
-            db.update("places", px_id=px.id, where="key=$pb_key", vars=locals())
-
-_inserts = {}
-def lazy_insert(table, **row):
-    rows = _inserts.setdefault(table, [])
-    rows.append(row)
-    if len(rows) >= 1000:
-        commit_lazy_inserts()
-
-def commit_lazy_inserts():
-    for table, rows in _inserts.items():
-        if rows:
-            db.multiple_insert(table, rows)
-            _inserts[table] = []
+    """Adds the polling centers and sets the px_id of their polling booths.
+    """
+    rows = [("{0}/{1}/{2}".format(state.key, ac_code, px_code), name, "PX", px_code, "{0}/{1}/{2}".format(state.key, ac_code, pb_code))
+            for ac_code, px_code, pb_code, name in read_csv(filename)]
+    load_places("add_polling_centers", rows)
+
+    with timed("set px_id of polling booths"):
+        count = db.query(
+            "UPDATE places SET px_id=px.id" +
+            " FROM staging_places s JOIN places px ON px.key=s.key" +
+            " WHERE places.key=s.parent_key AND places.px_id IS DISTINCT FROM px.id")
+        update_ancestors("parent_key")
+        print "set px_id of {0} polling booths".format(count)
 
 def add_state(code, name):
     if not db.select("places", where="type='STATE' AND key=$code", vars=locals()):
-        db.insert("places", key=code, name=name, type="STATE", code=code, parent_id=None)
-    return Place.find(code)
+        id = db.insert("places", key=code, name=name, type="STATE", code=code, parent_id=None)
+        Place.update_ancestors([id])
+    # not using Place.find as the place tree may not have the new state yet
+    return db.select("places", where="type='STATE' AND key=$code", vars=locals())[0]
 
 def read_csv(filename):
     return [[c.strip() for c in row] for row in csv.reader(open(filename), delimiter='\t')]
@@ -139,9 +208,13 @@ def main():
     import webapp
     webapp.check_config()
 
-    global db 
+    global db, dry_run
     db = get_db()
 
+    if "--dry-run" in sys.argv:
+        sys.argv.remove("--dry-run")
+        dry_run = True
+
     if "--add-admin" in sys.argv:
         index = sys.argv.index("--add-admin")
         email = sys.argv[index+1]
@@ -158,7 +231,8 @@ def main():
         filename = sys.argv[index+2]
         state = Place.find(state_code)
         print "add_polling_centers", state, filename
-        add_polling_centers(state, filename)
+        with transaction():
+            add_polling_centers(state, filename)
         return
     if "--wards" in sys.argv:
         index = sys.argv.index("--wards")
@@ -166,21 +240,20 @@ def main():
         filename = sys.argv[index+2]
         state = Place.find(state_code)
         print "add_wards", state, filename
-        add_wards(state, filename)
+        with transaction():
+            add_wards(state, filename)
         return
 
-
-    
     dir = sys.argv[1]
     code = sys.argv[2]
     name = sys.argv[3]
 
-    state = add_state(code, name)
-
-    add_pcs(state, dir)
-    add_acs(state, dir)
-    #add_wards(state, dir)
-    add_polling_booths(state, dir)
+    with transaction():
+        state = add_state(code, name)
+        add_pcs(state, dir)
+        add_acs(state, dir)
+        #add_wards(state, dir)
+        add_polling_booths(state, dir)
 
 if __name__ == '__main__':
     main()
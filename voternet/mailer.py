@@ -0,0 +1,197 @@
+"""Sends the messages of a SendMailBatch over multiple SMTP connections.
+
+The messages are sent by a pool of threads, each with its own SMTP connection.
+The sending rate across all the threads can be limited. The status of the
+messages is written to the database in bulk, a few hundred messages at a time.
+
+A message is never sent twice. Before sending a message, the connection is
+checked with a NOOP and it is reconnected if the server has closed it, which
+is safe as nothing of the message is sent yet. When the connection fails
+while sending the message, the server may have accepted it already, so the
+message is marked as failed and the connection is only reestablished for
+the next message.
+
+The number of connections and the rate limit are configured using
+smtp_connections and smtp_rate_limit (messages per second) in the config.
+"""
+import web
+import time
+import email.utils
+import socket
+import smtplib
+import logging
+import threading
+import Queue
+
+import utils
+from models import SendMailMessage
+
+logger = logging.getLogger(__name__)
+
+class RateLimiter:
+    """Limits the rate of some action to rate per second, across threads.
+    """
+    def __init__(self, rate):
+        self.rate = rate
+        self._lock = threading.Lock()
+        self._next = time.time()
+
+    def wait(self):
+        """Waits till the action can be done again.
+        """
+        if not self.rate:
+            return
+        with self._lock:
+            now = time.time()
+            delay = self._next - now
+            self._next = max(now, self._next) + 1.0 / self.rate
+        if delay > 0:
+            time.sleep(delay)
+
+class StatusWriter:
+    """Buffers the status of the messages and writes them in bulk.
+    """
+    def __init__(self, flush_size=200):
+        self.flush_size = flush_size
+        self._lock = threading.Lock()
+        self._pending = []
+
+    def add(self, message, status):
+        with self._lock:
+            self._pending.append((message.id, status))
+            if len(self._pending) < self.flush_size:
+                return
+            pending, self._pending = self._pending, []
+        self._write(pending)
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+        self._write(pending)
+
+    def _write(self, pending):
+        ids_by_status = {}
+        for id, status in pending:
+            ids_by_status.setdefault(status, []).append(id)
+        for status, ids in ids_by_status.items():
+            SendMailMessage.set_status_many(ids, status)
+
+class BatchSender:
+    """Sends all the pending messages of a batch.
+
+    The connect argument is the function to create a connected smtplib.SMTP
+    connection, or None to print the messages instead of sending them,
+    utils.connect_smtp by default.
+    """
+    # errors that indicate the connection needs to be reestablished
+    CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, smtplib.SMTPHeloError, socket.error)
+
+    def __init__(self, batch, num_connections=None, rate=None, connect=None, flush_size=200):
+        self.batch = batch
+        self.num_connections = num_connections or web.config.get("smtp_connections") or 4
+        self.rate_limiter = RateLimiter(rate or web.config.get("smtp_rate_limit"))
+        self.connect = connect or utils.connect_smtp
+        self.status_writer = StatusWriter(flush_size)
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def send(self):
+        """Sends all the pending messages and returns the number of messages
+        by status.
+        """
+        self.counts = {}
+        unsubscribed = self.batch.mark_unsubscribed()
+        if unsubscribed:
+            self.counts['unsubscribed'] = unsubscribed
+
+        queue = Queue.Queue()
+        for m in self.batch.get_messages(status='pending'):
+            queue.put(m)
+
+        logger.info("sending %d messages of batch %s using %d connections",
+            queue.qsize(), self.batch.id, self.num_connections)
+
+        threads = [threading.Thread(target=self._send_messages, args=(queue,)) for i in range(self.num_connections)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.status_writer.flush()
+        logger.info("finished sending batch %s: %s", self.batch.id, self.counts)
+        return self.counts
+
+    def _send_messages(self, queue):
+        conn = None
+        while True:
+            try:
+                m = queue.get_nowait()
+            except Queue.Empty:
+                break
+            self.rate_limiter.wait()
+            try:
+                conn = self._get_connection(conn)
+                status, conn = self._send(conn, m)
+            except Exception:
+                logger.error("failed to send email to %s", m.to_address, exc_info=True)
+                status = "failed"
+            self.status_writer.add(m, status)
+            with self._lock:
+                self.counts[status] = self.counts.get(status, 0) + 1
+        self._close(conn)
+
+    def _get_connection(self, conn):
+        """Returns the connection if it still works, or a new connection.
+
+        Nothing is sent to the server before this, so connecting is retried
+        once when it fails.
+        """
+        if conn is not None:
+            try:
+                conn.noop()
+                return conn
+            except self.CONNECTION_ERRORS:
+                logger.info("smtp connection was closed, reconnecting...")
+                self._close(conn)
+        try:
+            return self.connect()
+        except self.CONNECTION_ERRORS:
+            logger.warn("failed to connect to the smtp server, retrying...", exc_info=True)
+            return self.connect()
+
+    def _close(self, conn):
+        if conn is not None:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+    def _send(self, conn, m):
+        """Sends the message, without retrying.
+
+        Returns the status of the message and the connection to use for the
+        next message, which is None when the connection has failed.
+        """
+        batch = self.batch
+        message = batch.message.replace('{name}', m.name or "").replace('{email}', m.to_address or "")
+        if conn is None:
+            # debug mode, prints the message instead of sending it
+            utils.send_email(m.to_address, message=message, subject=batch.subject)
+            return "sent", conn
+
+        msg = utils.make_envelope(m.to_address, message, subject=batch.subject).to_mime_message()
+        bcc = web.config.get("email_bcc_address") or []
+        if isinstance(bcc, basestring):
+            bcc = [bcc]
+        from_addr = email.utils.parseaddr(msg['From'])[1]
+        try:
+            conn.sendmail(from_addr, [m.to_address] + list(bcc), msg.as_string())
+        except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError):
+            # the server has refused the message
+            return "failed", conn
+        except self.CONNECTION_ERRORS:
+            # The server may have accepted the message before the connection
+            # failed, so it is not sent again.
+            logger.warn("smtp connection failed while sending to %s", m.to_address, exc_info=True)
+            self._close(conn)
+            return "failed", None
+        return "sent", conn
@@ -2,12 +2,15 @@ import web
 import re
 import json
 import cache
+import cachesync
+import jobs
 import time, datetime
 import tablib
 import uuid
 import voterlib
 import hmac
 import logging
+import threading
 
 logger = logging.getLogger(__name__)
 
@@ -16,6 +19,35 @@ def get_db():
     params = web.config.get("db_parameters") or dict(dbn="postgres", db="voternet")
     return web.database(**params)
 
+def get_connection_params():
+    """Returns psycopg2 connection parameters from the db_parameters in the config.
+
+    Used where a dedicated connection is required, outside of web.py.
+    """
+    params = dict(web.config.get("db_parameters") or dict(dbn="postgres", db="voternet"))
+    params.pop("dbn", None)
+    mapping = {"db": "database", "pw": "password", "passwd": "password"}
+    return dict((mapping.get(k, k), v) for k, v in params.items())
+
+def iter_query(query, vars=None, batch_size=1000):
+    """Runs the query using a server-side cursor and yields the result rows
+    as tuples, fetching batch_size rows at a time.
+
+    Unlike get_db().query, the result is never loaded into memory as a whole.
+    A dedicated connection is used, which is closed when the iteration ends.
+    """
+    import psycopg2
+    q = web.reparam(query, vars or {})
+    conn = psycopg2.connect(**get_connection_params())
+    try:
+        cursor = conn.cursor(name="iter_query")
+        cursor.itersize = batch_size
+        cursor.execute(q.query(paramstyle="pyformat"), q.values())
+        for row in cursor:
+            yield row
+    finally:
+        conn.close()
+
 @web.memoize
 def get_voter_db():
     if web.config.get("voterdb"):
@@ -24,6 +56,7 @@ def get_voter_db():
         return get_db()
 
 re_normalize = re.compile("[^a-z]")
+
 def normalize(name):
     return re_normalize.sub("", name.lower())
 
@@ -81,19 +114,15 @@ class Place(web.storage):
             return w.name
 
     def get_parents(self):
-        i = self.TYPES.index(self.type)
-        parent_types = self.TYPES[:i]
-        parents = [self.get_parent(t) for t in parent_types]
+        parents = [Place.from_id(id) for id in self.get_parent_ids()]
         return [p for p in parents if p]
 
     def get_subplaces(self):
         """Returns list of all sub places"""
-        rows = get_db().query("SELECT * FROM places WHERE {0} = $id ORDER BY key".format(self.type_column), vars=self)
-        return [Place(row) for row in rows]
+        return get_place_tree().get_subtree(self.id)
 
     def get_children(self, type):
-        rows = get_db().query("SELECT * FROM places WHERE type=$type AND {0} = $self.id ORDER BY key".format(self.type_column), vars=locals())
-        return [Place(row) for row in rows]
+        return get_place_tree().get_subtree(self.id, type=type)
 
     @property
     def volunteers(self):
@@ -128,13 +157,56 @@ class Place(web.storage):
             where += " AND email=$email"
 
         result = get_db().query(
-            "SELECT people.* FROM people, places" + 
-            " WHERE people.place_id=places.id" + 
-            where +
-            "   AND (places.id=$self.id OR places.{0} = $self.id)".format(self.type_column),
+            "SELECT people.* FROM people, place_ancestors a" + 
+            " WHERE people.place_id=a.place_id AND a.ancestor_id=$self.id" + 
+            where,
             vars=locals())
         return [Person(row) for row in result]
 
+    # at least 3 digits and nothing else but +, -, spaces and brackets
+    re_phone_query = re.compile(r"^[+\-() ]*([0-9][+\-() ]*){3,}$")
+
+    @staticmethod
+    def _escape_like(s):
+        """Escapes the wildcards of LIKE in the string.
+        """
+        return s.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+    def search_people(self, q, limit=50):
+        """Returns the people in the subtree of this place matching the query,
+        ordered by name.
+
+        A query that looks like a phone number matches the phone numbers
+        containing it, after normalizing both like utils.process_phone.
+        Otherwise every word of the query has to be part of the name, email
+        or voter ID of the person, ignoring case.
+        """
+        import utils
+        q = q.strip()
+        if self.re_phone_query.match(q):
+            pattern = "%" + self._escape_like(utils.process_phone(q)) + "%"
+            where = web.reparam("normalize_phone(people.phone) LIKE $pattern", locals())
+        else:
+            conditions = []
+            for word in q.lower().split():
+                pattern = "%" + self._escape_like(word) + "%"
+                conditions.append(web.reparam(
+                    "(lower(people.name) LIKE $pattern" +
+                    " OR lower(people.email) LIKE $pattern" +
+                    " OR lower(people.voterid) LIKE $pattern)", locals()))
+            if not conditions:
+                return []
+            where = web.SQLQuery.join(conditions, " AND ")
+
+        result = get_db().query(
+            web.reparam(
+                "SELECT people.* FROM people" +
+                " JOIN place_ancestors a ON a.place_id=people.place_id" +
+                " WHERE a.ancestor_id=$self.id AND ", locals()) +
+            where +
+            web.reparam(" ORDER BY people.name LIMIT $limit", locals()))
+        return [Person(row) for row in result]
+
     @cache.object_memoize(key="coordinators")
     def get_coordinators(self):
         return self.get_people(["coordinator"])
@@ -148,12 +220,14 @@ class Place(web.storage):
             voterid=voterid,
             role=role, 
             notes=notes)
+        PlaceStats.update_places([self.id])
+        ACL.invalidate(email)
         self._invalidate_object_cache()
         logger.info("Added %s <%s> as %s to %s", name, email, role, self.key)
         self.record_activity("volunteer-added", volunteer_id=person_id, name=name, role=role)
         person = Person.find_by_id(person_id)
         if voterid:
-            person.populate_voterid_info()
+            person.enqueue_voterid_info()
         return person
 
     def add_invite(self, name, email, phone, batch=None):
@@ -176,22 +250,81 @@ class Place(web.storage):
 
     def _invalidate_object_cache(self):
         cache.invalidate_object_cache(objects=[self] + self.get_parents())
-        code = self.get_url()[1:] # remove / at the beginning
-        cache.invalidate_cache("Place.find", code)
-        cache.invalidate_cache("Place.find", code=code)
-        cache.invalidate_cache("Place.from_id", self.id)
-        cache.invalidate_cache("Place.from_id", id=self.id)
+
+    @staticmethod
+    def update_ancestors(place_ids=None):
+        """Updates the rows of the given places in place_ancestors from their
+        hierarchy columns. Updates all the places when place_ids is None.
+
+        Must be called whenever a place is added or its hierarchy columns change.
+        """
+        if place_ids is None:
+            where = "true"
+        else:
+            place_ids = list(set(id for id in place_ids if id))
+            if not place_ids:
+                return
+            where = "places.id IN $place_ids"
+        db = get_db()
+        with db.transaction():
+            db.query("DELETE FROM place_ancestors WHERE " + where.replace("places.id", "place_id"), vars=locals())
+            db.query(
+                "INSERT INTO place_ancestors (ancestor_id, place_id)" +
+                " SELECT DISTINCT a.id, places.id" +
+                " FROM places, unnest(ARRAY[places.id, places.state_id, places.region_id," +
+                "   places.pc_id, places.ac_id, places.ward_id, places.px_id]) AS a(id)" +
+                " WHERE a.id IS NOT NULL AND " + where, vars=locals())
+
+    @staticmethod
+    def invalidate_object_caches(place_ids):
+        """Invalidates the object cache of all the given places and their
+        parents, invalidating each place only once.
+        """
+        places = {}
+        for place in get_place_tree().get_many(place_ids).values():
+            for p in [place] + place.get_parents():
+                places[p.id] = p
+        if places:
+            cache.invalidate_object_cache(objects=places.values())
+
+    def reassign_pb_agents(self):
+        """Moves the PB agents in the subtree of this place, whose voterid
+        belongs to a different PB, to that PB, using a single UPDATE.
+
+        Returns the list of moved agents as rows of id, name, email,
+        old_place_id and new_place_id.
+        """
+        db = get_db()
+        with db.transaction():
+            result = db.query(
+                "WITH moved AS (" +
+                "  SELECT DISTINCT ON (people.id) people.id, people.name, people.email," +
+                "    people.place_id AS old_place_id, voterid_info.pb_id AS new_place_id" +
+                "  FROM people" +
+                "  JOIN voterid_info ON voterid_info.voterid=people.voterid" +
+                "  JOIN place_ancestors a ON a.place_id=people.place_id" +
+                "  WHERE people.role='pb_agent' AND voterid_info.pb_id IS NOT NULL" +
+                "    AND voterid_info.pb_id != people.place_id" +
+                "    AND a.ancestor_id=$self.id" +
+                "  ORDER BY people.id, voterid_info.id)" +
+                " UPDATE people SET place_id=moved.new_place_id" +
+                " FROM moved WHERE people.id=moved.id" +
+                " RETURNING moved.*", vars=locals()).list()
+            if result:
+                Activity.record_many("volunteer-reassigned", [
+                    dict(place_id=row.new_place_id, volunteer_id=row.id, name=row.name, from_place_id=row.old_place_id)
+                    for row in result])
+                PlaceStats.update_places([row.old_place_id for row in result] + [row.new_place_id for row in result])
+        if result:
+            Place.invalidate_object_caches([row.old_place_id for row in result] + [row.new_place_id for row in result])
+            for email in set(row.email for row in result):
+                ACL.invalidate(email)
+        return result
 
     @property
     def type_label(self):
         return self.TYPE_LABELS[self.type]
 
-    @property
-    def type_column(self):
-        if self.type == "PB":
-            return "id"
-        return self.type.lower() + "_id"
-
     @property
     def parent_column(self):
         if self.type != "STATE":
@@ -211,16 +344,24 @@ class Place(web.storage):
 
     def update_info(self, info):
         get_db().update("places", where='id=$self.id', info=info, vars=locals())
+        get_place_tree().refresh([self.id])
         self._invalidate_object_cache()
 
     def delete(self):
         db = get_db()
+        place_ids = [self.id] + get_place_tree().get_subtree_ids(self.id)
         with db.transaction():
-            db.query("DELETE FROM people USING places"
-                + " WHERE place_id=places.id"
-                + "     AND (places.id=$self.id OR places.%s=$self.id)" % self.type_column,
+            deleted = db.query("DELETE FROM people USING place_ancestors a"
+                + " WHERE people.place_id=a.place_id AND a.ancestor_id=$self.id"
+                + " RETURNING people.email",
                 vars=locals())
-            db.query("DELETE FROM places WHERE id=$self.id OR %s=$self.id" % self.type_column, vars=locals())
+            emails = set(row.email.lower() for row in deleted if row.email)
+            db.query("DELETE FROM places WHERE id IN (SELECT place_id FROM place_ancestors WHERE ancestor_id=$self.id)", vars=locals())
+            PlaceStats.recompute(self.get_parent_ids())
+            PlaceStats.update_places([self.px_id])
+        get_place_tree().refresh(place_ids)
+        self._invalidate_object_cache()
+        cache.invalidate_cache_many("ACL.find", [(email,) for email in emails])
 
     def get_all_subtypes(self):
         """Returns all subtypes including type of this place.
@@ -229,18 +370,14 @@ class Place(web.storage):
         return [web.storage(code=type, label=self.TYPE_LABELS[type]) for type in self.TYPES[index:]]
 
     def get_places(self, type=None):
-        db = get_db()
-        id = self.id
         type = type or self.subtype
-        column = self.type_column
-        result = db.select("places", where="%s=$id and type=$type" % column, order="code", vars=locals())
-        return [Place(row) for row in result]
+        return get_place_tree().get_subtree(self.id, type=type, order="code")
 
     def get_unassigned_places(self, type, parent_type):
         """Returns places of given type inside this subtree, with out parent of parent_type.
         """
         col = parent_type.lower() + "_id"
-        where = "%s=$self.id and %s is NULL and type=$type" % (self.type_column, col)
+        where = "id IN (SELECT place_id FROM place_ancestors WHERE ancestor_id=$self.id) and %s is NULL and type=$type" % col
         result = get_db().select("places", where=where, order="code", vars=locals())
         return [Place(row) for row in result]
 
@@ -285,17 +422,28 @@ class Place(web.storage):
         self._add_place(key, code, name, type)
 
     def set_ward(self, ward):
+        old_ward_id = self.ward_id
         self.ward_id = ward and ward.id
         get_db().update("places", ward_id=self.ward_id, where="id=$self.id", vars=locals())
+        Place.update_ancestors([self.id])
+        get_place_tree().refresh([self.id])
+        PlaceStats.recompute([old_ward_id, self.ward_id])
         self._invalidate_object_cache()
+        ACL.invalidate_places([self.id])
         if self.type == "PB":
             px = self.get_parent("PX")
             px and px.autoupdate_ward()
 
     def set_px(self, px):
+        old_px_id = self.px_id
         self.px_id = px and px.id
         get_db().update("places", px_id=self.px_id, where="id=$self.id", vars=locals())
+        Place.update_ancestors([self.id])
+        get_place_tree().refresh([self.id])
+        PlaceStats.recompute([old_px_id, self.px_id])
+        PlaceStats.update_places([old_px_id, self.px_id])
         self._invalidate_object_cache()
+        ACL.invalidate_places([self.id])
         px = self.get_parent("PX")
         px and px.autoupdate_ward()
 
@@ -309,23 +457,85 @@ class Place(web.storage):
             top_ward = max(d, key=d.__getitem__)
             self.set_ward(Place.find(top_ward))
 
+    def assign_booths(self, assignments):
+        """Sets the ward and the polling center of many polling booths at once.
+
+        The assignments is a list of (pb, ward, px) tuples, where ward and px
+        can be None. Only the booths whose ward or polling center has changed
+        are updated, using a single UPDATE. The ward of each affected polling
+        center is then set to the ward of most of its booths, like
+        autoupdate_ward does. Returns the number of booths changed.
+        """
+        changes = [(pb, ward and ward.id, px and px.id) for pb, ward, px in assignments
+                   if pb.ward_id != (ward and ward.id) or pb.px_id != (px and px.id)]
+        if not changes:
+            return 0
+
+        ward_ids = set()
+        px_ids = set()
+        for pb, ward_id, px_id in changes:
+            ward_ids.update([pb.ward_id, ward_id])
+            px_ids.update([pb.px_id, px_id])
+        px_ids.discard(None)
+        px_ids = list(px_ids)
+        # the polling centers may move from one ward to another
+        ward_ids.update(px.ward_id for px in get_place_tree().get_many(px_ids).values())
+
+        db = get_db()
+        with db.transaction():
+            values = [web.reparam("($pb.id, $ward_id, $px_id)", locals()) for pb, ward_id, px_id in changes]
+            db.query(
+                "UPDATE places SET ward_id=v.ward_id::integer, px_id=v.px_id::integer" +
+                " FROM (VALUES " + web.SQLQuery.join(values, ", ") + ") AS v(id, ward_id, px_id)" +
+                " WHERE places.id=v.id")
+            if px_ids:
+                result = db.query(
+                    "UPDATE places SET ward_id=v.ward_id" +
+                    " FROM (" +
+                    "   SELECT DISTINCT ON (px_id) px_id, ward_id FROM places" +
+                    "   WHERE type='PB' AND px_id IN $px_ids AND ward_id IS NOT NULL" +
+                    "   GROUP BY px_id, ward_id" +
+                    "   ORDER BY px_id, count(*) DESC, ward_id) v" +
+                    " WHERE places.id=v.px_id AND places.ward_id IS DISTINCT FROM v.ward_id" +
+                    " RETURNING places.ward_id", vars=locals())
+                ward_ids.update(row.ward_id for row in result)
+
+            Place.update_ancestors([pb.id for pb, ward_id, px_id in changes] + px_ids)
+            ward_ids.discard(None)
+            PlaceStats.recompute(list(ward_ids) + px_ids)
+            PlaceStats.update_places(px_ids)
+
+        get_place_tree().refresh([pb.id for pb, ward_id, px_id in changes] + px_ids)
+        Place.invalidate_object_caches([pb.id for pb, ward_id, px_id in changes] + px_ids + list(ward_ids))
+        ACL.invalidate_places([pb.id for pb, ward_id, px_id in changes] + px_ids)
+        return len(changes)
+
     def set_parent(self, type, parent):
         if self.get_parent(type) == parent:
             # nothing to change
             return
 
         col = self.COLUMN_NAMES[type]
+        old_parent_id = self[col]
         self[col] = parent and parent.id
         values = {col: self[col]}
-        where = "id=$self.id OR {0}=$self.id".format(self.type_column)
-        get_db().update("places", where=where, vars=locals(), **values)
-        places = [Place(row) for row in get_db().select("places", where=where, vars=locals())]
+        where = "id IN (SELECT place_id FROM place_ancestors WHERE ancestor_id=$self.id)"
+        db = get_db()
+        with db.transaction():
+            places = [Place(row) for row in db.select("places", where=where, vars=locals())]
+            place_ids = [p.id for p in places]
+            db.update("places", where="id IN $place_ids", vars=locals(), **values)
+            Place.update_ancestors(place_ids)
+            PlaceStats.recompute([old_parent_id, self[col]])
+        get_place_tree().refresh(place_ids)
         for p in places:
             p._invalidate_object_cache()
+        ACL.invalidate_places([self.id])
 
     def update_name(self, name):
         self.name = name
         get_db().update("places", name=name, where="id=$self.id", vars=locals())
+        get_place_tree().refresh([self.id])
         self._invalidate_object_cache()
 
     def get_places_text(self):
@@ -352,7 +562,10 @@ class Place(web.storage):
         # set the parent id in the apprpriate field
         row[self.type.lower() + "_id"] = self.id
         row['id'] = get_db().insert("places", **row)
+        Place.update_ancestors([row.id])
+        get_place_tree().refresh([row.id])
         place = Place(row)
+        PlaceStats.update_places([place.id])
         place._invalidate_object_cache()
 
     re_place_line = re.compile("([^{}]*) {{(.*)}}")
@@ -378,136 +591,81 @@ class Place(web.storage):
         if result:
             return Place(result[0])
 
-    @cache.object_memoize(key="counts")
+    @cache.object_memoize(key="stats")
+    def get_stats(self):
+        """Returns the summary of volunteer, agent and coverage counts of
+        this place, computed from the place_stats rollup.
+
+        See PlaceStats.summarize for the fields.
+        """
+        return PlaceStats.summarize(PlaceStats.find(self.id))
+
     def get_counts(self):
-        if self.type == "PB":
-            where = "places.id=$self.id"
-        else:
-            where = "(places.%s=$self.id OR places.id=$self.id)" % self.type_column
+        return self.get_stats().counts
 
-        result = get_db().query(
-            "SELECT type, count(*) as count" +
-            " FROM places" +
-            " WHERE " + where +
-            " GROUP BY type", vars=locals())
-        return dict((row.type, row.count) for row in result)
-        return dict()
-
-    @cache.object_memoize(key="volunteer_counts")
     def get_volunteer_counts(self):
-        if self.type == "PB":
-            where = "places.id=$self.id"
-        else:
-            where = "(places.%s=$self.id OR places.id=$self.id)" % self.type_column
+        return self.get_stats().volunteer_counts
 
-        roles = ['coordinator', 'volunteer']
-        result = get_db().query(
-            "SELECT type, count(*) as count" +
-            " FROM places" +
-            " JOIN people ON places.id=people.place_id" +
-            " WHERE %s AND role in $roles" % where + 
-            " GROUP BY type", vars=locals())
-        return dict((row.type, row.count) for row in result)
-
-    @cache.object_memoize(key="agent_counts")
     def get_agent_counts(self):
-        if self.type == "PB":
-            where = "places.id=$self.id"
-        else:
-            where = "(places.%s=$self.id OR places.id=$self.id)" % self.type_column
+        return self.get_stats().agent_counts
 
-        # find total agents
-        result = get_db().query(
-            "SELECT count(*) as count FROM people, places" +
-            " WHERE people.role='pb_agent'" + 
-            "   AND people.place_id=places.id" +
-            "   AND " + where, 
-            vars=locals())
-        total = result[0].count
+    def get_agent_counts2(self):
+        return self.get_stats().agent_counts2
 
-        # find confirmed agents
-        result = get_db().query(
-            "SELECT count(*) as agents, count(distinct places.id) as booths FROM people" +
-            " JOIN voterid_info ON voterid_info.voterid=people.voterid" +
-            " JOIN places ON places.id=people.place_id" +
-            " WHERE people.role='pb_agent' and places.type='PB'" +
-            "   AND " + where, 
-            vars=locals())
-        row = result[0]
-        confirmed = row.agents
-        confirmed_booths = row.booths
-        pending = total-confirmed
-        return web.storage(total=total, confirmed=confirmed, confirmed_booths=confirmed_booths, pending=pending)
+    def get_child_stats(self, type=None):
+        """Returns the statistics of all the subplaces of this place.
 
-    #@cache.object_memoize(key="agent_counts2")
-    def get_agent_counts2(self):
-        total_pb_agents, _ = self._get_agent_counts("pb_agent")
-        assigned_pb_agents, assigned_booths = self._get_agent_counts("pb_agent", 'PB')
-
-        total_px_agents, _ = self._get_agent_counts("px_agent")
-        assigned_px_agents, assigned_centers = self._get_agent_counts("px_agent", 'PX')
-
-        ward_coordinators, assigned_wards = self._get_agent_counts('coordinator', 'WARD')
-
-        return web.storage({
-            "assigned_pb_agents": assigned_pb_agents,
-            "assigned_pbs": assigned_booths,
-            "unassigned_pb_agents": total_pb_agents - assigned_pb_agents,
-            "assigned_px_agents": assigned_px_agents,
-            "unassigned_px_agents": total_px_agents - assigned_px_agents,            
-            "assigned_pxs": assigned_centers,
-            "assigned_pxs_including_pbs": self._get_px_count(),
-
-            "assigned_ward_coordinators": ward_coordinators,
-            "assigned_wards": assigned_wards,
-        })
-
-    def _get_agent_counts(self, role, place_type=None):
-        where = "(places.%s=$self.id OR places.id=$self.id)" % self.type_column
-        if place_type:
-            where += " AND places.type=$place_type"
-        if isinstance(role, list):
-            where += " AND people.role IN $role"
-        else:
-            where += " AND people.role = $role"
-        result = get_db().query(
-            "SELECT count(*) as count, count(distinct places.id) as place_count, count(distinct places.px_id) as px_count FROM people, places" +
-            " WHERE people.place_id=places.id" +
-            "   AND " + where, 
-            vars=locals())
-        row = result[0]
-        return row.count, row.place_count
+        See get_places_stats for details.
+        """
+        return self.get_places_stats(self.get_places(type=type))
 
-    def _get_px_count(self):
-        """When counting PX agents, we count both PB agents and PX agents.
+    @staticmethod
+    def get_places_stats(places):
+        """Returns the statistics shown on the dashboard for each of the
+        given places as a dict keyed by place id.
+
+        Each value is a storage object with coordinators, volunteers, counts,
+        volunteer_counts, agent_counts, coverage_count and agent_counts2,
+        holding the same values as the corresponding methods of Place.
+        All of them are computed using two queries, irrespective of the
+        number of places.
         """
-        q1 = ("SELECT places.id FROM places, people" +
-            " WHERE people.place_id=places.id" +
-            "   AND people.role='px_agent'" + 
-            "   AND places.type='PX'" +
-            "   AND (places.{}=$self.id OR places.id=$self.id)".format(self.type_column)) 
+        ids = [p.id for p in places]
+        if not ids:
+            return {}
+
+        rollup = PlaceStats.find_all(ids)
+        stats = {}
+        for id in ids:
+            stats[id] = PlaceStats.summarize(rollup.get(id, {}))
+            stats[id].coordinators = []
+            stats[id].volunteers = []
+
+        roles = ['coordinator', 'volunteer', 'pb_agent', 'px_agent', 'member', 'active_member']
+        result = get_db().select("people", where="place_id IN $ids AND role IN $roles", order="role, id", vars=locals())
+        for row in result:
+            person = Person(row)
+            stats[person.place_id].volunteers.append(person)
+            if person.role == "coordinator":
+                stats[person.place_id].coordinators.append(person)
+        return stats
 
-        q2 = ("SELECT places.px_id FROM places, people" +
-            " WHERE people.place_id=places.id" +
-            "   AND people.role='pb_agent'" + 
-            "   AND places.type='PB'" +
-            "   AND (places.{}=$self.id OR places.id=$self.id)".format(self.type_column)) 
+    def get_parent_ids(self):
+        """Returns ids of all the parents of this place.
 
-        q =  "SELECT count(*) FROM ({} UNION {}) as t".format(q1, q2)
-        result = get_db().query(q, vars=locals())
-        row = result[0]
-        return row.count
+        This is same as [p.id for p in self.get_parents()], but without
+        loading the parents.
+        """
+        i = self.TYPES.index(self.type)
+        ids = [self[t.lower() + "_id"] for t in self.TYPES[:i]]
+        return [id for id in ids if id]
 
     @cache.object_memoize(key="volunteer_counts_by_date")
     def get_volunteer_counts_by_date(self):
-        if self.type == "PB":
-            column = "id"
-        else:
-            column = self.type_column
         result = get_db().query(
             "SELECT to_char(added, 'YYYY-MM-DD')::date as date, count(*) as count" +
-            " FROM people, places" +
-            " WHERE people.place_id=places.id AND (places.%s=$self.id OR places.id=$self.id)" % column + 
+            " FROM people, place_ancestors a" +
+            " WHERE people.place_id=a.place_id AND a.ancestor_id=$self.id" + 
             " GROUP BY 1" + 
             " ORDER BY 1", vars=locals())
         return result.list()
@@ -531,24 +689,16 @@ class Place(web.storage):
         return self.prepare_data_for_graph(self.get_volunteer_counts_by_date())
 
     @staticmethod
-    @cache.memoize(key="Place.find")
     def find(key):
-        result = get_db().select("places", where="key=$key", vars=locals())
-        if result:
-            return Place(result[0])
+        return get_place_tree().find(key)
 
     @staticmethod
     def find_all():
-        db = get_db()
-        return [Place(row) for row in db.select("places")]
+        return get_place_tree().get_all()
 
     @staticmethod
-    @cache.memoize(key="Place.from_id")
     def from_id(id):
-        db = get_db()
-        result = db.select("places", where="id=$id", vars=locals())
-        if result:
-            return Place(result[0]) 
+        return get_place_tree().get(id)
 
     def __eq__(self, other):
         return self.id is not None and isinstance(other, Place) and self.id == other.id
@@ -563,12 +713,7 @@ class Place(web.storage):
         if user.email in web.config.get('super_admins', []):
             return True
 
-        place_ids = [self.id, self.state_id, self.region_id, self.pc_id, self.ac_id, self.ward_id]
-        result = get_db().query("SELECT * FROM people" +
-            " WHERE lower(email)=lower($user.email)" +
-            "   AND place_id in $place_ids" +
-            "   AND role IN $roles", vars=locals())
-        return bool(result)
+        return ACL.find(user.email).has_role(self, roles)
 
     def viewable_by(self, user):
         if not user:
@@ -577,16 +722,11 @@ class Place(web.storage):
         if user.email in web.config.get('super_admins', []):
             return True
 
+        acl = ACL.find(user.email)
         # If they can write, then can view as well.
-        if self.writable_by(user, roles=['coordinator', 'admin', 'user']):
+        if acl.has_role(self, roles=['coordinator', 'admin', 'user']):
             return True
-
-        result = get_db().query("SELECT people.* FROM people, places" +
-            " WHERE places.id=people.place_id" + 
-            "   AND lower(people.email)=lower($user.email)" + 
-            "   AND $self.id IN (places.id, places.ward_id, places.ac_id, places.pc_id, places.region_id, places.state_id)",
-            vars=locals())
-        return bool(result)
+        return self.id in acl.viewable_ids
 
     def add_coverage(self, date, coverage, user):
         db = get_db()
@@ -599,22 +739,27 @@ class Place(web.storage):
                 self.record_activity("coverage-added", count=len(coverage))
             else:
                 self.record_activity("coverage-updated", count=len(coverage), old_count=count)
+            PlaceStats.update_places([self.id])
         self._invalidate_object_cache()
 
-    def get_activity(self, types=None, offset=0, limit=100):
+    def get_activity(self, types=None, before=None, limit=100):
+        """Returns the latest activity in the subtree of this place.
+
+        The activity is paginated by (tstamp, id). To get the next page,
+        pass the id of the last activity of the current page as before.
+        """
         if types is None:
             types = ['volunteer-added', 'coverage-added', 'voterid-added']
-        if self.type == 'PB':
-            where = "places.id=$self.id"
-        else:
-            where = "(places.id=$self.id OR places.%s=$self.id)" % self.type_column
+        where = "a.ancestor_id=$self.id"
+        if before:
+            where += " AND (activity.tstamp, activity.id) < (SELECT tstamp, id FROM activity WHERE id=$before)"
         result = get_db().query(
             "SELECT activity.*" +
-            " FROM activity, places" + 
-            " WHERE activity.place_id=places.id AND activity.type IN $types AND " + where +
-            " ORDER by tstamp DESC OFFSET $offset LIMIT $limit",
+            " FROM activity, place_ancestors a" + 
+            " WHERE activity.place_id=a.place_id AND activity.type IN $types AND " + where +
+            " ORDER by activity.tstamp DESC, activity.id DESC LIMIT $limit",
             vars=locals())
-        return [Activity(a) for a in result]
+        return Activity.prefetch([Activity(a) for a in result])
 
     def record_activity(self, type, **kwargs):
         Activity.record(type, self.id, **kwargs)
@@ -626,10 +771,15 @@ class Place(web.storage):
         else:
             return []
 
-    def get_messages(self, limit=5):
+    def get_messages(self, limit=5, before=None):
+        """Returns the latest messages posted to this place and its parents.
+
+        To get the next page, pass the id of the last message of the current
+        page as before.
+        """
         places = [self] + self.get_parents()
         place_ids = [p.id for p in places]
-        return Message.find(place_id=place_ids, limit=limit)
+        return Message.find(place_id=place_ids, limit=limit, before=before)
 
     def find_message(self, id):
         m = Message.by_id(id)
@@ -639,33 +789,16 @@ class Place(web.storage):
     def post_message(self, message, author):
         return Message.create(place=self, author=author, message=message)
 
-    @cache.object_memoize(key="coverage_count")
     def get_coverage_count(self):
-        if self.type == "PB":
-            column = "id"
-        else:
-            column = self.type_column
-        result = get_db().query(
-                    "SELECT sum(count) as count" +
-                    " FROM coverage, places" +
-                    " WHERE coverage.place_id=places.id" +
-                    "   AND places.%s=$self.id" % column, vars=locals())
-        if result:
-            return result[0].count or 0
-        else:
-            return 0
+        return self.get_stats().coverage_count
 
     @cache.object_memoize(key="coverage_count_by_date")
     def get_coverage_counts_by_date(self):
-        if self.type == "PB":
-            column = "id"
-        else:
-            column = self.type_column
         result = get_db().query(
                     "SELECT date, sum(count) as count" +
-                    " FROM coverage, places" +
-                    " WHERE coverage.place_id=places.id" +
-                    "   AND places.%s=$self.id" % column +
+                    " FROM coverage, place_ancestors a" +
+                    " WHERE coverage.place_id=a.place_id" +
+                    "   AND a.ancestor_id=$self.id" +
                     " GROUP BY date ORDER BY date", vars=locals())
         return result.list()
 
@@ -755,9 +888,8 @@ class Place(web.storage):
 
     def get_signups(self):
         result = get_db().query(
-            "SELECT volunteer_signups.* FROM volunteer_signups, places" +
-            " WHERE places.id=volunteer_signups.place_id" + 
-            "   AND $self.id IN (places.id, places.ac_id, places.pc_id, places.region_id, places.state_id)"
+            "SELECT volunteer_signups.* FROM volunteer_signups, place_ancestors a" +
+            " WHERE a.place_id=volunteer_signups.place_id AND a.ancestor_id=$self.id" + 
             " ORDER BY added DESC", vars=locals())
         return [VolunteerSignup(row) for row in result]
 
@@ -793,30 +925,580 @@ class Place(web.storage):
         wards = self.get_places(type="WARD")            
         return [process_ward(w) for w in wards]
 
-    def get_all_coordinators_as_dataset(self, types=['STATE', 'REGION', 'PC', 'AC', 'WARD']):
-        return self.get_all_volunteers_as_dataset(roles=['coordinator'], types=types)
+    def iter_coordinator_rows(self, types=['STATE', 'REGION', 'PC', 'AC', 'WARD']):
+        return self.iter_volunteer_rows(roles=['coordinator'], types=types)
+
+    def iter_volunteer_rows(self, roles=['volunteer', 'pb_agent', 'px_agent', 'coordinator', 'member', 'active_member'], types=['STATE', 'REGION', 'PC', 'AC', 'WARD', 'PB', 'PX']):
+        """Yields rows of (name, email, phone, voterid, role, pb, ward, ac, pc)
+        for all the people in the subtree, to export them.
+
+        The rows are streamed from the database, ordered by PC, AC and ward.
+        """
+        query = (
+            "SELECT people.name, people.email, people.phone, people.voterid, people.role," +
+            " CASE WHEN places.type='PB' THEN places.name ELSE '-' END," +
+            " CASE WHEN places.type='WARD' THEN places.name ELSE coalesce(ward.name, '-') END," +
+            " CASE WHEN places.type='AC' THEN places.name ELSE coalesce(ac.name, '-') END," +
+            " CASE WHEN places.type='PC' THEN places.name ELSE coalesce(pc.name, '-') END" +
+            " FROM people" +
+            " JOIN places ON places.id=people.place_id" +
+            " LEFT JOIN places pc ON pc.id=places.pc_id" +
+            " LEFT JOIN places ac ON ac.id=places.ac_id" +
+            " LEFT JOIN places ward ON ward.id=places.ward_id" +
+            " JOIN place_ancestors a ON a.place_id=places.id" +
+            " WHERE people.role IN $roles AND places.type IN $types" +
+            " AND a.ancestor_id=$self.id" +
+            " ORDER BY places.pc_id NULLS FIRST, places.ac_id NULLS FIRST, places.ward_id NULLS FIRST, people.place_id")
+        return iter_query(query, vars=locals())
+
+    def iter_signup_rows(self):
+        """Yields rows of (name, phone, email, locality, ward, timestamp)
+        for all the volunteer signups in the subtree, to export them.
+        """
+        query = (
+            "SELECT volunteer_signups.name, volunteer_signups.phone, volunteer_signups.email," +
+            " volunteer_signups.address, places.name, volunteer_signups.added" +
+            " FROM volunteer_signups, places, place_ancestors a" +
+            " WHERE places.id=volunteer_signups.place_id" +
+            "   AND a.place_id=places.id AND a.ancestor_id=$self.id" +
+            " ORDER BY volunteer_signups.added DESC")
+        return iter_query(query, vars=locals())
+
+@web.memoize
+def get_place_tree():
+    return PlaceTree()
+
+class PlaceTree:
+    """In-memory index of all the places.
+
+    The places table is small, about 8k rows for a state. All of them are
+    loaded once per process and Place.find, Place.from_id and the navigation
+    methods of Place are served from here instead of querying the database.
+
+    The methods that modify places call refresh with the ids of the modified
+    places to keep the tree in sync with the database. The tree is read and
+    modified by many threads, so all access to its state holds the lock. The
+    database is never queried while holding it.
+    """
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._loaded = False
+        self.rows = {}
+        self.keys = {}
+        self.parent_ids = {}
+        # id -> set of ids of all places in its subtree
+        self.subtrees = {}
+        # cache of sorted lists of places in subtrees
+        self._sorted = {}
+        # functions called with the ids of the changed places
+        self._listeners = []
+
+    def add_listener(self, f):
+        """Registers a function to be called whenever places change.
+
+        The function is called with the list of ids of the places that are
+        added, modified or deleted, or with None when all the places are
+        reloaded. The changes made by other processes are included.
+        """
+        self._listeners.append(f)
+
+    def _notify(self, ids):
+        for f in self._listeners:
+            try:
+                f(ids)
+            except Exception:
+                logger.error("failed to notify the change of places %s", ids, exc_info=True)
+
+    def load(self):
+        """Loads all the places from the database.
+        """
+        rows = get_db().select("places").list()
+        with self._lock:
+            self.rows, self.keys, self.parent_ids, self.subtrees, self._sorted = {}, {}, {}, {}, {}
+            for row in rows:
+                self._add(row)
+            self._loaded = True
+        logger.info("loaded %d places into the place tree", len(rows))
+        self._notify(None)
+
+    def reset(self):
+        """Marks the tree as stale, to reload all the places on next access.
+        """
+        self._loaded = False
+
+    def refresh(self, ids=None, propagate=True):
+        """Reloads the places with the given ids from the database.
 
-    def get_all_volunteers_as_dataset(self, roles=['volunteer', 'pb_agent', 'px_agent', 'coordinator', 'member', 'active_member'], types=['STATE', 'REGION', 'PC', 'AC', 'WARD', 'PB', 'PX']):
+        Reloads the whole tree when ids is None. Unless propagate is False,
+        the other processes are notified to reload the same places.
+        """
+        if ids is None:
+            return self.load()
+
+        ids = list(set(id for id in ids if id))
+        if not ids:
+            return
+        if propagate:
+            cachesync.publish("places", ids)
+        if not self._loaded:
+            return
+        rows = get_db().select("places", where="id IN $ids", vars=locals()).list()
+        with self._lock:
+            for id in ids:
+                self._remove(id)
+            for row in rows:
+                self._add(row)
+            self._sorted = {}
+        self._notify(ids)
+
+    def _add(self, row):
+        place = Place(row)
+        self.rows[place.id] = place
+        self.keys[place.key] = place.id
+        self.parent_ids[place.id] = parent_ids = tuple(place.get_parent_ids())
+        for parent_id in parent_ids:
+            self.subtrees.setdefault(parent_id, set()).add(place.id)
+
+    def _remove(self, id):
+        place = self.rows.pop(id, None)
+        if place:
+            if self.keys.get(place.key) == id:
+                del self.keys[place.key]
+            for parent_id in self.parent_ids.pop(id, ()):
+                self.subtrees.get(parent_id, set()).discard(id)
+
+    def _ensure_loaded(self):
+        if not self._loaded:
+            self.load()
+
+    def get(self, id):
+        """Returns the place with the given id.
+
+        The returned place is a copy and it is safe to modify it.
+        """
+        self._ensure_loaded()
+        with self._lock:
+            place = self.rows.get(id)
+        if place is None and id is not None:
+            # The place may have been added by another process.
+            self.refresh([id], propagate=False)
+            with self._lock:
+                place = self.rows.get(id)
+        return place and Place(place)
+
+    def get_many(self, ids):
+        """Returns a dict mapping id to place for all the given ids.
+
+        Places missing in the tree are loaded from the database in one query.
+        """
+        self._ensure_loaded()
+        ids = set(id for id in ids if id is not None)
+        with self._lock:
+            missing = [id for id in ids if id not in self.rows]
+        if missing:
+            self.refresh(missing, propagate=False)
+        return self.get_loaded(ids)
+
+    def get_loaded(self, ids):
+        """Returns a dict mapping id to place for the given ids, only for the
+        places that are in the tree, without loading the missing ones.
+        """
+        with self._lock:
+            return dict((id, Place(self.rows[id])) for id in ids if id in self.rows)
+
+    def find(self, key):
+        """Returns the place with the given key.
+        """
+        self._ensure_loaded()
+        with self._lock:
+            id = self.keys.get(key)
+        if id is None:
+            # The place may have been added by another process.
+            result = get_db().select("places", what="id", where="key=$key", vars=locals())
+            id = result and result[0].id
+        return id and self.get(id)
+
+    def get_all(self):
+        self._ensure_loaded()
+        with self._lock:
+            return [Place(p) for p in self.rows.values()]
+
+    def get_parents(self, id):
+        """Returns all the parents of the place with the given id, top-most first.
+        """
+        self._ensure_loaded()
+        with self._lock:
+            return [Place(self.rows[pid]) for pid in self.parent_ids.get(id, ()) if pid in self.rows]
+
+    def get_subtree_ids(self, id):
+        """Returns ids of all the places in the subtree of a place, excluding the place itself.
+        """
+        self._ensure_loaded()
+        with self._lock:
+            return list(self.subtrees.get(id, ()))
+
+    def get_subtree(self, id, type=None, order="key"):
+        """Returns all the places in the subtree of the place with the given
+        id, optionally of given type, sorted by the given field.
+        """
+        self._ensure_loaded()
+        cache_key = id, type, order
+        with self._lock:
+            places = self._sorted.get(cache_key)
+            if places is None:
+                places = [self.rows[i] for i in self.subtrees.get(id, ()) if i in self.rows]
+                if type is not None:
+                    places = [p for p in places if p.type == type]
+                places.sort(key=lambda p: p[order])
+                self._sorted[cache_key] = places
+            return [Place(p) for p in places]
+
+class ACL(web.storage):
+    """Roles of a user at various places, used to check permissions.
+
+    The roles are loaded once for a user and cached till the roles of the
+    user change, so that permission checks don't have to query the database.
+    """
+    # A user with a role at a place can view the place and all its parents
+    # of these types.
+    VIEWABLE_PARENT_TYPES = ["STATE", "REGION", "PC", "AC", "WARD"]
+
+    @staticmethod
+    def find(email):
+        """Returns the ACL of the user with the given email.
+        """
+        return ACL._find(email and email.lower())
+
+    @staticmethod
+    @cache.memoize(key="ACL.find", ttl=3600)
+    def _find(email):
+        roles = {}
+        viewable_ids = set()
+        if email:
+            result = get_db().query("SELECT place_id, role FROM people WHERE lower(email)=$email", vars=locals())
+            for row in result:
+                roles.setdefault(row.place_id, set()).add(row.role)
+        for place_id in roles:
+            place = Place.from_id(place_id)
+            if place:
+                viewable_ids.add(place.id)
+                viewable_ids.update(place[t.lower() + "_id"] for t in ACL.VIEWABLE_PARENT_TYPES)
+        viewable_ids.discard(None)
+        return ACL(email=email, roles=roles, viewable_ids=viewable_ids)
+
+    @staticmethod
+    def invalidate(email):
+        """Invalidates the cached ACL of the user with the given email.
+
+        Must be called whenever the roles of the user change.
+        """
+        if email:
+            cache.invalidate_cache("ACL.find", email.lower())
+
+    @staticmethod
+    def invalidate_places(place_ids):
+        """Invalidates the cached ACLs of all the people with a role at the
+        given places or in their subtrees.
+
+        Must be called whenever the parents of the places change, as the
+        places a user can view depend on the parents of the places of the
+        roles of the user.
+        """
+        place_ids = [id for id in place_ids if id]
+        if not place_ids:
+            return
         result = get_db().query(
-            "SELECT places.type, places.pc_id, places.ac_id, places.ward_id, places.name as place," +
-            " people.name as name, people.email, people.phone, people.voterid, people.role" +
-            " FROM people, places" +
-            " WHERE people.place_id=places.id AND role IN $roles AND places.type IN $types" +
-            " AND (places.%s=$self.id or places.id=$self.id)" % self.type_column +
-            " ORDER by place_id", vars=locals())
-        rows = sorted(result, key=lambda row: (row.pc_id, row.ac_id, row.ward_id))
-        for row in rows:
-            row.pc = row.pc_id and Place.from_id(row.pc_id).name or "-"
-            row.ac = row.ac_id and Place.from_id(row.ac_id).name or "-"
-            row.ward = row.ward_id and Place.from_id(row.ward_id).name or "-"
-            row.ward = row.ward_id and Place.from_id(row.ward_id).name or "-"
-            row.pb = "-"
-            row[row.type.lower()] = row.place
-
-        dataset = tablib.Dataset(headers=['Name', 'E-Mail', 'Phone', 'Voter ID', 'Role', 'Polling Booth', 'Ward', 'Assembly Constituency', 'Parliamentary Constituency'])
-        for row in rows:
-            dataset.append([row.name, row.email, row.phone, row.voterid, row.role, row.pb, row.ward, row.ac, row.pc])
-        return dataset
+            "SELECT DISTINCT lower(email) as email FROM people" +
+            " JOIN place_ancestors a ON a.place_id=people.place_id" +
+            " WHERE a.ancestor_id IN $place_ids AND email IS NOT NULL", vars=locals())
+        cache.invalidate_cache_many("ACL.find", [(row.email,) for row in result])
+
+    def has_role(self, place, roles):
+        """Returns True if the user has any of the given roles at the place
+        or any of its parents.
+        """
+        place_ids = [place.id, place.state_id, place.region_id, place.pc_id, place.ac_id, place.ward_id]
+        return any(self.roles.get(id, set()).intersection(roles) for id in place_ids if id)
+
+def _reset_caches():
+    cache.clear_all()
+    get_place_tree().reset()
+
+cachesync.register_handler("places", lambda ids: get_place_tree().refresh(ids, propagate=False))
+cachesync.register_handler("reset", _reset_caches)
+
+class PlaceStats(web.storage):
+    """Rollup of volunteer, agent and coverage counts of places.
+
+    The place_stats table has a row for every place and place type, with the
+    counts summed over all the places of that type in the subtree of the
+    place. The subtree of a place never has another place of the same type,
+    so the row of a place for its own type has the counts of the place alone.
+    Those rows are updated when people or coverage of a place change and the
+    difference is added to the rows of all its parents.
+    """
+    COLUMNS = [
+        "places",
+        "coordinators",
+        "volunteers",
+        "pb_agents",
+        "px_agents",
+        "confirmed_pb_agents",
+        "places_with_coordinators",
+        "places_with_pb_agents",
+        "places_with_px_agents",
+        "places_with_confirmed_pb_agents",
+        "covered_pxs",
+        "coverage"
+    ]
+
+    # key space of the advisory locks taken on places by update_places
+    LOCK_SPACE = 1
+
+    # Counts of each place without its subtree.
+    # {filter} and {places_filter} are replaced with conditions on place_id
+    # and places.id respectively.
+    OWN_STATS_QUERY = """
+        SELECT places.id as place_id, places.type, 1 as places,
+            coalesce(p.coordinators, 0) as coordinators,
+            coalesce(p.volunteers, 0) as volunteers,
+            coalesce(p.pb_agents, 0) as pb_agents,
+            coalesce(p.px_agents, 0) as px_agents,
+            coalesce(p.confirmed_pb_agents, 0) as confirmed_pb_agents,
+            (CASE WHEN p.coordinators > 0 THEN 1 ELSE 0 END) as places_with_coordinators,
+            (CASE WHEN p.pb_agents > 0 THEN 1 ELSE 0 END) as places_with_pb_agents,
+            (CASE WHEN p.px_agents > 0 THEN 1 ELSE 0 END) as places_with_px_agents,
+            (CASE WHEN p.confirmed_pb_agents > 0 THEN 1 ELSE 0 END) as places_with_confirmed_pb_agents,
+            (CASE WHEN places.type = 'PX' AND (p.px_agents > 0 OR EXISTS (
+                SELECT 1 FROM places pb, people
+                WHERE people.place_id=pb.id
+                    AND pb.px_id=places.id
+                    AND pb.type='PB'
+                    AND people.role='pb_agent'))
+                THEN 1 ELSE 0 END) as covered_pxs,
+            coalesce(c.coverage, 0) as coverage
+        FROM places
+        LEFT JOIN (
+            SELECT place_id,
+                count(CASE WHEN role='coordinator' THEN 1 END) as coordinators,
+                count(CASE WHEN role IN ('coordinator', 'volunteer') THEN 1 END) as volunteers,
+                count(CASE WHEN role='pb_agent' THEN 1 END) as pb_agents,
+                count(CASE WHEN role='px_agent' THEN 1 END) as px_agents,
+                count(CASE WHEN role='pb_agent' AND EXISTS (
+                    SELECT 1 FROM voterid_info WHERE voterid_info.voterid=people.voterid)
+                    THEN 1 END) as confirmed_pb_agents
+            FROM people
+            WHERE {filter}
+            GROUP BY place_id) p ON p.place_id=places.id
+        LEFT JOIN (
+            SELECT place_id, sum(count) as coverage
+            FROM coverage
+            WHERE {filter}
+            GROUP BY place_id) c ON c.place_id=places.id
+        WHERE {places_filter}
+        """
+
+    @staticmethod
+    def find(place_id):
+        """Returns the rollup rows of a place as a dict keyed by place type.
+        """
+        return PlaceStats.find_all([place_id]).get(place_id, {})
+
+    @staticmethod
+    def find_all(place_ids):
+        """Returns the rollup rows of the given places as a dict mapping
+        place id to a dict keyed by place type.
+        """
+        d = {}
+        if place_ids:
+            result = get_db().select("place_stats", where="place_id IN $place_ids", vars=locals())
+            for row in result:
+                d.setdefault(row.place_id, {})[row.type] = PlaceStats(row)
+        return d
+
+    @staticmethod
+    def summarize(rows):
+        """Converts the rollup rows of a place, keyed by type, into the counts
+        shown on the dashboard.
+
+        The return value has counts, volunteer_counts, agent_counts,
+        coverage_count and agent_counts2 fields.
+        """
+        zero = PlaceStats((c, 0) for c in PlaceStats.COLUMNS)
+        get = lambda type: rows.get(type, zero)
+        total = lambda column: sum(row[column] for row in rows.values())
+
+        total_pb_agents = total("pb_agents")
+        total_px_agents = total("px_agents")
+        pb, px, ward = get("PB"), get("PX"), get("WARD")
+
+        return web.storage(
+            counts=dict((t, row.places) for t, row in rows.items() if row.places),
+            volunteer_counts=dict((t, row.volunteers) for t, row in rows.items() if row.volunteers),
+            coverage_count=total("coverage"),
+            agent_counts=web.storage(
+                total=total_pb_agents,
+                confirmed=pb.confirmed_pb_agents,
+                confirmed_booths=pb.places_with_confirmed_pb_agents,
+                pending=total_pb_agents - pb.confirmed_pb_agents),
+            agent_counts2=web.storage({
+                "assigned_pb_agents": pb.pb_agents,
+                "assigned_pbs": pb.places_with_pb_agents,
+                "unassigned_pb_agents": total_pb_agents - pb.pb_agents,
+                "assigned_px_agents": px.px_agents,
+                "unassigned_px_agents": total_px_agents - px.px_agents,
+                "assigned_pxs": px.places_with_px_agents,
+                "assigned_pxs_including_pbs": px.covered_pxs,
+
+                "assigned_ward_coordinators": ward.coordinators,
+                "assigned_wards": ward.places_with_coordinators,
+            }))
+
+    @staticmethod
+    def update_places(place_ids):
+        """Updates the rollup after people or coverage of the given places
+        have changed.
+
+        The counts of each place are recomputed and the difference from the
+        previous counts is added to the place and all its parents.
+
+        Concurrent updates of the same place are serialized with an advisory
+        lock on the place, which works even when the place has no row yet.
+        Otherwise both would compute their difference from the same previous
+        counts and add it twice.
+        """
+        place_ids = list(set(id for id in place_ids if id))
+        if not place_ids:
+            return
+
+        db = get_db()
+        with db.transaction():
+            places = [Place(row) for row in db.select("places", where="id IN $place_ids", vars=locals())]
+
+            # A polling center is covered when any of its booths has an agent
+            px_ids = list(set(p.px_id for p in places if p.type == 'PB' and p.px_id and p.px_id not in place_ids))
+            if px_ids:
+                places += [Place(row) for row in db.select("places", where="id IN $px_ids", vars=locals())]
+                place_ids += px_ids
+
+            # the places are locked in the order of ids to avoid deadlocks
+            lock_space = PlaceStats.LOCK_SPACE
+            db.query(
+                "SELECT pg_advisory_xact_lock($lock_space, id)" +
+                " FROM (SELECT id FROM places WHERE id IN $place_ids ORDER BY id) p", vars=locals()).list()
+
+            old = dict((row.place_id, row) for row in db.query(
+                "SELECT place_stats.* FROM place_stats, places" +
+                " WHERE place_stats.place_id=places.id" +
+                "   AND place_stats.type=places.type" +
+                "   AND places.id IN $place_ids", vars=locals()))
+            new = dict((row.place_id, row) for row in PlaceStats._query_own_stats(place_ids))
+
+            deltas = []
+            for place in places:
+                old_row = old.get(place.id, {})
+                new_row = new[place.id]
+                delta = [new_row[c] - old_row.get(c, 0) for c in PlaceStats.COLUMNS]
+                if any(delta):
+                    for id in [place.id] + place.get_parent_ids():
+                        deltas.append([id, place.type] + delta)
+            PlaceStats._add(deltas)
+
+    @staticmethod
+    def recompute(place_ids):
+        """Recomputes the rollup rows of the given places from the rows of
+        the places in their subtrees.
+
+        This is required when places are moved from one parent to another.
+        """
+        db = get_db()
+        with db.transaction():
+            for id in set(id for id in place_ids if id):
+                place = Place.from_id(id)
+                if not place or place.type == "PB":
+                    continue
+                db.delete("place_stats", where="place_id=$id AND type != $place.type", vars=locals())
+                db.query(
+                    "INSERT INTO place_stats (place_id, type, {0})".format(", ".join(PlaceStats.COLUMNS)) +
+                    " SELECT $id, s.type, {0}".format(", ".join("sum(s.%s)" % c for c in PlaceStats.COLUMNS)) +
+                    " FROM places, place_stats s, place_ancestors a" +
+                    " WHERE s.place_id=places.id AND s.type=places.type" +
+                    "   AND a.place_id=places.id AND a.ancestor_id=$id AND places.id != $id" +
+                    " GROUP BY s.type", vars=locals())
+
+    @staticmethod
+    def rebuild():
+        """Recomputes the whole rollup from scratch.
+        """
+        db = get_db()
+        with db.transaction():
+            db.query("DELETE FROM place_stats")
+            PlaceStats._build("place_stats")
+
+    @staticmethod
+    def check():
+        """Compares the rollup with the counts computed from scratch.
+
+        Returns the list of rows which differ, each with place_id, type and
+        the stored and expected values of every column that differs.
+        """
+        db = get_db()
+        drift = []
+        with db.transaction():
+            db.query("CREATE TEMP TABLE expected_place_stats (LIKE place_stats) ON COMMIT DROP")
+            PlaceStats._build("expected_place_stats")
+
+            columns = ", ".join("coalesce(s.{0}, 0) as {0}, coalesce(e.{0}, 0) as expected_{0}".format(c) for c in PlaceStats.COLUMNS)
+            result = db.query(
+                "SELECT coalesce(s.place_id, e.place_id) as place_id, coalesce(s.type, e.type) as type, " + columns +
+                " FROM place_stats s" +
+                " FULL OUTER JOIN expected_place_stats e ON e.place_id=s.place_id AND e.type=s.type")
+            for row in result:
+                diff = dict((c, (row[c], row['expected_' + c])) for c in PlaceStats.COLUMNS if row[c] != row['expected_' + c])
+                if diff:
+                    drift.append(web.storage(place_id=row.place_id, type=row.type, diff=diff))
+        return drift
+
+    @staticmethod
+    def _query_own_stats(place_ids):
+        query = PlaceStats.OWN_STATS_QUERY.format(filter="place_id IN $place_ids", places_filter="places.id IN $place_ids")
+        return get_db().query(query, vars=locals())
+
+    @staticmethod
+    def _build(table):
+        """Computes the rollup of all places from scratch into the given table.
+        """
+        db = get_db()
+        columns = ", ".join(PlaceStats.COLUMNS)
+        query = PlaceStats.OWN_STATS_QUERY.format(filter="true", places_filter="true")
+        db.query("INSERT INTO {0} (place_id, type, {1}) SELECT place_id, type, {1} FROM ({2}) as t".format(table, columns, query))
+
+        sums = ", ".join("sum(s.%s)" % c for c in PlaceStats.COLUMNS)
+        for type, column in Place.COLUMN_NAMES.items():
+            db.query(
+                "INSERT INTO {0} (place_id, type, {1})".format(table, columns) +
+                " SELECT places.{0}, s.type, {1}".format(column, sums) +
+                " FROM places, {0} s".format(table) +
+                " WHERE s.place_id=places.id AND s.type=places.type" +
+                "   AND places.{0} IS NOT NULL".format(column) +
+                " GROUP BY 1, 2")
+
+    @staticmethod
+    def _add(rows):
+        """Adds the given counts to the rollup.
+
+        Each row is a list of place_id, type and a value for each column.
+        """
+        if not rows:
+            return
+        columns = ", ".join(PlaceStats.COLUMNS)
+        values = web.SQLQuery.join([web.SQLQuery.join([web.sqlparam(v) for v in row], ", ", prefix="(", suffix=")") for row in rows], ", ")
+        updates = ", ".join("{0}=place_stats.{0} + EXCLUDED.{0}".format(c) for c in PlaceStats.COLUMNS)
+        query = (
+            web.SQLQuery("INSERT INTO place_stats (place_id, type, {0}) VALUES ".format(columns)) +
+            values +
+            " ON CONFLICT (place_id, type) DO UPDATE SET " + updates)
+        get_db().query(query)
 
 def get_voterid_details(voterid, fetch=False):
     if voterid:
@@ -824,17 +1506,155 @@ def get_voterid_details(voterid, fetch=False):
         if rows:
             return rows[0]
         if fetch:
-            d = voterlib.get_voter_details(voterid)
+            d = VoterLookup.get(voterid)
             if d:
-                key = "KA/AC{0:03d}/PB{1:04d}".format(int(d.ac_num), int(d.part_no))
-                d.pb_id = Place.find(key).id
-                get_db().insert("voterid_info", **d)
+                _add_voterid_info(d)
                 return d
 
+def _add_voterid_info(d):
+    """Adds the voter details fetched from the voter search service to voterid_info.
+    """
+    key = "KA/AC{0:03d}/PB{1:04d}".format(int(d.ac_num), int(d.part_no))
+    d.pb_id = Place.find(key).id
+    get_db().insert("voterid_info", **d)
+    _update_voterid_stats(d.voterid)
+
+def add_voterid_info_many(details):
+    """Adds the voter details of many voters to voterid_info, using a multi-row
+    insert, and updates the stats of the affected places once.
+    """
+    rows = []
+    for d in details:
+        key = "KA/AC{0:03d}/PB{1:04d}".format(int(d.ac_num), int(d.part_no))
+        pb = Place.find(key)
+        rows.append(dict(d, pb_id=pb and pb.id))
+    if not rows:
+        return
+    voterids = [d['voterid'] for d in rows]
+    db = get_db()
+    with db.transaction():
+        # skip the voterids added while we were fetching the voter details
+        result = db.query("SELECT voterid FROM voterid_info WHERE voterid IN $voterids", vars=locals())
+        existing = set(row.voterid for row in result)
+        rows = [d for d in rows if d['voterid'] not in existing]
+        if rows:
+            db.multiple_insert("voterid_info", rows)
+    result = get_db().query("SELECT DISTINCT place_id FROM people WHERE voterid IN $voterids", vars=locals())
+    place_ids = [row.place_id for row in result]
+    PlaceStats.update_places(place_ids)
+    Place.invalidate_object_caches(place_ids)
+
+class VoterLookup:
+    """Cache of the voter details looked up from the voter search service.
+
+    Both the found and the not-found results are cached in the voterid_lookup
+    table, so that the same voterid is not looked up again till the result
+    expires. Failed lookups are not cached.
+    """
+    # time in seconds to cache found and not-found results
+    FOUND_TTL = 30 * 24 * 3600
+    NOT_FOUND_TTL = 24 * 3600
+
+    @staticmethod
+    def get(voterid):
+        """Returns the voter details of the given voterid or None if there is no
+        such voter.
+
+        Raises voterlib.VoterLookupError when the voter search service fails.
+        """
+        cached = VoterLookup._find_cached([voterid])
+        if voterid in cached:
+            return cached[voterid]
+        d = voterlib.get_voter_details(voterid)
+        VoterLookup._save({voterid: d})
+        return d
+
+    @staticmethod
+    def get_many(voterids):
+        """Returns a dict mapping voterid to voter details, or None if there is no
+        such voter, for all the given voterids.
+
+        The voterids that are not in the cache are looked up in parallel. The
+        voterids that could not be looked up are left out.
+        """
+        voterids = list(set(v for v in voterids if v))
+        d = VoterLookup._find_cached(voterids)
+        missing = [v for v in voterids if v not in d]
+        if missing:
+            fetched = voterlib.get_voter_details_many(missing)
+            VoterLookup._save(fetched)
+            d.update(fetched)
+        return d
+
+    @staticmethod
+    def _find_cached(voterids):
+        d = {}
+        if voterids:
+            result = get_db().query(
+                "SELECT voterid, data FROM voterid_lookup" +
+                " WHERE voterid IN $voterids AND expires > (current_timestamp at time zone 'UTC')",
+                vars=locals())
+            for row in result:
+                d[row.voterid] = row.data and web.storage(json.loads(row.data))
+        return d
+
+    @staticmethod
+    def _save(results):
+        """Saves the given results, a dict mapping voterid to voter details or
+        None, in the cache.
+        """
+        if not results:
+            return
+        now = datetime.datetime.utcnow()
+        values = []
+        for voterid, d in results.items():
+            ttl = VoterLookup.FOUND_TTL if d else VoterLookup.NOT_FOUND_TTL
+            expires = now + datetime.timedelta(seconds=ttl)
+            data = d and json.dumps(d)
+            values.append(web.reparam("($voterid, $data, $expires)", locals()))
+        get_db().query(
+            "INSERT INTO voterid_lookup (voterid, data, expires) VALUES " +
+            web.SQLQuery.join(values, ", ") +
+            " ON CONFLICT (voterid) DO UPDATE SET data=excluded.data, expires=excluded.expires")
+
+def _update_voterid_stats(voterid):
+    """Updates the place stats of all the people with the given voterid,
+    after the voterid info of that voterid is added.
+    """
+    result = get_db().query("SELECT DISTINCT place_id FROM people WHERE voterid=$voterid", vars=locals())
+    place_ids = [row.place_id for row in result]
+    PlaceStats.update_places(place_ids)
+    for id in place_ids:
+        place = id and Place.from_id(id)
+        if place:
+            place._invalidate_object_cache()
+
 class Person(web.storage):
     @property
     def place(self):
-        return Place.from_id(self.place_id)
+        place = self.get("_place")
+        if place is None or place.id != self.place_id:
+            place = Place.from_id(self.place_id)
+        return place
+
+    @staticmethod
+    def prefetch(people):
+        """Loads the places and the voterid info of all the given people
+        and attaches them to the people objects.
+
+        This avoids querying the database for every person when rendering
+        a list of people. Returns the given list.
+        """
+        places = get_place_tree().get_many(p.place_id for p in people)
+        voterids = list(set(p.voterid for p in people if p.voterid))
+        info = {}
+        if voterids:
+            result = get_db().query("SELECT * FROM voterid_info WHERE voterid IN $voterids", vars=locals())
+            info = dict((row.voterid, row) for row in result)
+        for p in people:
+            p._place = places.get(p.place_id)
+            p._voterid_info = info.get(p.voterid)
+        return people
 
     def get_url(self):
         return self.place.get_url() + "/people/%d" % self.id
@@ -847,22 +1667,31 @@ class Person(web.storage):
             return [Person(row) for row in result]
 
     def get_voterid_info(self):
+        if "_voterid_info" in self:
+            return self._voterid_info
         return get_voterid_details(self.voterid)
 
     def populate_voterid_info(self):
         d = self.get_voterid_info()
         if self.voterid and not d:
-            d = voterlib.get_voter_details(self.voterid)
+            d = VoterLookup.get(self.voterid)
             # The voter ID might have been added while we are fetching the voter details.
             # Usually happens when user press save button twice.
-            if d and not self.get_voterid_info():
-                key = "KA/AC{0:03d}/PB{1:04d}".format(int(d.ac_num), int(d.part_no))
-                d.pb_id = Place.find(key).id
-                get_db().insert("voterid_info", **d)
+            if d and not get_voterid_details(self.voterid):
+                _add_voterid_info(d)
+                self.pop("_voterid_info", None)
         if d and d.get('pb_id') and self.role == "pb_agent" and self.place_id != d.pb_id:
             self.update(place_id=d.pb_id)
             logger.info("Reassigned %s <%s> as %s to %s", self.name, self.email, self.role, self.place.key)
 
+    def enqueue_voterid_info(self, notify=False):
+        """Adds a job to populate the voterid info of this person in the background.
+
+        If notify is True, the person is emailed about the status of the voterid
+        once the voterid info is populated.
+        """
+        jobs.enqueue("voterid-info", key="voterid-info/%d" % self.id, person_id=self.id, notify=notify)
+
     def get_agent_status(self):
         """Return one of [None, "pending", "verified", mismatch"].
         """
@@ -951,6 +1780,8 @@ class Person(web.storage):
         if values:
             web.storage.update(self, values)
         web.storage.update(self, kwargs)
+        if self.voterid != old_self.voterid:
+            self.pop("_voterid_info", None)
 
         # invalidate cache before and after as the place can change.
         self.place._invalidate_object_cache()
@@ -961,12 +1792,18 @@ class Person(web.storage):
             phone=self.phone,
             voterid=self.voterid,
             role=self.role)
+        PlaceStats.update_places([old_self.place_id, self.place_id])
+        ACL.invalidate(old_self.email)
+        ACL.invalidate(self.email)
         self.place._invalidate_object_cache()
         if self.voterid and old_self.voterid != self.voterid:
             self.place.record_activity("voterid-added", volunteer_id=self.id, voterid=self.voterid)
         if old_self.place_id != self.place.id:
             old_self.place._invalidate_object_cache()
-        self.populate_voterid_info()
+        if self.voterid and not self.get_voterid_info():
+            self.enqueue_voterid_info()
+        else:
+            self.populate_voterid_info()
 
     def delete(self):
         db = get_db()
@@ -976,6 +1813,8 @@ class Person(web.storage):
             db.delete("activity", where="person_id=$self.id", vars=locals())
             db.delete("invite", where="person_id=$self.id", vars=locals())
             db.delete("people", where="id=$self.id", vars=locals())
+            PlaceStats.update_places([place.id])
+        ACL.invalidate(self.email)
         place._invalidate_object_cache()
 
     def dict(self):
@@ -995,10 +1834,14 @@ class Person(web.storage):
 class Message(web.storage):
     @property
     def place(self):
+        if "_place" in self:
+            return self._place
         return Place.from_id(self.place_id)
 
     @property
     def author(self):
+        if "_author" in self:
+            return self._author
         return Person.find_by_id(self.author_id)
 
     @property
@@ -1013,19 +1856,40 @@ class Message(web.storage):
             "message": message
         }
         message_id = get_db().insert("messages", **d)
-        return Message.find(message_id)
+        return Message.by_id(message_id)
 
     @staticmethod
-    def find(place_id=None, limit=10):
+    def find(place_id=None, limit=10, before=None):
+        """Returns the latest messages posted to the given place or places,
+        paginated by (tstamp, id).
+        """
         wheres = []
         if place_id and isinstance(place_id, list):
             wheres.append("place_id IN $place_id")
         else:
             wheres.append("place_id = $place_id")
+        if before:
+            wheres.append("(tstamp, id) < (SELECT tstamp, id FROM messages WHERE id=$before)")
 
         where = " AND ".join(wheres)
-        result = get_db().select("messages", where=where, order="tstamp desc", vars=locals())
-        return [Message(row) for row in result]
+        result = get_db().select("messages", where=where, order="tstamp desc, id desc", limit=limit, vars=locals())
+        return Message.prefetch([Message(row) for row in result])
+
+    @staticmethod
+    def prefetch(messages):
+        """Loads the authors and places of the given messages and attaches them
+        to the message objects. Returns the given list.
+        """
+        author_ids = list(set(m.author_id for m in messages if m.author_id))
+        authors = {}
+        if author_ids:
+            result = get_db().select("people", where="id IN $author_ids", vars=locals())
+            authors = dict((row.id, Person(row)) for row in result)
+        places = get_place_tree().get_many(m.place_id for m in messages)
+        for m in messages:
+            m._author = authors.get(m.author_id)
+            m._place = places.get(m.place_id)
+        return messages
 
     @staticmethod
     def by_id(message_id):
@@ -1037,15 +1901,41 @@ class Activity(web.storage):
     def get_place(self):
         return Place.from_id(self.place_id)
 
+    def _find_person(self, id):
+        if "_people" in self:
+            return self._people.get(id)
+        return Person.find_by_id(id)
+
     def get_person(self):
-        return Person.find_by_id(self.person_id)
+        return self._find_person(self.person_id)
 
     def get_data(self):
-        return web.storage(json.loads(self['data']))
+        if "_data" not in self:
+            self._data = web.storage(json.loads(self['data']))
+        return self._data
 
     def get_volunteer(self):
         vid = self.get_data().get("volunteer_id")
-        return vid and Person.find_by_id(vid)
+        return vid and self._find_person(vid)
+
+    @staticmethod
+    def prefetch(activities):
+        """Loads the people referred by the given activities in a single query
+        and attaches them to the activity objects. Returns the given list.
+        """
+        ids = set()
+        for a in activities:
+            ids.add(a.person_id)
+            ids.add(a.get_data().get("volunteer_id"))
+        ids = [id for id in ids if id]
+        people = {}
+        if ids:
+            result = get_db().select("people", where="id IN $ids", vars=locals())
+            people = dict((row.id, Person(row)) for row in result)
+            Person.prefetch(people.values())
+        for a in activities:
+            a._people = people
+        return activities
 
     def get_volunteer_name(self):
         return self.get_data()['volunteer_name']
@@ -1053,6 +1943,24 @@ class Activity(web.storage):
     def get_coverage_count(self):
         return self.get_data()['count']
 
+    @staticmethod
+    def record_many(event_type, rows):
+        """Records an activity for each of the given rows, using a multi-row insert.
+
+        Each row is a dict with place_id and the data of the activity.
+        """
+        import account
+        who = account.get_current_user()
+        who_id = who and who.id
+
+        values = []
+        for row in rows:
+            data = dict(row)
+            place_id = data.pop('place_id')
+            values.append(dict(type=event_type, place_id=place_id, person_id=who_id, data=json.dumps(data)))
+        if values:
+            get_db().multiple_insert("activity", values)
+
     @staticmethod
     def record(event_type, place_id, **kwargs):
         import account
@@ -1193,7 +2101,6 @@ class Invite(web.storage):
                     role='pb_agent',
                     notes=self.batch)
             self.add_person_id(agent.id)
-            agent.populate_voterid_info()
             return agent
 
     def __repr__(self):
@@ -1263,6 +2170,16 @@ class SendMailBatch(web.storage):
             vars=locals())
         return [SendMailMessage(row) for row in rows]
 
+    def mark_unsubscribed(self):
+        """Marks the pending messages to the addresses that have unsubscribed
+        as unsubscribed. Returns the number of such messages.
+        """
+        return get_db().query(
+            "UPDATE sendmail_message SET status='unsubscribed'" +
+            " WHERE batch_id=$self.id AND status='pending'" +
+            "   AND EXISTS (SELECT 1 FROM unsubscribe WHERE lower(unsubscribe.email)=lower(sendmail_message.to_address))",
+            vars=locals())
+
     def get_stats(self):
         result = get_db().query(
             "SELECT status, count(*) as count" +
@@ -1278,3 +2195,156 @@ class SendMailMessage(web.storage):
     def set_status(self, status):
         get_db().update("sendmail_message", where="id=$id", status=status, vars=self)
         self.status = status
+
+    @staticmethod
+    def set_status_many(ids, status):
+        """Sets the status of all the messages with the given ids, in a single query.
+        """
+        if ids:
+            get_db().update("sendmail_message", where="id IN $ids", status=status, vars=locals())
+
+class Unsubscribe:
+    """Registry of the email addresses that have unsubscribed from our emails.
+
+    Emails are stored lowercased. The set of all the addresses is cached in
+    the process and invalidated, in all processes, when an address is added.
+    """
+    @staticmethod
+    def normalize(email):
+        return (email or "").strip().lower()
+
+    @staticmethod
+    def add(email):
+        email = Unsubscribe.normalize(email)
+        get_db().query(
+            "INSERT INTO unsubscribe (email) VALUES ($email)" +
+            " ON CONFLICT (lower(email)) DO NOTHING", vars=locals())
+        cache.invalidate_cache("Unsubscribe.get_all")
+
+    @staticmethod
+    @cache.memoize(key="Unsubscribe.get_all", ttl=3600)
+    def get_all():
+        """Returns the set of all the unsubscribed email addresses, lowercased.
+        """
+        return frozenset(row.email for row in get_db().query("SELECT lower(email) as email FROM unsubscribe"))
+
+    @staticmethod
+    def is_unsubscribed(email):
+        return Unsubscribe.normalize(email) in Unsubscribe.get_all()
+
+class SendLedger:
+    """Record of the emails sent to each address, by template.
+
+    Used to avoid sending the same email to an address more than once, or more
+    than once in some hours. Emails are stored lowercased.
+    """
+    @staticmethod
+    def _cutoff(hours):
+        if hours is None:
+            return None
+        return datetime.datetime.utcnow() - datetime.timedelta(hours=hours)
+
+    @staticmethod
+    def claim(template, email, hours=None):
+        """Records that the email with the given template is being sent to the
+        address, unless it was already sent to the address in the last hours,
+        or ever when hours is None.
+
+        Returns True if the email can be sent. The check and the update are
+        done in a single query, so concurrent senders can't both claim it.
+        """
+        email = email.lower()
+        cutoff = SendLedger._cutoff(hours)
+        if cutoff is None:
+            on_conflict = " ON CONFLICT (template, email) DO NOTHING"
+        else:
+            on_conflict = (
+                " ON CONFLICT (template, email) DO UPDATE SET sent_on=excluded.sent_on" +
+                " WHERE send_ledger.sent_on < $cutoff")
+        result = get_db().query(
+            "INSERT INTO send_ledger (template, email) VALUES ($template, $email)" +
+            on_conflict +
+            " RETURNING email", vars=locals())
+        return bool(result.list())
+
+    @staticmethod
+    def release(template, email):
+        """Removes the record of sending the email, when sending it has failed.
+        """
+        email = email.lower()
+        get_db().query("DELETE FROM send_ledger WHERE template=$template AND email=$email", vars=locals())
+
+    @staticmethod
+    def filter_unsent(template, emails, hours=None):
+        """Returns the addresses among the given ones that the email with the
+        given template was not sent to in the last hours, or ever when hours
+        is None. The addresses are checked in a single query.
+        """
+        emails = [e for e in emails if e]
+        lowered = list(set(e.lower() for e in emails))
+        if not lowered:
+            return []
+        cutoff = SendLedger._cutoff(hours)
+        query = "SELECT email FROM send_ledger WHERE template=$template AND email IN $lowered"
+        if cutoff is not None:
+            query += " AND sent_on >= $cutoff"
+        sent = set(row.email for row in get_db().query(query, vars=locals()))
+        return [e for e in emails if e.lower() not in sent]
+
+class SMSBatch(web.storage):
+    """An SMS sent to many phones. The status of every phone is kept in sms_log.
+    """
+    @staticmethod
+    def find(id):
+        result = get_db().where("sms_batch", id=id)
+        if result:
+            return SMSBatch(result[0])
+
+    @staticmethod
+    def new(message, phones):
+        db = get_db()
+        with db.transaction():
+            id = db.insert("sms_batch", message=message)
+            values = [{"batch_id": id, "phone": phone} for phone in set(phones)]
+            if values:
+                db.multiple_insert("sms_log", values, seqname=False)
+        return SMSBatch.find(id)
+
+    @staticmethod
+    def find_incomplete():
+        """Returns all the batches that are not sent to some of their phones.
+        """
+        result = get_db().query(
+            "SELECT * FROM sms_batch WHERE id IN" +
+            " (SELECT DISTINCT batch_id FROM sms_log WHERE status != 'sent' AND status != 'unknown')" +
+            " ORDER BY id")
+        return [SMSBatch(row) for row in result]
+
+    def get_unsent_phones(self):
+        """Returns the phones the SMS has to be sent to, leaving out the phones
+        it was sent to and those it may have been sent to.
+        """
+        result = get_db().query(
+            "SELECT phone FROM sms_log" +
+            " WHERE batch_id=$self.id AND status != 'sent' AND status != 'unknown'" +
+            " ORDER BY phone", vars=locals())
+        return [row.phone for row in result]
+
+    def set_status(self, phones, status, response=None):
+        """Sets the status of the given phones, in a single query.
+        """
+        get_db().query(
+            "UPDATE sms_log SET status=$status, response=$response," +
+            " tstamp=(current_timestamp at time zone 'UTC')" +
+            " WHERE batch_id=$self.id AND phone IN $phones", vars=locals())
+
+    def get_stats(self):
+        result = get_db().query(
+            "SELECT status, count(*) as count" +
+            " FROM sms_log" +
+            " WHERE batch_id=$id" +
+            " GROUP BY status",
+            vars=self)
+        stats = web.storage((row.status, row.count) for row in result)
+        stats.total = sum(stats.values())
+        return stats
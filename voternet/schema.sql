@@ -28,6 +28,17 @@ create index places_ac_id_idx on places(ac_id);
 create index places_ward_id_idx on places(ward_id);
 create index places_px_id_idx on places(px_id);
 
+-- The ancestors of every place, including the place itself, derived from the
+-- state_id, region_id, pc_id, ac_id, ward_id and px_id columns. All the places
+-- in the subtree of a place are found with a single index scan on ancestor_id.
+create table place_ancestors (
+    ancestor_id integer references places on delete cascade,
+    place_id integer references places on delete cascade,
+    primary key (ancestor_id, place_id)
+);
+
+create index place_ancestors_place_id_idx on place_ancestors(place_id);
+
 
 create table things (
     id serial primary key,
@@ -56,6 +67,22 @@ create table people (
 
 create index people_place_id_idx on people(place_id);
 create index people_email_idx on people(email);
+create index people_lower_email_idx on people(lower(email));
+
+-- Indexes for searching people by fragments of name, email, phone and voter ID.
+-- normalize_phone keeps only the digits of a phone number and removes the +91
+-- prefix, like utils.process_phone.
+create extension if not exists pg_trgm;
+
+create function normalize_phone(phone text) returns text as
+    'select case when length(d) = 12 and d like ''91%'' then substr(d, 3) else d end
+     from (select regexp_replace(phone, ''[^0-9]'', '''', ''g'') as d) t'
+    language sql immutable;
+
+create index people_name_trgm_idx on people using gin (lower(name) gin_trgm_ops);
+create index people_email_trgm_idx on people using gin (lower(email) gin_trgm_ops);
+create index people_phone_trgm_idx on people using gin (normalize_phone(phone) gin_trgm_ops);
+create index people_voterid_trgm_idx on people using gin (lower(voterid) gin_trgm_ops);
 
 create table auth (
     id serial primary key,
@@ -86,9 +113,9 @@ create table activity (
 );
 
 create index activity_type_idx on activity(type);
-create index activity_place_id_idx on activity(place_id);
+create index activity_place_id_tstamp_idx on activity(place_id, tstamp, id);
 create index activity_person_id_idx on activity(person_id);
-create index activity_tstamp_idx on activity(tstamp);
+create index activity_tstamp_id_idx on activity(tstamp, id);
 
 create table messages (
     id serial primary key,
@@ -98,7 +125,7 @@ create table messages (
     tstamp timestamp default (current_timestamp at time zone 'UTC')
 );
 
-create index messages_place_id_idx on messages(place_id);
+create index messages_place_id_tstamp_idx on messages(place_id, tstamp, id);
 create index messages_author_id_idx on messages(author_id);
 
 create table unsubscribe (
@@ -107,6 +134,8 @@ create table unsubscribe (
     tstamp timestamp default (current_timestamp at time zone 'UTC')
 );
 
+create unique index unsubscribe_lower_email_idx on unsubscribe(lower(email));
+
 -- signup invites for people who might be interested
 create table invite (
     id serial primary key,
@@ -176,6 +205,63 @@ create table voterid_info (
     sex text
 );
 
+-- queue of background jobs, run by the workers started with actions.py run_jobs
+create table jobs (
+    id serial primary key,
+    name text,
+    -- only one pending job can have the same key
+    key text,
+    args text,
+    status text default 'pending', -- pending, running, done, failed, merged (into a pending job with the same key)
+    priority integer default 0,
+    attempts integer default 0,
+    max_attempts integer default 3,
+    error text,
+    created timestamp default (current_timestamp at time zone 'UTC'),
+    run_at timestamp default (current_timestamp at time zone 'UTC'),
+    started timestamp,
+    -- updated periodically by the worker while the job is running
+    heartbeat timestamp,
+    finished timestamp
+);
+
+create index jobs_pending_idx on jobs(priority desc, id) where status='pending';
+create index jobs_status_idx on jobs(status);
+create unique index jobs_pending_key_idx on jobs(key) where status='pending';
+
+-- emails sent to each address, by template. emails are lowercased.
+create table send_ledger (
+    template text,
+    email text,
+    sent_on timestamp default (current_timestamp at time zone 'UTC'),
+    primary key (template, email)
+);
+
+create table sms_batch (
+    id serial primary key,
+    message text,
+    created timestamp default (current_timestamp at time zone 'UTC')
+);
+
+create table sms_log (
+    batch_id integer references sms_batch,
+    phone text,
+    status text default 'pending', -- pending, sent, failed, unknown (may have been sent)
+    response text,
+    tstamp timestamp default (current_timestamp at time zone 'UTC'),
+    primary key (batch_id, phone)
+);
+
+create index sms_log_unsent_idx on sms_log(batch_id) where status != 'sent';
+
+-- voter details looked up from the voter search service.
+-- data is null when the voterid is not found.
+create table voterid_lookup (
+    voterid text primary key,
+    data text,
+    expires timestamp
+);
+
 create table signup (
     id serial primary key,
     place_id integer references places(id),
@@ -186,3 +272,24 @@ create table signup (
     timestamp timestamp default current_timestamp,
     data JSON
 );
+
+-- rollup of counts of each place, maintained by models.PlaceStats.
+-- There is a row for every place and place type, with the counts summed
+-- over all the places of that type in the subtree of the place.
+create table place_stats (
+    place_id integer references places on delete cascade,
+    type place_type,
+    places integer default 0,
+    coordinators integer default 0,
+    volunteers integer default 0,
+    pb_agents integer default 0,
+    px_agents integer default 0,
+    confirmed_pb_agents integer default 0,
+    places_with_coordinators integer default 0,
+    places_with_pb_agents integer default 0,
+    places_with_px_agents integer default 0,
+    places_with_confirmed_pb_agents integer default 0,
+    covered_pxs integer default 0,
+    coverage integer default 0,
+    primary key (place_id, type)
+);
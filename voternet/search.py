@@ -1,56 +1,304 @@
-try:
-    import xappy
-except ImportError:
-    xappy = None
-    print "WARNING: unable to import xappy, search functionality will not work."
+"""In-memory search index of places.
+
+The index is built from the place tree, in well under a second for all the
+places of a state, and kept in memory by every process. It is updated
+incrementally whenever places are added, renamed, moved or deleted, in this
+process or in any other, as the place tree notifies it of the changes.
+
+To see how long it takes to build the index:
+
+    python voternet/search.py config.yml
+
+Places are matched by the words of their name, their code and the parts of
+their key. Every word of the query has to match a word of the place, either
+exactly, as a prefix or, when neither matches any place, by the trigrams the
+words share, to allow for misspellings. The places are ranked by how well
+they match, then by type, the larger places first, and then by name.
+"""
+import re
+import time
+import heapq
+import bisect
+import logging
+import threading
 
 import models
-from web import config
 
-def search(s, page=0):
-    if not xappy:
-        return 0, []
+logger = logging.getLogger(__name__)
+
+# scores of the ways a word of the query can match a word of a place
+EXACT_SCORE = 3
+PREFIX_SCORE = 2
+FUZZY_SCORE = 1
+
+# score for matching the whole key or code of a place
+KEY_SCORE = 10
+
+# minimum trigram similarity for a fuzzy match
+FUZZY_THRESHOLD = 0.4
+
+TYPE_RANKS = dict((type, i) for i, type in enumerate(models.Place.TYPES))
+
+re_word = re.compile("[a-z0-9]+")
+re_code_number = re.compile("^[a-z]*0*([0-9]+)$")
+
+def tokenize(text):
+    """Returns the lowercase words of the text.
+    """
+    return re_word.findall((text or "").lower())
+
+def get_trigrams(word):
+    """Returns the trigrams of the word, padded like pg_trgm does.
+    """
+    w = "  " + word + " "
+    return set(w[i:i+3] for i in range(len(w)-2))
+
+def get_place_tokens(place):
+    """Returns the words a place can be found with.
+    """
+    tokens = set(tokenize(place.name))
+    tokens.update(tokenize(place.code))
+    tokens.update(tokenize(place.key))
+    # AC150 is found with 150 and PB0012 with 12
+    for token in tokenize(place.code):
+        m = re_code_number.match(token)
+        if m:
+            tokens.add(m.group(1))
+    return tokens
+
+def get_place_keys(place):
+    """Returns the lowercase key and code of the place.
+    """
+    return set(k.lower() for k in [place.key, place.code] if k)
+
+class PlaceIndex:
+    """Search index of a set of places.
+
+    The index is built in bulk using build and kept up to date using update.
+    """
+    def __init__(self):
+        self._lock = threading.RLock()
+        # token -> set of place ids
+        self.token_ids = {}
+        # lowercase key or code -> set of place ids
+        self.key_ids = {}
+        # trigram -> set of tokens
+        self.trigram_tokens = {}
+        # all tokens, sorted, for prefix search
+        self.sorted_tokens = []
+        # place id -> sort key of the place, used for ranking
+        self.sort_keys = {}
+        # place id -> (tokens, keys) of the place, to remove it from the index
+        self.place_entries = {}
 
-    conn = xappy.SearchConnection(config.search_db)
+    def build(self, places):
+        """Adds all the places to the index.
 
-    # disable spell corrector.
-    # It was converting PB0119 to PB0019.
+        Returns the number of places indexed per second.
+        """
+        t0 = time.time()
+        with self._lock:
+            for place in places:
+                self._add_entries(place)
+            for token in self.token_ids:
+                for trigram in get_trigrams(token):
+                    self.trigram_tokens.setdefault(trigram, set()).add(token)
+            self.sorted_tokens = sorted(self.token_ids)
+        elapsed = time.time() - t0
+        return len(places) / max(elapsed, 0.001)
 
-    #q = conn.query_parse(conn.spell_correct(s))
-    q = conn.query_parse(s)
+    def _add_entries(self, place):
+        """Adds the place to the index, except for the trigrams and the sorted
+        tokens. Returns the tokens that were not in the index before.
+        """
+        tokens = get_place_tokens(place)
+        keys = get_place_keys(place)
+        self.place_entries[place.id] = (tokens, keys)
+        self.sort_keys[place.id] = (TYPE_RANKS.get(place.type, len(TYPE_RANKS)), (place.name or "").lower())
+        new_tokens = []
+        for token in tokens:
+            if token not in self.token_ids:
+                self.token_ids[token] = set()
+                new_tokens.append(token)
+            self.token_ids[token].add(place.id)
+        for k in keys:
+            self.key_ids.setdefault(k, set()).add(place.id)
+        return new_tokens
 
-    result = conn.search(q, page*20, page*20+20)
-    return result.matches_estimated, [models.Place.from_id(x.data['id']) for x in result]
+    def add(self, place):
+        """Adds the place to the index, replacing it if it is already there.
+        """
+        with self._lock:
+            self.remove(place.id)
+            for token in self._add_entries(place):
+                for trigram in get_trigrams(token):
+                    self.trigram_tokens.setdefault(trigram, set()).add(token)
+                bisect.insort(self.sorted_tokens, token)
 
-def index():
-    """Index entire database."""
-    indexer = xappy.IndexerConnection(config.search_db)
-    #indexer.add_field_action("id", xappy.FieldActions.STORE_CONTENT)
-    indexer.add_field_action("name", xappy.FieldActions.INDEX_FREETEXT, spell=True)
-    indexer.add_field_action("code", xappy.FieldActions.INDEX_EXACT)
-    indexer.add_field_action("type", xappy.FieldActions.INDEX_EXACT)
-    indexer.add_field_action("url", xappy.FieldActions.INDEX_EXACT)
+    def remove(self, id):
+        """Removes the place with the given id from the index.
+        """
+        with self._lock:
+            tokens, keys = self.place_entries.pop(id, ((), ()))
+            self.sort_keys.pop(id, None)
+            for token in tokens:
+                ids = self.token_ids[token]
+                ids.discard(id)
+                if not ids:
+                    # the token is not used by any place now
+                    del self.token_ids[token]
+                    for trigram in get_trigrams(token):
+                        self.trigram_tokens[trigram].discard(token)
+                    i = bisect.bisect_left(self.sorted_tokens, token)
+                    del self.sorted_tokens[i]
+            for k in keys:
+                self.key_ids[k].discard(id)
+                if not self.key_ids[k]:
+                    del self.key_ids[k]
 
-    def add_field(doc, k, v):
-        doc.fields.append(xappy.Field(k, v))
+    def update(self, places, ids):
+        """Updates the places with the given ids in the index.
+
+        The places is a dict of the current places by id. The ids missing in
+        it are the places that are deleted.
+        """
+        with self._lock:
+            for id in ids:
+                if id in places:
+                    self.add(places[id])
+                else:
+                    self.remove(id)
+
+    def _match_prefix(self, word):
+        """Returns the tokens starting with the word.
+        """
+        tokens = self.sorted_tokens
+        i = bisect.bisect_left(tokens, word)
+        result = []
+        while i < len(tokens) and tokens[i].startswith(word):
+            result.append(tokens[i])
+            i += 1
+        return result
+
+    def _match_fuzzy(self, word):
+        """Returns the tokens similar to the word, with their similarity.
+        """
+        trigrams = get_trigrams(word)
+        counts = {}
+        for trigram in trigrams:
+            for token in self.trigram_tokens.get(trigram, ()):
+                counts[token] = counts.get(token, 0) + 1
+        result = []
+        for token, common in counts.items():
+            similarity = float(common) / (len(trigrams) + len(get_trigrams(token)) - common)
+            if similarity >= FUZZY_THRESHOLD:
+                result.append((token, similarity))
+        return result
+
+    def _match_word(self, word):
+        """Returns a dict mapping the ids of the places matching the word to
+        their score.
+        """
+        scores = {}
+        def add(ids, score):
+            for id in ids:
+                if scores.get(id, 0) < score:
+                    scores[id] = score
+
+        for token in self._match_prefix(word):
+            add(self.token_ids[token], EXACT_SCORE if token == word else PREFIX_SCORE)
+        if not scores and len(word) >= 3:
+            for token, similarity in self._match_fuzzy(word):
+                add(self.token_ids[token], FUZZY_SCORE * similarity)
+        return scores
+
+    def search(self, query, limit=20, offset=0):
+        """Returns the number of places matching the query and the ids of
+        limit of them, starting from offset, in the order of their rank.
+        """
+        with self._lock:
+            return self._search(query, limit, offset)
+
+    def _search(self, query, limit, offset):
+        words = tokenize(query)
+        if not words:
+            return 0, []
+
+        scores = None
+        for word in words:
+            word_scores = self._match_word(word)
+            if scores is None:
+                scores = word_scores
+            else:
+                scores = dict((id, score + word_scores[id]) for id, score in scores.items() if id in word_scores)
+            if not scores:
+                return 0, []
+
+        for id in self.key_ids.get(query.strip().lower(), ()):
+            if id in scores:
+                scores[id] += KEY_SCORE
+
+        sort_keys = self.sort_keys
+        top = heapq.nsmallest(offset+limit, scores, key=lambda id: (-scores[id], sort_keys[id]))
+        return len(scores), top[offset:]
+
+_index = None
+# reentrant, as building the index may load the place tree, which notifies
+# _on_places_changed in the same thread
+_lock = threading.RLock()
+
+def build_index():
+    """Builds the search index of all the places in the place tree.
+    """
+    global _index
+    places = models.get_place_tree().get_all()
+    index = PlaceIndex()
+    rate = index.build(places)
+    logger.info("indexed %d places at %d places/second", len(places), rate)
+    _index = index
+    return index
+
+def get_index():
+    """Returns the search index of all the places, building it on first use.
+    """
+    if _index is None:
+        with _lock:
+            if _index is None:
+                build_index()
+    return _index
+
+def _on_places_changed(ids):
+    if _index is None:
+        return
+    if ids is None:
+        # all the places are reloaded
+        with _lock:
+            build_index()
+    else:
+        _index.update(models.get_place_tree().get_loaded(ids), ids)
 
-    def add_to_index(place):
-        print "indexing", place.url
-        doc = xappy.UnprocessedDocument()
-        doc.id = place.url
-        add_field(doc, "name", place.name)
-        add_field(doc, "type", place.type)
-        add_field(doc, "url", place.type)
-        doc = indexer.process(doc)
-        doc.data = {"id": place.id}
-        indexer.replace(doc)
+models.get_place_tree().add_listener(_on_places_changed)
 
-    places = models.Place.find_all()
-    for p in places:
-        add_to_index(p)
+def search(s, page=0, page_size=20):
+    """Returns the number of places matching the query and the places in
+    the given page of the results.
+    """
+    nmatched, ids = get_index().search(s, limit=page_size, offset=page*page_size)
+    places = models.get_place_tree().get_many(ids)
+    return nmatched, [places[id] for id in ids if id in places]
 
-    indexer.flush()
-    indexer.close()
+def autocomplete(s, limit=10):
+    """Returns the top places matching the query as a list of dicts with
+    key, name, type, type_label and url, to suggest while typing.
+    """
+    nmatched, places = search(s, page_size=limit)
+    return [{
+        "key": p.key,
+        "name": p.name,
+        "type": p.type,
+        "type_label": p.type_label,
+        "url": p.url
+    } for p in places]
 
 if __name__ == "__main__":
     import sys
@@ -62,4 +310,7 @@ if __name__ == "__main__":
         for d in result:
             print repr(d)
     else:
-        index()
\ No newline at end of file
+        places = models.get_place_tree().get_all()
+        t0 = time.time()
+        rate = PlaceIndex().build(places)
+        print "indexed {0} places in {1:0.3f} seconds ({2:d} places/second)".format(len(places), time.time() - t0, int(rate))
@@ -2,9 +2,9 @@ import web
 import os
 import logging
 from wtforms import Form, StringField, HiddenField, validators, ValidationError
-from models import Place, Invite, Voter
+from models import Place, Invite, Voter, Unsubscribe
 import webapp
-import utils
+import cachesync
 
 urls = (
     "/(.?.?)", "signup",
@@ -94,11 +94,7 @@ class signup:
                 voterid=i.voterid,
                 role='pb_agent',
                 notes=notes)
-            agent.populate_voterid_info()
-            if agent.get_voterid_info():
-                utils.sendmail_voterid_added(agent)
-            else:
-                utils.sendmail_voterid_pending(agent)
+            agent.enqueue_voterid_info(notify=True)
             return render.thankyou(place, agent)
         else:
             return render.signup(form)
@@ -129,10 +125,7 @@ class signup_invite:
             return render.signup_invite(form)
 
         agent = invite.signup(i.name, i.email, i.phone, i.voterid)
-        if agent.get_voterid_info():
-            utils.sendmail_voterid_added(agent)
-        else:
-            utils.sendmail_voterid_pending(agent)
+        agent.enqueue_voterid_info(notify=True)
         return render.thankyou(agent.place, agent)
 
     def get_invite(self, id, digest):
@@ -149,9 +142,7 @@ class unsubscribe:
         i = web.input()
         form = UnsubscribeForm(i)
         if form.validate():
-            db = get_db()
-            if not db.where("unsubscribe", email=i.email):
-                db.insert("unsubscribe", email=i.email)
+            Unsubscribe.add(i.email)
             return render.unsubscribe(form, done=True)
         else:
             return render.unsubscribe(form)
@@ -179,6 +170,7 @@ def main():
             web.config.get('error_from_address'))
     logger = logging.getLogger(__name__)
     logger.info("starting the signup app")
+    cachesync.start_listener()
     app.run()
 
 if __name__ == '__main__':
@@ -0,0 +1,110 @@
+"""Sends SMS through the SMS gateway, keeping a record of every SMS sent.
+
+The phone numbers an SMS is sent to are added as a batch, with a row for every
+phone number in the sms_log table. The numbers are sent to the gateway in
+chunks, a few chunks in parallel, and the status of the numbers is updated
+after each chunk. A batch interrupted by a crash is resumed by sending it
+again, which only sends to the numbers that are pending or failed.
+
+Sending an SMS is not idempotent. A chunk is marked as failed, and is sent
+again on resume, only when the request never reached the gateway or the
+gateway rejected it. When the request times out or the gateway fails with a
+5xx error, the gateway may have sent the SMS anyway, so the chunk is marked
+as unknown and is never sent again automatically.
+
+The gateway is configured using sms_url in the config. When it is not set,
+the messages are printed instead of being sent. Any other provider, like a
+stand-in for tests, can be used by passing it to send_batch or set_provider.
+"""
+import web
+import urllib
+import logging
+from multiprocessing.pool import ThreadPool
+
+import httpclient
+
+logger = logging.getLogger(__name__)
+
+# max number of phone numbers sent to the gateway in a single request
+CHUNK_SIZE = 300
+
+class HTTPProvider:
+    """Sends SMS by requesting the sms_url of the gateway.
+
+    The url is a format string with phone_numbers and message as fields.
+    """
+    def __init__(self, url, pool_size=4, timeout=30, retries=0):
+        self.url = url
+        self.pool = httpclient.ConnectionPool(url, size=pool_size, timeout=timeout, retries=retries)
+
+    def send(self, phones, message):
+        """Sends the message to the phones and returns the response of the gateway.
+        """
+        url = self.url.format(
+            phone_numbers=urllib.quote_plus(",".join(phones)),
+            message=urllib.quote_plus(web.safestr(message)))
+        return self.pool.get(httpclient.get_path(url), idempotent=False)
+
+class DebugProvider:
+    """Prints the messages instead of sending them.
+    """
+    def send(self, phones, message):
+        print >> web.debug, "To: {}".format(",".join(phones))
+        print >> web.debug, message
+        return ""
+
+_provider = None
+
+def get_provider():
+    global _provider
+    if _provider is None:
+        if web.config.get('sms_url'):
+            _provider = HTTPProvider(web.config.sms_url)
+        else:
+            _provider = DebugProvider()
+    return _provider
+
+def set_provider(provider):
+    """Sets the provider to send SMS through, instead of the one from the config.
+    """
+    global _provider
+    _provider = provider
+
+def get_failure_status(error):
+    """Returns the status of the phones of a chunk that failed with the error.
+
+    It is "failed" when the SMS was surely not sent and "unknown" when the
+    gateway may have sent it.
+    """
+    if isinstance(error, httpclient.ConnectError):
+        return "failed"
+    elif isinstance(error, httpclient.HTTPError) and error.status < 500:
+        return "failed"
+    else:
+        return "unknown"
+
+def send_batch(batch, provider=None, concurrency=4):
+    """Sends the message of the batch to all the phones in the batch that it
+    is not sent to yet. Returns the number of phones by status.
+    """
+    provider = provider or get_provider()
+    chunks = list(web.group(batch.get_unsent_phones(), CHUNK_SIZE))
+
+    def send_chunk(phones):
+        try:
+            response = provider.send(phones, batch.message)
+        except Exception, e:
+            status = get_failure_status(e)
+            logger.error("failed to send sms of batch %s to %d phones (%s)", batch.id, len(phones), status, exc_info=True)
+            batch.set_status(phones, status, response=str(e))
+        else:
+            logger.info("sent sms of batch %s to %d phones\n%s", batch.id, len(phones), response)
+            batch.set_status(phones, "sent", response=web.safestr(response))
+
+    if chunks:
+        pool = ThreadPool(min(concurrency, len(chunks)))
+        try:
+            pool.map(send_chunk, chunks)
+        finally:
+            pool.close()
+    return batch.get_stats()
@@ -3,10 +3,10 @@ import logging
 import re
 import datetime
 import functools
-from models import Thing, get_db
+from models import Person, SMSBatch, Unsubscribe, SendLedger, get_db
+import jobs
 import envelopes 
-import urllib
-import subprocess
+import smtplib
 import sys
 
 logger = logging.getLogger(__name__)
@@ -24,8 +24,38 @@ def get_smtp_conn():
         login=web.config.smtp_username,
         password=web.config.smtp_password)
 
+def connect_smtp():
+    """Returns a new connection to the SMTP server, logged in and ready to
+    send, or None in debug mode. Unlike get_smtp_conn, the connection is made
+    right away, so that connection failures are raised here.
+    """
+    if web.config.debug:
+        return None
+
+    conn = smtplib.SMTP(web.config.smtp_server, web.config.smtp_port)
+    conn.ehlo()
+    if web.config.smtp_starttls:
+        conn.starttls()
+        conn.ehlo()
+    if web.config.smtp_username:
+        conn.login(web.config.smtp_username, web.config.smtp_password)
+    return conn
+
 def get_unsubscribes():
-    return set(row.email for row in get_db().select("unsubscribe"))
+    """Returns the set of unsubscribed email addresses, lowercased.
+    """
+    return Unsubscribe.get_all()
+
+def make_envelope(to_addr, message, cc=None, bcc=None, subject=None):
+    if subject is None:
+        subject = message.subject.strip()
+    return envelopes.Envelope(
+        from_addr=web.config.from_address,
+        to_addr=to_addr,
+        subject=subject,
+        text_body=web.safestr(message),
+        cc_addr=cc or [],
+        bcc_addr=bcc or web.config.get("email_bcc_address") or [])
 
 def send_email(to_addr, message, cc=None, bcc=None, conn=None, subject=None):
     global email_count
@@ -48,13 +78,7 @@ def send_email(to_addr, message, cc=None, bcc=None, conn=None, subject=None):
         return True
     else:
         logger.info("{}: sending email to {} with subject {!r}".format(email_count, to_addr, subject))
-        envelope = envelopes.Envelope(    
-            from_addr=web.config.from_address,
-            to_addr=to_addr,
-            subject=subject,
-            text_body=message,
-            cc_addr=cc,
-            bcc_addr=bcc)
+        envelope = make_envelope(to_addr, message, cc=cc, bcc=bcc, subject=subject)
         conn = conn or get_smtp_conn()
         try:
             conn.send(envelope)
@@ -67,31 +91,12 @@ def send_email(to_addr, message, cc=None, bcc=None, conn=None, subject=None):
 def sendmail_batch(batch, async=False):
     """Starts sending all messages in the given batch.
 
-    If async is True, a new process will be created for sending messages.
+    If async is True, the messages are sent by a background job.
     """
     if async:
-        python = sys.executable
-        args = [
-            python, "voternet/utils.py",
-            "--config", web.config.configfile,
-            "sendmail-batch", str(batch.id)]
-        p = subprocess.Popen(args)
-        return p
-    messages = batch.get_messages(status='pending')
-    conn = get_smtp_conn()
-    unsubscribes = get_unsubscribes()
-
-    for m in messages:
-        if m.to_address in unsubscribes:
-            m.set_status('unsubscribed')
-            continue
-
-        message = batch.message.replace('{name}', m.name).replace('{email}', m.to_address or "")
-        success = send_email(m.to_address, message=message, subject=batch.subject, conn=conn)
-        if success:
-            m.set_status('sent')
-        else:
-            m.set_status('failed')
+        return jobs.enqueue("sendmail-batch", key="sendmail-batch/%d" % batch.id, batch_id=batch.id)
+    import mailer
+    return mailer.BatchSender(batch).send()
 
 def parse_datetime(value):
     """Creates datetime object from isoformat.
@@ -106,35 +111,47 @@ def parse_datetime(value):
         tokens = re.split('-|T|:|\.| ', value)
         return datetime.datetime(*map(int, tokens))        
 
+def limit_sends(hours=None):
+    """Decorator to call the function at most once for an agent in the given
+    hours, or only once when hours is None.
+
+    The function is called with the agent as first argument and the calls are
+    recorded in the send ledger by the email of the agent.
+    """
+    def decorator(f):
+        @functools.wraps(f)
+        def g(agent, *a, **kw):
+            if not agent.email:
+                return
+            if not SendLedger.claim(f.__name__, agent.email, hours=hours):
+                logger.info("Already sent {} email to {}. Ignoring...".format(f.__name__, agent.email))
+                return
+            try:
+                f(agent, *a, **kw)
+            except Exception:
+                SendLedger.release(f.__name__, agent.email)
+                raise
+        g.template = f.__name__
+        g.hours = hours
+        return g
+    return decorator
+
 def limit_once(f):
     """Decorator to call the function only once.
     """
-    @functools.wraps(f)    
-    def g(agent, *a, **kw):
-        key = f.__name__ + "/" + agent.email
-        if not Thing.find(key):
-            f(agent, *a, **kw)
-            Thing(key=key, type="email", sent_on=datetime.datetime.utcnow().isoformat()).save()
-        else:
-            logger.info("Already sent {} email to {}. Ignoring...".format(f.__name__, agent.email))
-    return g
+    return limit_sends()(f)
 
 def limit_once_per_day(f):
     """Decorator to call the function at most once a day.
     """
-    @functools.wraps(f)
-    def g(agent, *a, **kw):
-        if not agent.email:
-            return
-        key = f.__name__ + "/" + agent.email
-        t = Thing.find(key) or Thing(key=key, type="email", sent_on="2000-01-02T03:04:05")
-        if parse_datetime(t.sent_on) < datetime.datetime.utcnow()-datetime.timedelta(days=1):
-            f(agent, *a, **kw)
-            t.sent_on = datetime.datetime.utcnow().isoformat()
-            t.save()
-        else:
-            logger.info("Already sent {} email to {} once today. Ignoring...".format(f.__name__, agent.email))
-    return g
+    return limit_sends(hours=24)(f)
+
+def filter_unsent(f, agents):
+    """Returns the agents that f, a function decorated with limit_sends, is
+    yet to be called for. Uses a single query for all the agents.
+    """
+    emails = set(SendLedger.filter_unsent(f.template, [a.email for a in agents], hours=f.hours))
+    return [a for a in agents if a.email in emails]
 
 @limit_once
 def sendmail_voterid_added(agent, conn=None):
@@ -170,16 +187,38 @@ def notify_signup(volunteer):
 
 @limit_once_per_day
 def sendmail_voterid_pending(agent, conn=None):
-    unsubscribes = get_unsubscribes()
-
     from webapp import xrender
     if agent.role == "pb_agent":
         msg = xrender.email_agent_voterid_pending(agent)
-        if agent.email in unsubscribes:
+        if Unsubscribe.is_unsubscribed(agent.email):
             logger.warn("Ignoring %s as he unsubscribed", agent.email)
         else:
             send_email(agent.email, msg, conn=conn)
 
+@jobs.register("sendmail-batch")
+def sendmail_batch_job(batch_id):
+    from models import SendMailBatch
+    batch = SendMailBatch.find(batch_id)
+    if batch:
+        sendmail_batch(batch)
+    else:
+        logger.warn("unknown batch %s", batch_id)
+
+@jobs.register("voterid-info")
+def populate_voterid_info(person_id, notify=False):
+    """Populates the voterid info of a person and, if notify is True, emails
+    the person about the status of the voterid.
+    """
+    person = Person.find_by_id(person_id)
+    if not person:
+        return
+    person.populate_voterid_info()
+    if notify:
+        if person.get_voterid_info():
+            sendmail_voterid_added(person)
+        else:
+            sendmail_voterid_pending(person)
+
 def process_phone(number):
     if not number:
         return
@@ -189,24 +228,34 @@ def process_phone(number):
         number = number[2:]
     return number
 
-def send_sms(agents, message):
-    if not web.config.get('sms_url'):
-        print >> web.debug, "To: {}".format(",".join(a.phone for a in agents))
-        print >> web.debug, message
-        return
+def send_sms(agents, message, async=False):
+    """Sends the message to the phones of the agents, except those who have
+    unsubscribed. Returns the number of phones.
 
-    unsubscribes = get_unsubscribes()
-    phones = [process_phone(a.phone) for a in agents if a.email not in unsubscribes]
+    If async is True, the message is sent by a background job.
+    """
+    phones = [process_phone(a.phone) for a in agents if not Unsubscribe.is_unsubscribed(a.email)]
     phones = set(p for p in phones if p and len(p) == 10)
-    for chunk in web.group(phones, 300):
-        phone_numbers = ",".join(chunk)
-        url = web.config.sms_url.format(
-            phone_numbers=urllib.quote_plus(phone_numbers), 
-            message=urllib.quote_plus(message))
-        response = urllib.urlopen(url)
-        logger.info("sms response\n%s", response.read())
+    batch = SMSBatch.new(message, phones)
+    if async:
+        jobs.enqueue("sms-batch", key="sms-batch/%d" % batch.id, batch_id=batch.id)
+    else:
+        import sms
+        sms.send_batch(batch)
     return len(phones)
 
+@jobs.register("sms-batch")
+def send_sms_batch_job(batch_id):
+    import sms
+    batch = SMSBatch.find(batch_id)
+    if not batch:
+        logger.warn("unknown sms batch %s", batch_id)
+        return
+    stats = sms.send_batch(batch)
+    if stats.get("failed"):
+        # fail the job, so that it is retried
+        raise Exception("failed to send sms of batch {} to {} phones".format(batch_id, stats.failed))
+
 def main():
     import webapp
     from models import SendMailBatch
@@ -4,11 +4,19 @@ import web
 import sys
 import logging
 import urllib
+import urlparse
 import json
+from multiprocessing.pool import ThreadPool
+
+import httpclient
+
 logger = logging.getLogger(__name__)
 
 URL = "http://ceokarnataka.kar.nic.in/SearchWithEpicNo_New.aspx"
 
+# The voter search service
+DEFAULT_URL = "http://voter.missionvistaar.in/search"
+
 def get_voter_details_old(voterid):
     # ignore voterids like "yes" etc.
     if len(voterid) <= 4:
@@ -40,21 +48,82 @@ def get_voter_details_old(voterid):
     logger.info("voter info %s %s", voterid, d)   
     return web.storage(d)
 
-def get_voter_details(voterid):    
-    response = urllib.urlopen("http://voter.missionvistaar.in/search?voterid=" + voterid).read()
-    d = json.loads(response)
-    if d:
-        cols = "ac_num ac_name part_no sl_no first_name last_name rel_firstname rel_lastname sex age".split()
-        mapping = {
-            "ac_num": "ac",
-            "part_no": "part",
-            "sl_no": "serial",
-            "first_name": "name",
-            "rel_firstname": "relname"
-        }
-        return web.storage({c:d.get(mapping.get(c, c), "") for c in cols})
+COLUMNS = "ac_num ac_name part_no sl_no first_name last_name rel_firstname rel_lastname sex age".split()
+
+# column name -> name of the field in the response of the voter search service
+MAPPING = {
+    "ac_num": "ac",
+    "part_no": "part",
+    "sl_no": "serial",
+    "first_name": "name",
+    "rel_firstname": "relname"
+}
+
+class VoterLookupError(Exception):
+    pass
+
+class Fetcher:
+    """Fetches voter details from the voter search service.
+
+    Up to pool_size requests are made in parallel over a pool of keep-alive
+    connections. Failed requests are retried with exponential backoff.
+
+    The url of the service can be changed using voter_search_url in the
+    config, or by passing it to the constructor.
+    """
+    def __init__(self, url=None, pool_size=4, timeout=10, retries=3, backoff=0.5):
+        self.url = url or web.config.get("voter_search_url") or DEFAULT_URL
+        self.pool_size = pool_size
+        self.path = urlparse.urlsplit(self.url).path or "/"
+        self.pool = httpclient.ConnectionPool(self.url, size=pool_size, timeout=timeout, retries=retries, backoff=backoff)
+
+    def fetch(self, voterid):
+        """Returns the details of the voter with the given voterid or None
+        if there is no such voter.
+
+        Raises VoterLookupError if the service could not be reached even after
+        retrying.
+        """
+        path = self.path + "?" + urllib.urlencode({"voterid": voterid})
+        try:
+            d = json.loads(self.pool.get(path))
+        except (httpclient.RETRY_ERRORS + (ValueError,)), e:
+            raise VoterLookupError("failed to get voter details of {0}: {1}".format(voterid, e))
+        if d:
+            details = web.storage({c:d.get(MAPPING.get(c, c), "") for c in COLUMNS})
+            details.voterid = voterid
+            return details
+
+    def fetch_many(self, voterids):
+        """Returns a dict mapping voterid to voter details, or None if there is
+        no such voter, for all the given voterids.
+
+        The voterids that could not be looked up are left out.
+        """
+        def fetch(voterid):
+            try:
+                return voterid, self.fetch(voterid)
+            except VoterLookupError:
+                logger.error("failed to get voter details of %s", voterid, exc_info=True)
+
+        voterids = list(set(voterids))
+        pool = ThreadPool(min(self.pool_size, len(voterids)) or 1)
+        try:
+            return dict(r for r in pool.map(fetch, voterids) if r)
+        finally:
+            pool.close()
+
+@web.memoize
+def get_fetcher():
+    return Fetcher()
+
+def get_voter_details(voterid):
+    return get_fetcher().fetch(voterid)
 
+def get_voter_details_many(voterids):
+    return get_fetcher().fetch_many(voterids)
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO, format = "[%(levelname)s] : %(filename)s:%(lineno)d : %(message)s")
-    print get_voter_details(sys.argv[1])
+    for voterid, d in sorted(get_voter_details_many(sys.argv[1:]).items()):
+        print voterid, d
@@ -8,17 +8,21 @@ import functools
 import datetime
 from cStringIO import StringIO
 import pytz
-import tablib
 import urllib
 import logging
 
-from models import Place, Person, Invite, SendMailBatch, get_all_coordinators_as_dataset, get_voterid_details
+from models import Place, Person, SendMailBatch, get_all_coordinators_as_dataset, get_voterid_details
 import forms
 import googlelogin
 import account
 import search
 import flash
 import utils
+import cache
+import cachesync
+import exports
+import importer
+import jobs
 
 logger = logging.getLogger("webapp")
 
@@ -45,7 +49,10 @@ urls = (
 
     "/sudo", "sudo",
     "/debug", "debug",
-    "/search", "do_search",    
+    "/debug/cache", "debug_cache",
+    "/debug/jobs", "debug_jobs",
+    "/search", "do_search",
+    "/search.json", "search_json",    
     "/download/(.*)", "download",
     "/voterid/(.*)", "voter_info",    
     "/([A-Z][A-Z])/users", "users",    
@@ -53,7 +60,7 @@ urls = (
     "/([\w/]+)/edit", "edit_place",
     "/([\w/]+)/info", "place_info",
     "/([\w/]+)/signups", "vol_signups",
-    "/([\w/]+)/signups.xls", "vol_signups_xls",
+    "/([\w/]+)/signups.(xls|xlsx|csv)", "vol_signups_xls",
     "/([\w/]+)/localities", "place_localities",
     "/([\w/]+)/export-localities", "export_localities",
     "/([\w/]+)/booths", "pb_list",
@@ -64,10 +71,11 @@ urls = (
     "/([\w/]+)/import-people", "import_people",
     "/([\w/]+)/people", "list_people",
     "/([\w/]+)/people/(\d+)", "edit_person",
+    "/([\w/]+)/people/search", "search_people",
     "/([\w/]+)/links", "links",
-    "/([\w/]+)/coordinators.xls", "download_coordinators",
-    "/([\w/]+)/volunteers.xls", "download_volunteers",
-    "/([\w/]+)/pb-agents.xls", "download_pb_agents",
+    "/([\w/]+)/coordinators.(xls|xlsx|csv)", "download_coordinators",
+    "/([\w/]+)/volunteers.(xls|xlsx|csv)", "download_volunteers",
+    "/([\w/]+)/pb-agents.(xls|xlsx|csv)", "download_pb_agents",
     "/([\w/]+)/member-registrations.xls", "download_member_registrations",
     "/([\w/]+)/ward-report", "ward_report",
     "/([\w/]+)/activity", "activity",
@@ -192,6 +200,8 @@ tglobals = {
     "get_today": get_today,
     "get_yesterday": get_yesterday,
     "get_flashed_messages": flash.get_flashed_messages,
+    "get_places_stats": Place.get_places_stats,
+    "prefetch_people": Person.prefetch,
     "get_site_url": lambda : web.ctx.home,
     "get_url": lambda: web.ctx.home + web.ctx.fullpath,
 
@@ -314,30 +324,36 @@ class pb_list:
     def POST(self, place):
         data = json.loads(web.data())['data']
 
+        assignments = []
         for row in data:
-            code = place.key + "/" + row['code']
-            pb = Place.find(code)
+            pb = row['code'] and Place.find(place.key + "/" + row['code'])
+            if not pb:
+                logger.warn("Unknown polling booth. Ignoring this %s", row)
+                continue
+            ward = self.find_place(place, row['ward'], pb.get_parent("WARD"))
+            px = self.find_place(place, row['px'], pb.get_parent("PX"))
+            assignments.append((pb, ward, px))
+        count = place.assign_booths(assignments)
+        logger.info("updated the ward/polling center of %d booths of %s", count, place.key)
 
-            if row['ward'] and row['ward'].strip():
-                # Extract te group code from its name
-                key = place.key + "/" + row['ward'].split("-")[0].strip()
-                ward = Place.find(key)
-                if pb.ward_id != ward.id:
-                    pb.set_ward(ward)
-            else:
-                pb.set_ward(None)
+        web.header("content-type", "application/json")
+        return json.dumps({"result": "ok", "updated": count})
 
-            if row['px'] and row['px'].strip():
-                # Extract te group code from its name
-                key = place.key + "/" + row['px'].split("-")[0].strip()
-                px = Place.find(key)
-                if pb.px_id != px.id:
-                    pb.set_px(px)
-            else:
-                pb.set_px(None)
+    def find_place(self, ac, name, default):
+        """Finds the ward or polling center of the AC from its name in the grid.
 
-        web.header("content-type", "application/json")
-        return '{"result": "ok"}'
+        Returns None when the name is empty and the default when no such place
+        is found.
+        """
+        if not name or not name.strip():
+            return None
+        # Extract the code from its name
+        key = ac.key + "/" + name.split("-")[0].strip()
+        place = Place.find(key)
+        if not place:
+            logger.warn("Unknown place %s in the polling booth list of %s", name, ac.key)
+            return default
+        return place
 
 class vol_signups:
     @placify(roles=['admin', 'coordinator'])
@@ -346,17 +362,9 @@ class vol_signups:
 
 class vol_signups_xls:
     @placify(roles=['admin', 'coordinator'])
-    def GET(self, place):
-        web.header("Content-disposition", "attachment; filename=%s-signups.xls" % place.code)
-        web.header("Content-Type", "application/vnd.ms-excel")
-        return self.get_dataset(place).xls
-
-    def get_dataset(self, place):
+    def GET(self, place, format):
         headers = ['Name', "Phone", 'Email', 'Locality', 'Ward', 'Timestamp']
-        dataset = tablib.Dataset(headers=headers)
-        for p in place.get_signups():
-            dataset.append([p.name, p.phone, p.email, p.address, p.get_place().name, p.added.isoformat()])
-        return dataset
+        return exports.export(place.code + "-signups", format, headers, place.iter_signup_rows())
 
 class pb_groups:
     @placify(roles=['admin', 'coordinator'])
@@ -449,69 +457,28 @@ class import_people:
         i = json.loads(web.data())
         batch = i.get('batch')
         as_invite = i.get('as_invite', False)
-        data = i['data']
-        data = [self.process_row(row) for row in data]
-
-        # skip empty rows
-        data = [row for row in data if any(row) and row.name]
-        count = 0
-        for row in data:
-            if self.add_volunteer(row, place, batch, as_invite):
-                count += 1
-        flash.add_flash_message("success", "Added {0} volunteers.".format(count))
-        #raise web.seeother(place.url)
+        data = [self.process_row(row) for row in i['data']]
+
+        # skip empty rows, keeping the row numbers of the spreadsheet
+        rows = [(index, row) for index, row in enumerate(data) if any(row.values()) and row.name]
+        results = importer.PeopleImporter(place, batch=batch, as_invite=as_invite).import_rows([row for index, row in rows])
+        for (index, row), r in zip(rows, results):
+            r['row'] = index
+
+        added = len([r for r in results if r['status'] == 'added'])
+        skipped = len(results) - added
+        if skipped:
+            flash.add_flash_message("success", "Added {0} volunteers. Skipped {1} rows.".format(added, skipped))
+        else:
+            flash.add_flash_message("success", "Added {0} volunteers.".format(added))
         web.header("content-type", "application/json")
-        return '{"result": "ok"}'
+        return json.dumps({"result": "ok", "added": added, "skipped": skipped, "rows": results})
 
     def process_row(self, row):
         """Strips all values.
         """
         return web.storage((k, v and v.strip()) for k, v in row.items())
 
-    def add_volunteer(self, row, ac, batch, as_invite):
-        if not row.name:
-            return
-
-        if row.place:
-            key = ac.key + "/" + row.place.split("-")[0].strip()
-            place = Place.find(key)
-            if not place:
-                return
-        else:
-            place = ac
-        if row.email and place.find_volunteer(email=row.email, phone=None, role=row.role):
-            logger.warn("Already found a vol with same email and role. Ignoring this %s", row)
-            return
-        if row.phone and place.find_volunteer(email=None, phone=row.phone, role=row.role):
-            logger.warn("Already found a vol with same phone number and role. Ignoring this %s", row)
-            return
-        if not row.email and not row.phone:
-            logger.warn("No email/phone number specified. Ignoring this %s", row)
-            return
-
-        if as_invite:
-            if not row.email:
-                logger.warn("Can't add invite as no email provided. Ignoring this %s", row)
-                return
-            if Invite.find_by_email(row.email):
-                logger.warn("Already found an invite with the same email. Ignoring this %s", row)
-                return
-
-            place.add_invite(       
-                name=row.name, 
-                phone=row.phone, 
-                email=row.email, 
-                batch=batch)
-        else:
-            place.add_volunteer(
-                name=row.name, 
-                phone=row.phone, 
-                email=row.email, 
-                voterid=row.voterid, 
-                role=row.role,
-                notes=batch)
-        return True
-
 class pb_agents:
     @placify(roles=['coordinator', 'admin'], types=['PC', 'AC', 'WARD', 'PB'])
     def GET(self, place):
@@ -580,10 +547,20 @@ class list_people:
 
     def GET_json(self, place, i):
         people = place.get_all_volunteers(["coordinator", "volunteer", "pb_agent"], notes=i.notes, email=i.email)
-        d = [p.dict() for p in people]
+        d = [p.dict() for p in Person.prefetch(people)]
         web.header("content-type", "application/json")
         return json.dumps(d)
 
+class search_people:
+    @placify(roles=['coordinator', 'admin'])
+    def GET(self, place):
+        i = web.input(q="", format="html")
+        people = Person.prefetch(place.search_people(i.q)) if i.q.strip() else []
+        if i.format == "json":
+            web.header("content-type", "application/json")
+            return json.dumps([dict(p.dict(), url=p.get_url()) for p in people])
+        return render.people_search(place, i.q, people)
+
 class edit_person:
     @placify()
     def GET(self, place, id):
@@ -617,11 +594,7 @@ class edit_person:
                 d['role'] = i.role
             person.update(d)
             if person.role == 'pb_agent':
-                person.populate_voterid_info()
-                if person.get_voterid_info():
-                    utils.sendmail_voterid_added(person)
-                else:
-                    utils.sendmail_voterid_pending(person)
+                person.enqueue_voterid_info(notify=True)
             flash.add_flash_message("success", "Thanks for updating!")            
         elif i.action == "delete" and self.can_change_role(user): # don't allow self deletes
             person.delete()
@@ -768,6 +741,28 @@ class debug:
                 raise web.notfound()
         return "hello world!"
 
+class debug_cache:
+    def GET(self):
+        user = account.get_current_user()
+        if not user or user.email not in web.config.get('super_admins', []):
+            return render.access_restricted()
+
+        i = web.input(reset=None)
+        if i.reset:
+            for backend in cache.backends.values():
+                backend.reset_stats()
+        web.header("content-type", "application/json")
+        return json.dumps(cache.get_stats(), indent=4)
+
+class debug_jobs:
+    def GET(self):
+        user = account.get_current_user()
+        if not user or user.email not in web.config.get('super_admins', []):
+            return render.access_restricted()
+
+        web.header("content-type", "application/json")
+        return json.dumps(jobs.get_status(), indent=4)
+
 class do_search:
     def GET(self):
         i = web.input(q="", page=1)
@@ -778,6 +773,13 @@ class do_search:
         else:
             return render.search(i.q, nmatched, results)
 
+class search_json:
+    def GET(self):
+        i = web.input(q="", limit=10)
+        limit = min(int(i.limit), 50)
+        web.header("content-type", "application/json")
+        return json.dumps(search.autocomplete(i.q, limit=limit))
+
 def is_coordinator(levels=['STATE']):
     user = account.get_current_user()
     _is_admin = user and user.role == 'admin'
@@ -800,8 +802,10 @@ class download:
         web.header("Content-Type", "application/vnd.ms-excel")
         return dataset.xls
 
+VOLUNTEER_EXPORT_HEADERS = ['Name', 'E-Mail', 'Phone', 'Voter ID', 'Role', 'Polling Booth', 'Ward', 'Assembly Constituency', 'Parliamentary Constituency']
+
 class download_coordinators:
-    def GET(self, code):
+    def GET(self, code, format):
         if not is_coordinator():
             raise web.notfound()
 
@@ -811,32 +815,26 @@ class download_coordinators:
         user = account.get_current_user()
         if not place.writable_by(user, roles=['coordinator', 'admin']):
             raise web.seeother(place.url)
-        dataset = place.get_all_coordinators_as_dataset()
-        web.header("Content-disposition", "attachment; filename=%s-coordinators.xls" % place.code)
-        web.header("Content-Type", "application/vnd.ms-excel")
-        return dataset.xls
+        rows = place.iter_coordinator_rows()
+        return exports.export(place.code + "-coordinators", format, VOLUNTEER_EXPORT_HEADERS, rows)
 
 class download_volunteers:
     @placify(roles=['coordinator', 'admin'])
-    def GET(self, place):
+    def GET(self, place, format):
         if not is_coordinator():
             raise web.notfound()
 
-        dataset = place.get_all_volunteers_as_dataset()
-        web.header("Content-disposition", "attachment; filename=%s-volunteers.xls" % place.code)
-        web.header("Content-Type", "application/vnd.ms-excel")
-        return dataset.xls
+        rows = place.iter_volunteer_rows()
+        return exports.export(place.code + "-volunteers", format, VOLUNTEER_EXPORT_HEADERS, rows)
 
 class download_pb_agents:
     @placify(roles=['coordinator', 'admin'])
-    def GET(self, place):
+    def GET(self, place, format):
         if not is_coordinator():
             raise web.notfound()
 
-        dataset = place.get_all_volunteers_as_dataset(roles=['pb_agent'])
-        web.header("Content-disposition", "attachment; filename=%s-pb-agents.xls" % place.code)
-        web.header("Content-Type", "application/vnd.ms-excel")
-        return dataset.xls
+        rows = place.iter_volunteer_rows(roles=['pb_agent'])
+        return exports.export(place.code + "-pb-agents", format, VOLUNTEER_EXPORT_HEADERS, rows)
 
 class download_member_registrations:
     @placify(roles=['coordinator', 'admin'])
@@ -854,7 +852,9 @@ class download_member_registrations:
 class activity:
     @placify(roles=['admin', 'coordinator'])
     def GET(self, place):
-        activities = place.get_activity()
+        i = web.input(before=None)
+        before = i.before and i.before.isdigit() and int(i.before) or None
+        activities = place.get_activity(before=before)
         return render.activity(place, activities)
 
 class send_sms:
@@ -870,8 +870,8 @@ class send_sms:
         if not form.validate():
             return render.sms(place, form)
         people = self.get_people(place, i.people)
-        count = utils.send_sms(people, i.message)
-        flash.add_flash_message("success", "Successfully sent SMS to {} people".format(count))
+        count = utils.send_sms(people, i.message, async=True)
+        flash.add_flash_message("success", "Sending SMS to {} people".format(count))
         return render.sms(place, form)
 
     def get_people(self, place, choice):
@@ -879,10 +879,10 @@ class send_sms:
             user = account.get_current_user()
             return [user]
         elif choice == "agents.confirmed":
-            agents = [p for p in place.get_pb_agents() if p.get_voterid_info()]
+            agents = [p for p in Person.prefetch(place.get_pb_agents()) if p.get_voterid_info()]
             return agents
         elif choice == "agents.pending":
-            agents = [p for p in place.get_pb_agents() if not p.get_voterid_info()]
+            agents = [p for p in Person.prefetch(place.get_pb_agents()) if not p.get_voterid_info()]
             return agents
         elif choice == "volunteers":
             return place.volunteers
@@ -952,7 +952,9 @@ class new_message:
 class messages:
     @placify()
     def GET(self, place):
-        return render.messages(place)
+        i = web.input(before=None)
+        before = i.before and i.before.isdigit() and int(i.before) or None
+        return render.messages(place, before)
 
 class view_message:
     @placify()
@@ -1199,6 +1201,7 @@ class tmp_px_dump:
 
 def load_config(configfile):
     web.config.update(yaml.load(open(configfile)))
+    cache.configure_from_config(web.config.get("cache"))
 
 def check_config():
     if "--config" in sys.argv:
@@ -1231,6 +1234,7 @@ def main():
 
     logger = logging.getLogger(__name__)
     logger.info("starting the webapp")
+    cachesync.start_listener()
     app.run()
 
 if __name__ == "__main__":
@@ -12,4 +12,6 @@ except IOError:
 # line, it's possible required libraries won't be in your searchable path
 #
 from voternet.webapp import app
+from voternet import cachesync
+cachesync.start_listener()
 application = app.wsgifunc()